@@ -0,0 +1,266 @@
+#! /usr/bin/env python3
+"""
+adaptive filters for the noise gates, all with the same interface as adaptfilt.nlms:
+
+	y, e, w = nlms(u, d, taps, mu, ...)
+
+u is the filter input, d the desired signal, e[n] = d[n + taps - 1] - y[n] is the error
+(worked out before the update) and y[n] is the output of the weights after it
+
+nlms => one sample at a time, the reference (and exactly what adaptfilt did)
+block_nlms => the same numbers as nlms (to rounding) but a block of samples at a time
+fdaf => frequency domain adaptive filter, one normalised step per block
+
+everything works along the last axis, any leading axes are independent filters and mu
+can be given per filter (an array of the leading shape)
+"""
+
+import numpy as np
+import fft_wrapper as fft
+
+
+def prepare(u, d, taps, mu, eps, leak, init_coeffs, n):
+	""" check the parameters and get everything into shape
+	inputs: see nlms
+	
+	return: u, d, initial weights (..., taps), mu (..., 1), leakstep (..., 1), n
+	side_effects: None
+	"""
+	
+	if np.iscomplexobj(u) or np.iscomplexobj(d):
+		raise Exception("only real signals can be filtered")
+	
+	u = np.asarray(u, dtype=np.float64)
+	d = np.asarray(d, dtype=np.float64)
+	
+	if int(taps) != taps or taps < 1:
+		raise Exception("taps must be a positive integer")
+	
+	taps = int(taps)
+	
+	if n is None:
+		n = u.shape[-1] - taps + 1
+	
+	if n < 0 or n > u.shape[-1] - taps + 1:
+		raise Exception("can do at most len(u) - taps + 1 iterations")
+	
+	if d.shape[-1] < n + taps - 1:
+		raise Exception("d needs to be at least n + taps - 1 long")
+	
+	if eps < 0:
+		raise Exception("eps must be non-negative")
+	
+	if not 0 <= leak < 1:
+		raise Exception("leak must be in [0, 1)")
+	
+	batch = np.broadcast_shapes(u.shape[:-1], d.shape[:-1], np.shape(mu))
+	
+	mu = np.broadcast_to(np.asarray(mu, dtype=np.float64), batch)[..., np.newaxis]
+	
+	if np.any(mu < 0):
+		raise Exception("mu must be non-negative")
+	
+	if init_coeffs is None:
+		w = np.zeros(batch + (taps, ))
+	else:
+		w = np.array(np.broadcast_to(np.asarray(init_coeffs, dtype=np.float64), batch + (taps, )))
+	
+	u = np.broadcast_to(u, batch + u.shape[-1:])
+	d = np.broadcast_to(d, batch + d.shape[-1:])
+	
+	return u, d, w, mu, 1 - mu * leak, n
+
+
+def nlms(u, d, taps, mu, eps=0.001, leak=0, initCoeffs=None, N=None, returnCoeffs=False):
+	""" normalised least mean squares, a sample at a time
+	inputs:
+	u => filter input
+	d => desired signal, at least N + taps - 1 long
+	taps => number of weights
+	mu => step size
+	eps => regularisation, stops the normalisation blowing up in silence
+	leak => leakage factor, 0 => normal nlms
+	initCoeffs => starting weights, defaults to 0
+	N => number of iterations, defaults to len(u) - taps + 1
+	returnCoeffs => return the weights after every iteration rather than just the last
+	
+	return: y, e, w (w is (..., N, taps) if returnCoeffs)
+	side_effects: None
+	"""
+	
+	u, d, w, mu, leakstep, n = prepare(u, d, taps, mu, eps, leak, initCoeffs, N)
+	
+	y = np.zeros(w.shape[:-1] + (n, ))
+	e = np.zeros(w.shape[:-1] + (n, ))
+	
+	if returnCoeffs:
+		coeffs = np.zeros(w.shape[:-1] + (n, taps))
+	
+	for i in range(n):
+		x = u[..., i:i + taps][..., ::-1]
+		
+		e[..., i] = d[..., i + taps - 1] - np.sum(x * w, axis=-1)
+		
+		norm = 1 / (np.sum(x * x, axis=-1, keepdims=True) + eps)
+		w = leakstep * w + mu * norm * x * e[..., i, np.newaxis]
+		
+		y[..., i] = np.sum(x * w, axis=-1)
+		
+		if returnCoeffs:
+			coeffs[..., i, :] = w
+	
+	if returnCoeffs:
+		w = coeffs
+	
+	return y, e, w
+
+
+def block_nlms(u,
+               d,
+               taps,
+               mu,
+               eps=0.001,
+               leak=0,
+               initCoeffs=None,
+               N=None,
+               returnCoeffs=False,
+               block_len=32):
+	""" normalised least mean squares, a block at a time, giving the same numbers as nlms
+	
+	Within a block every a priori output is the output of the weights at the start of
+	the block plus the updates made earlier in the block, and the update from sample j
+	reaches sample k through the dot product of their input windows R[k, j]. So with
+	c[j] = mu e[j] / (R[j, j] + eps) and L = 1 - mu * leak
+	
+		e[k] + sum_{j < k} L^(k - 1 - j) R[k, j] c[j] = d[k] - L^k (X w)[k]
+	
+	is a unit lower triangular system for the errors of the whole block. Solving it
+	takes a handful of matrix products instead of block_len trips round a python loop
+	
+	inputs:
+	block_len => samples per block, the solve is O(block_len**2) a sample so keep it small
+	the rest => see nlms
+	
+	return: y, e, w (w is (..., N, taps) if returnCoeffs)
+	side_effects: None
+	"""
+	
+	u, d, w, mu, leakstep, n = prepare(u, d, taps, mu, eps, leak, initCoeffs, N)
+	
+	y = np.zeros(w.shape[:-1] + (n, ))
+	e = np.zeros(w.shape[:-1] + (n, ))
+	
+	if returnCoeffs:
+		coeffs = np.zeros(w.shape[:-1] + (n, taps))
+	
+	# input windows, newest sample first like nlms
+	windows = np.lib.stride_tricks.sliding_window_view(u[..., :n + taps - 1], taps, axis=-1)[..., ::-1]
+	
+	# everything that only depends on where we are in the block, the last (short) block
+	# uses the top left corner
+	k, j = np.indices((block_len, block_len))
+	lower = k > j
+	leak_pow = np.power(leakstep[..., np.newaxis], np.where(lower, k - 1 - j, 0)) * lower
+	start_pow = np.power(leakstep, np.arange(block_len))
+	decay = np.power(leakstep, np.arange(block_len - 1, -1, -1))
+	ident = np.eye(block_len)
+	
+	for lo in range(0, n, block_len):
+		hi = min(lo + block_len, n)
+		length = hi - lo
+		
+		x = np.ascontiguousarray(windows[..., lo:hi, :])
+		
+		gram = np.matmul(x, np.swapaxes(x, -1, -2))
+		power = np.diagonal(gram, axis1=-2, axis2=-1)
+		
+		norm = (mu / (power + eps))[..., np.newaxis, :]
+		system = ident[:length, :length] + leak_pow[..., :length, :length] * gram * norm
+		start = start_pow[..., :length] * np.matmul(x, w[..., np.newaxis])[..., 0]
+		
+		desired = d[..., lo + taps - 1:hi + taps - 1]
+		e[..., lo:hi] = np.linalg.solve(system, (desired - start)[..., np.newaxis])[..., 0]
+		step = mu * e[..., lo:hi] / (power + eps)
+		
+		# y after each update, from the a priori output (d - e) and the update itself
+		y[..., lo:hi] = leakstep * (desired - e[..., lo:hi]) + step * power
+		
+		if returnCoeffs:
+			for i in range(length):
+				w = leakstep * w + step[..., i, np.newaxis] * x[..., i, :]
+				coeffs[..., lo + i, :] = w
+		
+		else:
+			scale = decay[..., block_len - length:] * step
+			w = np.power(leakstep, length) * w + np.matmul(scale[..., np.newaxis, :], x)[..., 0, :]
+	
+	if returnCoeffs:
+		w = coeffs
+	
+	return y, e, w
+
+
+def fdaf(u, d, taps, mu, eps=0.001, leak=0, initCoeffs=None, N=None, returnCoeffs=False, beta=0.9):
+	""" constrained (overlap-save) frequency domain adaptive filter with blocks of taps
+	samples. The block output is a convolution and the update a correlation, both done
+	as products of ffts of twice the taps, and the update is normalised per frequency
+	by a running average (beta) of the input power. That copes with coloured input
+	better than nlms, but it is one nlms sized step per block, so for the same mu it
+	adapts about taps times slower
+	
+	inputs:
+	beta => how much of the power estimate carries over between blocks
+	the rest => see nlms, returnCoeffs gives the weights in use after each sample
+	
+	return: y, e, w (w is (..., N, taps) if returnCoeffs)
+	side_effects: None
+	"""
+	
+	u, d, w, mu, leakstep, n = prepare(u, d, taps, mu, eps, leak, initCoeffs, N)
+	
+	y = np.zeros(w.shape[:-1] + (n, ))
+	e = np.zeros(w.shape[:-1] + (n, ))
+	
+	if returnCoeffs:
+		coeffs = np.zeros(w.shape[:-1] + (n, taps))
+	
+	n_fft = 2 * taps
+	power = None
+	
+	for lo in range(0, n, taps):
+		hi = min(lo + taps, n)
+		length = hi - lo
+		
+		spec = fft.rfft(u[..., lo:hi + taps - 1], n=n_fft, axis=-1)
+		
+		# |U|^2 * taps / n_fft is about the power of an nlms input window
+		block_power = (spec.real**2 + spec.imag**2) * (taps / n_fft)
+		if power is None:
+			power = block_power
+		else:
+			power = beta * power + (1 - beta) * block_power
+		
+		# overlap-save: the first taps - 1 outputs of the circular convolution are junk
+		out = fft.irfft(spec * fft.rfft(w, n=n_fft, axis=-1), n=n_fft, axis=-1)
+		e[..., lo:hi] = d[..., lo + taps - 1:hi + taps - 1] - out[..., taps - 1:taps - 1 + length]
+		
+		# correlation of the error with the input, keeping only the first taps lags
+		grad = fft.irfft(spec * np.conj(fft.rfft(e[..., lo:hi], n=n_fft, axis=-1)) / (power + eps),
+		                 n=n_fft,
+		                 axis=-1)
+		w = leakstep * w + (mu / length) * grad[..., taps - 1::-1]
+		
+		out = fft.irfft(spec * fft.rfft(w, n=n_fft, axis=-1), n=n_fft, axis=-1)
+		y[..., lo:hi] = out[..., taps - 1:taps - 1 + length]
+		
+		if returnCoeffs:
+			coeffs[..., lo:hi, :] = w[..., np.newaxis, :]
+	
+	if returnCoeffs:
+		w = coeffs
+	
+	return y, e, w
+
+
+# what noise_gate_adaptave.nlms_type picks from
+filters = {'sample': nlms, 'block': block_nlms, 'fdaf': fdaf}
@@ -0,0 +1,524 @@
+#! /usr/bin/env python3
+"""
+benchmarks for decompose, the gates and recompose on synthetic audio (tones, a chirp
+and pink noise) over a grid of lengths, sample rates, octave ranges and noteints,
+under each fft backend. Every stage is timed over a few repeats and run once more
+under tracemalloc for its peak memory (python & numpy allocations, on top of
+whatever the setup already holds). Results go to json, and --compare checks a run
+against a saved baseline
+
+	python benchmark.py --out bench.json
+	python benchmark.py --compare baseline.json bench.json
+
+the signals come from fixed seeds so the same grid always benchmarks the same audio
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import platform
+import tempfile
+import tracemalloc
+import argparse
+import itertools
+import numpy as np
+from scipy.io import wavfile
+import fft_wrapper as fft
+import math_fun
+import note_utils as note
+import note_decompose as nde
+import note_recompose as nre
+import note_store
+import noise_gate as ngate
+import noise_profile
+import stream_gate
+
+# bump this if the layout of the results changes
+results_version = 1
+
+default_grid = {
+    'signals': ['tones', 'chirp', 'pink'],
+    'seconds': [2, 8],
+    'sample_rates': [8000, 22050],
+    'octaves': [[2, 6], [2, 8]],
+    'noteints': [12]
+}
+
+quick_grid = {'signals': ['tones'], 'seconds': [1], 'sample_rates': [8000], 'octaves': [[2, 6]], 'noteints': [12]}
+
+stages = ['decompose', 'gate_sigma', 'gate_adaptave', 'gate_stream', 'recompose']
+
+
+def backends_available():
+	""" fft backends we can run here, see fft_wrapper """
+	
+	names = []
+	if fft.fft_ver == 'pyfftw':
+		names.append('pyfftw')
+	if fft.scipy is not None:
+		names.append('scipy')
+	names.append('numpy')
+	
+	return names
+
+
+# -------------------------------------------------------------------------------------------- #
+# test signals
+
+
+def pink_noise(n, sample_rate, rng):
+	""" n samples of pink noise, white noise shaped by math_fun.pink_power """
+	
+	spectrum = rng.standard_normal(n // 2 + 1) + 1j * rng.standard_normal(n // 2 + 1)
+	freqs = np.fft.rfftfreq(n, 1 / sample_rate)
+	
+	scale = np.zeros(len(freqs))
+	scale[1:] = np.sqrt(math_fun.pink_power(freqs[1:]))
+	
+	return np.fft.irfft(spectrum * scale, n)
+
+
+def make_signal(kind, seconds, sample_rate, octaves, seed=0):
+	""" synthetic audio to benchmark on
+	inputs:
+	kind => 'tones' (every 7th note of the octave range), 'chirp' (log sweep over
+	        the octave range) or 'pink' (pink noise)
+	seconds, sample_rate => how much audio
+	octaves => range the tones & chirp cover (capped below nyquist)
+	seed => for the noise
+	
+	return: float32 audio with a peak of 0.5, tones & chirp have a little pink noise in
+	side_effects: None
+	"""
+	
+	rng = np.random.default_rng(seed)
+	n = int(seconds * sample_rate) // 2 * 2
+	t = np.arange(n) / sample_rate
+	
+	f_lo = note.note2freq(octaves[0], 0)
+	f_hi = min(note.note2freq(octaves[1], 0), 0.45 * sample_rate)
+	
+	if kind == 'tones':
+		freqs = f_lo * 2**(np.arange(0, 12 * np.log2(f_hi / f_lo), 7) / 12)
+		data = np.sum([np.sin(2 * np.pi * f * t) for f in freqs], axis=0)
+	
+	elif kind == 'chirp':
+		rate = np.log(f_hi / f_lo) / t[-1]
+		data = np.sin(2 * np.pi * f_lo * np.expm1(rate * t) / rate)
+	
+	elif kind == 'pink':
+		data = pink_noise(n, sample_rate, rng)
+	
+	else:
+		raise Exception("No idea how to make a " + str(kind) + " signal")
+	
+	data = data / np.max(np.abs(data))
+	
+	if kind != 'pink':
+		noise = pink_noise(n, sample_rate, rng)
+		data = data + 0.05 * noise / np.max(np.abs(noise))
+	
+	return (0.5 * data / np.max(np.abs(data))).astype(np.float32)
+
+
+# -------------------------------------------------------------------------------------------- #
+# stages, each one does its setup and hands back what gets timed
+
+
+def make_decompose(case, filename):
+	""" a decompose with the params of a case """
+	
+	nde_class = nde.decompose(filename)
+	nde_class.octaves = tuple(case['octaves'])
+	nde_class.noteints = case['noteints']
+	
+	return nde_class
+
+
+def stage_decompose(case):
+	""" read the audio and decompose it (savetype 0) """
+	
+	def run():
+		make_decompose(case, case['wav']).decompose(os.path.join(case['dir'], 'decompose'), 0)
+	
+	return run
+
+
+def stage_gate_sigma(case):
+	""" noise_gate_sigma over every note """
+	
+	gate = ngate.noise_gate_sigma(case['bg'], tuple(case['octaves']), noteints=case['noteints'])
+	
+	def run():
+		for key, data in zip(case['keys'], case['notes']):
+			gate.noise_gate_sigma(data, key, 5, spread=1000)
+	
+	return run
+
+
+def adaptave_gate(case):
+	""" a noise_gate_adaptave for a case. The nlms needs at least taps envelope samples,
+	so short cases get a shorter spread than the usual 1000 """
+	
+	gate = ngate.noise_gate_adaptave(case['bg'], tuple(case['octaves']), noteints=case['noteints'])
+	gate.spread = case['spread']
+	gate.noise_profile()
+	
+	return gate
+
+
+def stage_gate_adaptave(case):
+	""" noise_gate_adaptave over every note, a block at a time """
+	
+	gate = adaptave_gate(case)
+	batch_size = nde.decompose(None).batch_size
+	
+	def run():
+		for i in range(0, len(case['keys']), batch_size):
+			gate.noise_gate_block(case['notes'][i:i + batch_size], case['keys'][i:i + batch_size])
+	
+	return run
+
+
+def stage_gate_stream(case):
+	""" the whole file through stream_gate a block at a time """
+	
+	gate = adaptave_gate(case)
+	
+	nde_class = nde.decompose(None)
+	nde_class.octaves = tuple(case['octaves'])
+	nde_class.noteints = case['noteints']
+	nde_class.sample_rate = case['sample_rate']
+	
+	processor = stream_gate.stream_gate(nde_class, gate)
+	
+	def run():
+		processor.reset()
+		case['extra']['gate_stream'] = stream_gate.run(processor, stream_gate.wav_source(case['wav'],
+		                                                                                    processor.block_len))
+	
+	return run
+
+
+def stage_recompose(case):
+	""" recompose the decomposition to a wav """
+	
+	def run():
+		nre.recompose(case['notes_file'], os.path.join(case['dir'], 'recomposed.wav'))
+	
+	return run
+
+
+stage_functions = {
+    'decompose': stage_decompose,
+    'gate_sigma': stage_gate_sigma,
+    'gate_adaptave': stage_gate_adaptave,
+    'gate_stream': stage_gate_stream,
+    'recompose': stage_recompose
+}
+
+
+# -------------------------------------------------------------------------------------------- #
+# running
+
+
+def case_name(signal, seconds, sample_rate, octaves, noteints):
+	""" id of a point on the grid, what results get matched on """
+	return '%s-%gs-%dHz-oct%d-%d-n%d' % (signal, seconds, sample_rate, octaves[0], octaves[1], noteints)
+
+
+def prepare_case(directory, signal, seconds, sample_rate, octaves, noteints, seed):
+	""" write the audio for a case and decompose it once for the stages that need notes
+	
+	return: dict describing the case
+	side_effects: writes files in directory
+	"""
+	
+	case = {
+	    'name': case_name(signal, seconds, sample_rate, octaves, noteints),
+	    'signal': signal,
+	    'seconds': seconds,
+	    'sample_rate': sample_rate,
+	    'octaves': list(octaves),
+	    'noteints': noteints,
+	    'dir': directory,
+	    'wav': os.path.join(directory, 'signal.wav'),
+	    'bg': os.path.join(directory, 'background.wav'),
+	    'notes_file': os.path.join(directory, 'notes'),
+	    'extra': {}
+	}
+	
+	wavfile.write(case['wav'], sample_rate, make_signal(signal, seconds, sample_rate, octaves, seed))
+	wavfile.write(case['bg'], sample_rate, make_signal('pink', seconds, sample_rate, octaves, seed + 1))
+	
+	nde_class = make_decompose(case, case['wav'])
+	nde_class.decompose(case['notes_file'], 0)
+	
+	taps = ngate.noise_gate_adaptave(case['bg'], tuple(octaves)).taps
+	case['spread'] = int(max(min(1000, nde_class.file_len // (4 * taps)), 1))
+	
+	with note_store.note_reader(case['notes_file']) as fp:
+		case['keys'] = fp.keys()
+		case['notes'] = fp.read_rows(0, len(fp))
+	
+	return case
+
+
+def measure(run, repeats):
+	""" time a stage, then run it once more for its peak memory
+	
+	return: (list of seconds per repeat, peak bytes allocated)
+	side_effects: whatever run does
+	"""
+	
+	times = []
+	for i in range(repeats):
+		start = time.perf_counter()
+		run()
+		times.append(time.perf_counter() - start)
+	
+	tracemalloc.start()
+	try:
+		run()
+		peak = tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+	
+	return times, peak
+
+
+def run_suite(grid=None, backends=None, stage_names=None, repeats=3, seed=0):
+	""" benchmark every stage at every point on the grid under every backend
+	inputs:
+	grid => dict like default_grid, None => default_grid
+	backends => fft backends to use, None => every one we have (see backends_available)
+	stage_names => stages to run, None => all of them
+	repeats => timed runs of each stage
+	seed => for the signals
+	
+	return: results dict, ready for json
+	side_effects: writes (and removes) a scratch directory of audio, decompositions &
+	              background profiles (so they stay out of the real noise_profile cache)
+	"""
+	
+	if grid is None:
+		grid = default_grid
+	
+	if backends is None:
+		backends = backends_available()
+	
+	if stage_names is None:
+		stage_names = stages
+	
+	results = {
+	    'format': 'benchmark',
+	    'version': results_version,
+	    'meta': {
+	        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+	        'python': platform.python_version(),
+	        'numpy': np.__version__,
+	        'platform': platform.platform(),
+	        'cpu_count': os.cpu_count(),
+	        'fftw_wisdom': fft.wisdom_loaded,
+	        'grid': grid,
+	        'backends': list(backends),
+	        'stages': list(stage_names),
+	        'repeats': repeats,
+	        'seed': seed
+	    },
+	    'results': []
+	}
+	
+	old_backend = fft.backend
+	directory = tempfile.mkdtemp(prefix='benchmark-')
+	
+	old_profiles = noise_profile.cache.directory
+	noise_profile.cache.directory = os.path.join(directory, 'noise_profiles')
+	
+	try:
+		for signal, seconds, sample_rate, octaves, noteints in itertools.product(
+		        grid['signals'], grid['seconds'], grid['sample_rates'], grid['octaves'], grid['noteints']):
+			
+			for backend in backends:
+				# a fresh backend so every case starts with an empty plan cache. The fftw
+				# wisdom loaded at import still applies (see meta fftw_wisdom), so pyfftw
+				# plans it covers are quick to make
+				fft.backend = fft.fft_backend(backend)
+				
+				case_dir = tempfile.mkdtemp(dir=directory)
+				case = prepare_case(case_dir, signal, seconds, sample_rate, octaves, noteints, seed)
+				
+				for stage in stage_names:
+					times, peak = measure(stage_functions[stage](case), repeats)
+					
+					result = {
+					    'case': case['name'],
+					    'backend': backend,
+					    'stage': stage,
+					    'params': {k: case[k]
+					               for k in ('signal', 'seconds', 'sample_rate', 'octaves', 'noteints', 'spread')},
+					    'times': times,
+					    'min': min(times),
+					    'median': float(np.median(times)),
+					    'peak_bytes': peak
+					}
+					
+					if stage in case['extra']:
+						result['extra'] = case['extra'][stage]
+					
+					results['results'].append(result)
+					print("%-40s %-7s %-14s %8.4f s %10d bytes" % (case['name'], backend, stage, min(times), peak))
+				
+				shutil.rmtree(case_dir)
+	
+	finally:
+		fft.backend = old_backend
+		noise_profile.cache.directory = old_profiles
+		shutil.rmtree(directory, ignore_errors=True)
+	
+	return results
+
+
+# -------------------------------------------------------------------------------------------- #
+# comparing
+
+
+def compare(baseline, current, time_tolerance=0.1, memory_tolerance=0.1, min_seconds=0.005):
+	""" check a set of results against a baseline
+	inputs:
+	baseline, current => results dicts (see run_suite)
+	time_tolerance => fraction slower (on the best time) before it counts as a regression
+	memory_tolerance => fraction more peak memory before it counts as a regression
+	min_seconds => ignore time changes smaller than this, they are just noise
+	
+	return: list of dicts of case, backend, stage, status ('regression', 'improvement',
+	        'ok', 'new' or 'missing'), the baseline & current best times and peak memory
+	        and what regressed
+	side_effects: None
+	"""
+	
+	def index(results):
+		return {(r['case'], r['backend'], r['stage']): r for r in results['results']}
+	
+	old = index(baseline)
+	new = index(current)
+	
+	rows = []
+	for key in sorted(set(old) | set(new)):
+		row = {'case': key[0], 'backend': key[1], 'stage': key[2], 'regressed': []}
+		
+		if key not in new:
+			row['status'] = 'missing'
+		
+		elif key not in old:
+			row['status'] = 'new'
+		
+		else:
+			a, b = old[key], new[key]
+			row.update({'time_old': a['min'], 'time_new': b['min'], 'bytes_old': a['peak_bytes'],
+			            'bytes_new': b['peak_bytes']})
+			
+			time_change = b['min'] - a['min']
+			if time_change > time_tolerance * a['min'] and time_change > min_seconds:
+				row['regressed'].append('time')
+			
+			if b['peak_bytes'] > (1 + memory_tolerance) * a['peak_bytes']:
+				row['regressed'].append('memory')
+			
+			if row['regressed']:
+				row['status'] = 'regression'
+			elif -time_change > time_tolerance * a['min'] and -time_change > min_seconds:
+				row['status'] = 'improvement'
+			else:
+				row['status'] = 'ok'
+		
+		rows.append(row)
+	
+	return rows
+
+
+def print_comparison(rows):
+	""" print the rows compare made, worst first """
+	
+	order = {'regression': 0, 'missing': 1, 'new': 2, 'improvement': 3, 'ok': 4}
+	
+	for row in sorted(rows, key=lambda r: order[r['status']]):
+		if 'time_old' in row:
+			detail = "time %.4f -> %.4f s (%+.0f%%)  memory %d -> %d bytes" % (
+			    row['time_old'], row['time_new'], 100 * (row['time_new'] / row['time_old'] - 1),
+			    row['bytes_old'], row['bytes_new'])
+		else:
+			detail = ''
+		
+		print("%-12s %-40s %-7s %-14s %s %s" % (row['status'].upper(), row['case'], row['backend'], row['stage'],
+		                                        detail, ','.join(row['regressed'])))
+	
+	return
+
+
+def load(filename):
+	""" read a results file """
+	
+	with open(filename) as fp:
+		results = json.load(fp)
+	
+	if results.get('format') != 'benchmark' or results.get('version') != results_version:
+		raise Exception(filename + " isnt a version %d benchmark results file" % results_version)
+	
+	return results
+
+
+def main(argv=None):
+	""" for use on the command line, returns the exit code """
+	
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--out', default='benchmark.json', help="where to write the results")
+	parser.add_argument('--quick', action='store_true', help="a tiny grid, to check everything runs")
+	parser.add_argument('--signals', nargs='+', choices=['tones', 'chirp', 'pink'])
+	parser.add_argument('--seconds', nargs='+', type=float)
+	parser.add_argument('--sample-rates', nargs='+', type=int)
+	parser.add_argument('--octaves', nargs='+', help="ranges like 2-6")
+	parser.add_argument('--noteints', nargs='+', type=int)
+	parser.add_argument('--backends', nargs='+', choices=backends_available())
+	parser.add_argument('--stages', nargs='+', choices=stages)
+	parser.add_argument('--repeats', type=int, default=3)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--baseline', help="compare the new results against this results file")
+	parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'), help="just compare two results files")
+	parser.add_argument('--time-tolerance', type=float, default=0.1)
+	parser.add_argument('--memory-tolerance', type=float, default=0.1)
+	args = parser.parse_args(argv)
+	
+	if args.compare is not None:
+		baseline, current = [load(f) for f in args.compare]
+	
+	else:
+		grid = dict(quick_grid if args.quick else default_grid)
+		for name in ('signals', 'seconds', 'noteints'):
+			if getattr(args, name) is not None:
+				grid[name] = getattr(args, name)
+		if args.sample_rates is not None:
+			grid['sample_rates'] = args.sample_rates
+		if args.octaves is not None:
+			grid['octaves'] = [[int(i) for i in octaves.split('-')] for octaves in args.octaves]
+		
+		current = run_suite(grid, args.backends, args.stages, args.repeats, args.seed)
+		
+		with open(args.out, 'w') as fp:
+			json.dump(current, fp, indent=1)
+		
+		if args.baseline is None:
+			return 0
+		
+		baseline = load(args.baseline)
+	
+	rows = compare(baseline, current, args.time_tolerance, args.memory_tolerance)
+	print_comparison(rows)
+	
+	return 1 if any(row['status'] == 'regression' for row in rows) else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
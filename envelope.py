@@ -0,0 +1,180 @@
+#! /usr/bin/env python3
+"""
+volume envelopes of audio, worked out along the last axis and returned at their
+natural decimated rate: envelope sample k covers the window centred on audio sample
+k * spread + (spread - 1) / 2. apply_gain interpolates a gain at that rate back up
+to the audio, so nothing full length gets built apart from the output
+"""
+
+import numpy as np
+import scipy.ndimage as ndimage
+
+
+def block_envelope(data, spread, detect_type='peak'):
+	""" envelope over non-overlapping blocks of spread samples (the last block is
+	zero padded), the same numbers wave2vol has always made but without the copies
+	
+	inputs:
+	data => audio, envelope is along the last axis
+	spread => block length
+	detect_type => 'peak' or 'rms'
+	
+	return: envelope with ceil(n / spread) samples along the last axis
+	side_effects: None
+	"""
+	
+	data = np.asarray(data)
+	n_full = data.shape[-1] // spread
+	
+	# view the whole blocks as (..., n_full, spread) without copying
+	body = data[..., :n_full * spread].reshape(data.shape[:-1] + (n_full, spread))
+	tail = data[..., n_full * spread:]
+	
+	if detect_type == 'peak':
+		if n_full > 0:
+			volume = np.maximum(np.max(body, axis=-1), -np.min(body, axis=-1))
+		else:
+			volume = np.zeros(data.shape[:-1] + (0, ))
+		
+		if tail.shape[-1] > 0:
+			volume = np.concatenate((volume, np.max(np.abs(tail), axis=-1, keepdims=True)), axis=-1)
+	
+	elif detect_type == 'rms':
+		volume = np.sqrt(np.einsum('...ij,...ij->...i', body, body) / spread)
+		
+		if tail.shape[-1] > 0:
+			tail_volume = np.sqrt(np.einsum('...i,...i->...', tail, tail) / spread)
+			volume = np.concatenate((volume, tail_volume[..., np.newaxis]), axis=-1)
+	
+	else:
+		raise Exception("only peak and rms detection types are defined so far")
+	
+	return volume
+
+
+def sliding_peak(data, window, spread):
+	""" true sliding window peak, sampled every spread samples. maximum_filter1d runs
+	the monotonic queue (ascending minima) algorithm so this is O(n) whatever the window
+	
+	inputs:
+	data => audio, envelope is along the last axis
+	window => window length
+	spread => distance between envelope samples
+	
+	return: envelope with ceil(n / spread) samples along the last axis
+	side_effects: None
+	"""
+	
+	data = np.asarray(data)
+	n_env = int(np.ceil(data.shape[-1] / spread))
+	
+	peak = ndimage.maximum_filter1d(np.abs(data), window, axis=-1, mode='constant', cval=0)
+	
+	# the filter is centred on each sample, so pick out the block centres
+	return peak[..., spread // 2::spread][..., :n_env]
+
+
+def sliding_rms(data, window, spread):
+	""" true sliding window rms (samples off either end count as 0), sampled every
+	spread samples, from a running sum of squares so it is O(n) whatever the window
+	
+	inputs:
+	data => audio, envelope is along the last axis
+	window => window length
+	spread => distance between envelope samples
+	
+	return: envelope with ceil(n / spread) samples along the last axis
+	side_effects: None
+	"""
+	
+	data = np.asarray(data)
+	n = data.shape[-1]
+	n_env = int(np.ceil(n / spread))
+	
+	power = np.zeros(data.shape[:-1] + (n + 1, ))
+	np.cumsum(data * data, axis=-1, out=power[..., 1:])
+	
+	lo = np.arange(n_env) * spread + spread // 2 - window // 2
+	hi = np.clip(lo + window, 0, n)
+	lo = np.clip(lo, 0, n)
+	
+	# rounding in the running sum can leave tiny negatives
+	return np.sqrt(np.maximum(power[..., hi] - power[..., lo], 0) / window)
+
+
+def envelope(data, spread, detect_type='peak', window=None):
+	""" volume envelope at the decimated rate
+	
+	inputs:
+	data => audio, envelope is along the last axis
+	spread => distance between envelope samples
+	detect_type => 'peak' or 'rms'
+	window => window length, None => spread (non-overlapping blocks)
+	
+	return: envelope with ceil(n / spread) samples along the last axis
+	side_effects: None
+	"""
+	
+	if window is None or window == spread:
+		return block_envelope(data, spread, detect_type)
+	
+	if detect_type == 'peak':
+		return sliding_peak(data, window, spread)
+	
+	elif detect_type == 'rms':
+		return sliding_rms(data, window, spread)
+	
+	else:
+		raise Exception("only peak and rms detection types are defined so far")
+
+
+def hold(env, spread, n):
+	""" blow an envelope back up to n samples by repeating each value spread times """
+	return np.repeat(env, spread, axis=-1)[..., :n]
+
+
+def apply_gain(data, gain, spread, block_len=2**16):
+	""" multiply audio by a gain that is at the envelope rate, linearly interpolating
+	between envelope samples (and holding before the first / after the last). Done a
+	block at a time so there is never a full length gain array
+	
+	inputs:
+	data => audio, along the last axis
+	gain => gain at the envelope rate (leading axes broadcast against data)
+	spread => distance between envelope samples
+	block_len => samples to work on at once
+	
+	return: gained audio, in the precision of data if that is floating point
+	side_effects: None
+	"""
+	
+	data = np.asarray(data)
+	
+	if np.issubdtype(data.dtype, np.floating):
+		dtype = data.dtype
+	else:
+		dtype = np.result_type(data, gain)
+	
+	gain = np.asarray(gain, dtype=dtype)
+	
+	n = data.shape[-1]
+	n_env = gain.shape[-1]
+	
+	out = np.empty(np.broadcast_shapes(data.shape[:-1], gain.shape[:-1]) + (n, ), dtype=dtype)
+	
+	for lo in range(0, n, block_len):
+		hi = min(lo + block_len, n)
+		
+		# where each sample sits between the envelope samples
+		pos = np.clip((np.arange(lo, hi) - (spread - 1) / 2) / spread, 0, n_env - 1)
+		k = np.minimum(pos.astype(int), max(n_env - 2, 0))
+		frac = (pos - k).astype(dtype, copy=False)
+		
+		if n_env > 1:
+			g = gain[..., k] * (1 - frac) + gain[..., k + 1] * frac
+		else:
+			g = gain[..., k]
+		
+		out[..., lo:hi] = data[..., lo:hi] * g
+	
+	return out
@@ -1,71 +1,490 @@
 #! /usr/bin/env python3
 """
 Because some people in windows are having trouble installing pyfftw, 
-fall back to numpy (or another fft program if you want to use that here)
+fall back to scipy or numpy (or another fft program if you want to use that here)
 """
 
 # select what fft we are going to use
 
 import numpy
+import os
+import struct
+import atexit
+import instrument
+try:
+	import scipy.fft
+except:
+	scipy = None
+
 try:
 	import pyfftw
 	fft_ver = 'pyfftw'
 except:
-	print("falling back to numpy")
-	fft_ver = 'numpy'
+	if scipy is not None:
+		print("falling back to scipy")
+		fft_ver = 'scipy'
+	else:
+		print("falling back to numpy")
+		fft_ver = 'numpy'
+
+
+# -------------------------------------------------------------------------------------------- #
+
+
+# names for the precisions everything else can work in
+precisions = {'single': numpy.float32, 'double': numpy.float64}
+
+
+def precision_dtype(precision):
+	""" the real dtype for a precision, 'single' or 'double' """
+	
+	if precision not in precisions:
+		raise Exception("precision must be 'single' or 'double', not " + str(precision))
+	
+	return numpy.dtype(precisions[precision])
+
+
+def real_dtype(dtype):
+	""" the real dtype an fft of this dtype works in (single stays single) """
+	if numpy.dtype(dtype) in (numpy.float32, numpy.complex64):
+		return numpy.dtype(numpy.float32)
+	return numpy.dtype(numpy.float64)
 
 
-def fft_interface_select():
-	""" return the interface class for the fft """
+def complex_dtype(dtype):
+	""" the complex dtype an fft of this dtype works in (single stays single) """
+	if numpy.dtype(dtype) in (numpy.float32, numpy.complex64):
+		return numpy.dtype(numpy.complex64)
+	return numpy.dtype(numpy.complex128)
+
+
+def fit_axis(dest, data, axis):
+	""" copy data into dest along axis, truncating or zero padding it to fit
+	(this is what the n argument to numpy.fft does) """
 	
-	if fft_ver == 'pyfftw':
-		return pyfftw.interfaces.numpy_fft
+	n = min(dest.shape[axis], data.shape[axis])
 	
-	elif fft_ver == 'numpy':
-		return numpy.fft
+	index = [slice(None)] * data.ndim
+	index[axis] = slice(0, n)
+	dest[tuple(index)] = data[tuple(index)]
 	
-	else:
-		raise Exception("Dont know this fft type")
+	if n < dest.shape[axis]:
+		index[axis] = slice(n, None)
+		dest[tuple(index)] = 0
+	
+	return dest
 
 
-def fft_interface_format(fft_method, data, **kargs):
-	""" run the fft /ifft over data using kargs """
-	if fft_ver == 'pyfftw':
-		#pyfftw accepts a superset of numpy
-		return fft_method(data, **kargs)
+class fft_backend:
+	""" stateful fft, holds on to the fftw plans (and their aligned buffers) so each
+	transform shape only gets planned once. Plans are keyed on
+	(direction, shape, dtype, axis, threads). scipy and numpy dont plan, so for them
+	this is just a thin wrapper """
+	
+	def __init__(self, ver=None):
+		
+		self.ver = fft_ver if ver is None else ver
+		
+		# estimate plans cost next to nothing to make, so the wisdom saved from them barely
+		# saves anything. warmup plans with measure, and wisdom from that gets used by the
+		# estimate plans after it (fftw takes wisdom from an equal or harder planner)
+		self.planner_effort = 'FFTW_ESTIMATE'
+		
+		# (direction, shape, dtype, axis, threads) => pyfftw.FFTW
+		self.plans = {}
+		
+		# (direction, shape, dtype, axis, threads) => True if it was planned from wisdom
+		self.wisdom_hits = {}
+		
+		return
+	
+	def clear(self):
+		""" forget every plan, and free the buffers that go with them """
+		self.plans = {}
+		self.wisdom_hits = {}
+		return
+	
+	def wisdom_report(self):
+		""" which of the plans we made came out of the wisdom cache
+		
+		return: {'hits': n, 'misses': n, 'plans': {key: True if hit}}
+		side_effects: None
+		"""
+		hits = sum(self.wisdom_hits.values())
+		return {'hits': hits, 'misses': len(self.wisdom_hits) - hits, 'plans': dict(self.wisdom_hits)}
+	
+	def shapes(self, direction, data, n, axis):
+		""" work out the input & output shape and dtype of a transform
+		inputs:
+		direction => 'fft', 'ifft', 'rfft' or 'irfft'
+		data => the data we are going to transform
+		n, axis => as numpy.fft
+		
+		return: (in_shape, in_dtype, out_shape, out_dtype)
+		side_effects: None
+		"""
+		
+		in_shape = list(data.shape)
+		out_shape = list(data.shape)
+		
+		if direction == 'irfft':
+			n_out = 2 * (data.shape[axis] - 1) if n is None else n
+			in_shape[axis] = n_out // 2 + 1
+			out_shape[axis] = n_out
+			in_dtype = complex_dtype(data.dtype)
+			out_dtype = real_dtype(data.dtype)
+		
+		elif direction == 'rfft':
+			n_in = data.shape[axis] if n is None else n
+			in_shape[axis] = n_in
+			out_shape[axis] = n_in // 2 + 1
+			in_dtype = real_dtype(data.dtype)
+			out_dtype = complex_dtype(data.dtype)
+		
+		elif direction in ('fft', 'ifft'):
+			n_in = data.shape[axis] if n is None else n
+			in_shape[axis] = n_in
+			out_shape[axis] = n_in
+			in_dtype = complex_dtype(data.dtype)
+			out_dtype = in_dtype
+		
+		else:
+			raise Exception("Dont know this fft direction " + str(direction))
+		
+		return tuple(in_shape), in_dtype, tuple(out_shape), out_dtype
+	
+	def plan_key(self, direction, data, n, axis, threads):
+		""" the key self.plans uses for this transform """
+		in_shape, in_dtype = self.shapes(direction, data, n, axis)[:2]
+		return (direction, in_shape, in_dtype.str, axis, threads)
+	
+	def plan(self, direction, data, n, axis, threads):
+		""" get the (cached) fftw plan for this transform, planning it if we have to """
+		
+		in_shape, in_dtype, out_shape, out_dtype = self.shapes(direction, data, n, axis)
+		key = self.plan_key(direction, data, n, axis, threads)
+		
+		try:
+			return self.plans[key]
+		except KeyError:
+			pass
+		
+		in_array = pyfftw.empty_aligned(in_shape, dtype=in_dtype)
+		out_array = pyfftw.empty_aligned(out_shape, dtype=out_dtype)
+		
+		if direction in ('fft', 'rfft'):
+			fftw_direction = 'FFTW_FORWARD'
+		else:
+			fftw_direction = 'FFTW_BACKWARD'
+		
+		# the input buffer is ours, so fftw is free to scribble on it
+		flags = (self.planner_effort, 'FFTW_DESTROY_INPUT')
+		
+		try:
+			# only works if the wisdom we have already covers this transform
+			plan = pyfftw.FFTW(in_array,
+			                   out_array,
+			                   axes=(axis, ),
+			                   direction=fftw_direction,
+			                   flags=flags + ('FFTW_WISDOM_ONLY', ),
+			                   threads=threads)
+			self.wisdom_hits[key] = True
+		
+		except RuntimeError:
+			# cold start, plan from scratch
+			plan = pyfftw.FFTW(in_array,
+			                   out_array,
+			                   axes=(axis, ),
+			                   direction=fftw_direction,
+			                   flags=flags,
+			                   threads=threads)
+			self.wisdom_hits[key] = False
+		
+		self.plans[key] = plan
+		
+		return plan
+	
+	def transform(self, direction, data, n=None, axis=-1, threads=1, out=None, **kargs):
+		""" run a transform
+		inputs:
+		direction => 'fft', 'ifft', 'rfft' or 'irfft'
+		data => the data we want to transform, this is never modified
+		n, axis => as numpy.fft
+		threads => threads to use (pyfftw & scipy)
+		out => optional array to write the result into. With pyfftw an out that is
+		       aligned and exactly the shape, dtype & layout of the plans output is
+		       written into by fftw directly, anything else gets the result copied in
+		kargs => anything else the old interface took (eg overwrite_input) is ignored
+		
+		return: the transformed data (out if it was given), otherwise with pyfftw a copy
+		        of the plans output buffer, as the next transform reuses it
+		side_effects: may add a plan to self.plans
+		"""
+		
+		data = numpy.asarray(data)
+		axis = axis % data.ndim
+		
+		with instrument.span(direction, 'fft', shape=data.shape, backend=self.ver):
+			result = self.run(direction, data, n, axis, threads, out)
+		
+		if out is not None:
+			if result is not out:
+				numpy.copyto(out, result, casting='same_kind')
+			return out
+		
+		if self.ver == 'pyfftw':
+			# the plans output buffer gets reused by the next call
+			return result.copy()
+		
+		return result
 	
-	elif fft_ver == 'numpy':
-		# select only the args that are compatible with numpy
-		new_kargs = {}
-		for i in ('n', 'a', 'axis', 'norm'):
-			try:
-				new_kargs[i] = kargs[i]
-			except KeyError:
-				# the arg wasnt passed in the first place
-				pass
+	def run(self, direction, data, n, axis, threads, out=None):
+		""" the transform itself, see transform. pyfftw hands back its output buffer, or
+		out if fftw could write straight into it """
+		
+		if self.ver == 'pyfftw':
+			plan = self.plan(direction, data, n, axis, threads)
+			fit_axis(plan.input_array, data, axis)
+			
+			buffer = plan.output_array
+			if (out is not None and out.shape == buffer.shape and out.dtype == buffer.dtype and
+			    out.strides == buffer.strides and pyfftw.is_byte_aligned(out, plan.output_alignment)):
+				result = plan(output_array=out)
+				
+				# the plan holds on to whatever it last wrote to, give it its own buffer back
+				plan.update_arrays(plan.input_array, buffer)
+			
+			else:
+				result = plan()
+		
+		elif self.ver == 'scipy':
+			result = getattr(scipy.fft, direction)(data, n=n, axis=axis, workers=threads)
+		
+		elif self.ver == 'numpy':
+			# older numpys do everything in double
+			result = getattr(numpy.fft, direction)(data, n=n, axis=axis)
+			result = result.astype(self.shapes(direction, data, n, axis)[3], copy=False)
 		
-		return fft_method(data, **new_kargs)
+		else:
+			raise Exception("Dont know this fft type")
+		
+		return result
+	
+	def fft(self, data, **kargs):
+		""" fft """
+		return self.transform('fft', data, **kargs)
+	
+	def ifft(self, data, **kargs):
+		""" ifft """
+		return self.transform('ifft', data, **kargs)
+	
+	def rfft(self, data, **kargs):
+		""" rfft """
+		return self.transform('rfft', data, **kargs)
+	
+	def irfft(self, data, **kargs):
+		""" irfft """
+		return self.transform('irfft', data, **kargs)
+
+
+# everything in the project shares this one, so plans get reused between modules
+backend = fft_backend()
 
 
 def fft(data, **kargs):
 	""" fft wrapper """
-	interface = fft_interface_select()
-	return fft_interface_format(interface.fft, data, **kargs)
+	return backend.fft(data, **kargs)
 
 
 def ifft(data, **kargs):
 	""" ifft wrapper """
-	interface = fft_interface_select()
-	return fft_interface_format(interface.ifft, data, **kargs)
+	return backend.ifft(data, **kargs)
 
 
 def rfft(data, **kargs):
 	""" rfft wrapper """
-	interface = fft_interface_select()
-	return fft_interface_format(interface.rfft, data, **kargs)
+	return backend.rfft(data, **kargs)
 
 
 def irfft(data, **kargs):
 	""" irfft wrapper """
-	interface = fft_interface_select()
-	return fft_interface_format(interface.irfft, data, **kargs)
+	return backend.irfft(data, **kargs)
+
+
+# -------------------------------------------------------------------------------------------- #
+# fftw wisdom, so that short jobs dont have to pay for planning every time they start up
+
+# bump this if the way we store wisdom changes
+wisdom_version = 2
+
+# the wisdom file is this, then each of the (double, single, long double) wisdom strings
+# pyfftw.export_wisdom gives as a little endian uint64 length and the raw bytes. The
+# cache directory is shared, so it is plain bytes rather than a pickle
+wisdom_header = b'threezerozeroeight fftw wisdom %d\n' % wisdom_version
+
+
+def wisdom_path():
+	""" where the wisdom lives, versioned on our format and the pyfftw build """
+	cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+	return os.path.join(cache_dir, 'threezerozeroeight',
+	                    'fftw_wisdom-v%d-%s.wisdom' % (wisdom_version, pyfftw.__version__))
+
+
+def pack_wisdom(wisdom):
+	""" a tuple of wisdom bytes as the wisdom file holds them """
+	return wisdom_header + b''.join(struct.pack('<Q', len(part)) + part for part in wisdom)
+
+
+def unpack_wisdom(raw):
+	""" the tuple of wisdom bytes in a wisdom file, see pack_wisdom
+	
+	return: tuple of bytes, None if raw isnt a wisdom file we wrote
+	side_effects: None
+	"""
+	
+	if not raw.startswith(wisdom_header):
+		return None
+	
+	wisdom = []
+	offset = len(wisdom_header)
+	
+	while offset < len(raw):
+		if offset + 8 > len(raw):
+			return None
+		
+		length, = struct.unpack_from('<Q', raw, offset)
+		offset += 8
+		
+		if offset + length > len(raw):
+			return None
+		
+		wisdom.append(raw[offset:offset + length])
+		offset += length
+	
+	return tuple(wisdom)
+
+
+def load_wisdom(path=None):
+	""" import fftw wisdom from disk
+	inputs:
+	path => wisdom file, defaults to wisdom_path()
+	
+	return: True if any wisdom was imported
+	side_effects: adds to the fftw wisdom of this process
+	"""
+	
+	if fft_ver != 'pyfftw':
+		return False
+	
+	if path is None:
+		path = wisdom_path()
+	
+	try:
+		with open(path, 'rb') as fp:
+			wisdom = unpack_wisdom(fp.read())
+	except OSError:
+		# no cache yet, just plan from scratch
+		return False
+	
+	if wisdom is None:
+		# a broken or foreign file, plan from scratch (it gets replaced on the next save)
+		return False
+	
+	try:
+		return any(pyfftw.import_wisdom(wisdom))
+	except Exception:
+		return False
+
+
+def save_wisdom(path=None):
+	""" export all the fftw wisdom of this process to disk. The file is swapped in
+	atomically so concurrent jobs cant leave a half written cache behind
+	
+	inputs:
+	path => wisdom file, defaults to wisdom_path()
+	
+	return: None
+	side_effects: writes the wisdom file
+	"""
+	
+	if fft_ver != 'pyfftw':
+		return
+	
+	if path is None:
+		path = wisdom_path()
+	
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	
+	tmp_path = path + '.%d.tmp' % os.getpid()
+	with open(tmp_path, 'wb') as fp:
+		fp.write(pack_wisdom(pyfftw.export_wisdom()))
+	os.replace(tmp_path, path)
+	
+	return
+
+
+def warmup(sizes, directions=('rfft', 'irfft'), dtype=numpy.float64, threads=1, planner_effort='FFTW_MEASURE'):
+	""" plan the transforms we know we are going to use and save the wisdom, so the next
+	run starts warm. This is where saved wisdom pays off, planning with measure once
+	so every later run gets measured plans for the price of estimated ones (a transform
+	this process already has a plan for isnt planned again)
+	
+	inputs:
+	sizes => real data lengths (or shapes, transforms are over the last axis)
+	directions => which transforms to plan
+	dtype => real dtype of the data
+	threads => threads the transforms will be run with
+	planner_effort => fftw planner flag to plan with, None => backend.planner_effort
+	
+	return: backend.wisdom_report() for the plans made here
+	side_effects: plans are cached in backend and the wisdom file is updated
+	"""
+	
+	old_effort = backend.planner_effort
+	if planner_effort is not None:
+		backend.planner_effort = planner_effort
+	
+	keys = []
+	try:
+		for size in sizes:
+			shape = tuple(numpy.atleast_1d(size))
+			for direction in directions:
+				
+				if direction == 'irfft':
+					data = numpy.zeros(shape[:-1] + (shape[-1] // 2 + 1, ), dtype=complex_dtype(dtype))
+					n = shape[-1]
+				else:
+					data = numpy.zeros(shape, dtype=dtype)
+					n = None
+				
+				if fft_ver == 'pyfftw':
+					backend.plan(direction, data, n, data.ndim - 1, threads)
+					keys.append(backend.plan_key(direction, data, n, data.ndim - 1, threads))
+	
+	finally:
+		# a failed plan (a bad size or flag say) mustnt change the effort for everyone after
+		backend.planner_effort = old_effort
+	
+	save_wisdom()
+	
+	report = backend.wisdom_report()
+	report['plans'] = {key: report['plans'][key] for key in keys}
+	report['hits'] = sum(report['plans'].values())
+	report['misses'] = len(report['plans']) - report['hits']
+	
+	return report
+
+
+def save_new_wisdom():
+	""" on the way out, save the wisdom if we had to plan anything from scratch """
+	if fft_ver == 'pyfftw' and not all(backend.wisdom_hits.values()):
+		try:
+			save_wisdom()
+		except OSError:
+			pass
+	return
+
+
+# start warm if we can
+wisdom_loaded = load_wisdom()
+atexit.register(save_new_wisdom)
@@ -0,0 +1,263 @@
+#! /usr/bin/env python3
+"""
+a directory of files keyed on a hash of whatever made them, shared between runs.
+Files are written under a temporary name and moved into place in one go, so jobs
+running at the same time never see (or clobber) each others half written files,
+and a per key lock (where we have fcntl) stops them making the same file twice.
+Once the directory gets bigger than max_bytes the least recently used files go
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import contextlib
+
+try:
+	# posix only, without it jobs can end up building the same file at the same time
+	import fcntl
+except:
+	fcntl = None
+
+
+def cache_root():
+	""" where all our caches live """
+	cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+	return os.path.join(cache_dir, 'threezerozeroeight')
+
+
+def hash_file(filename, block_len=2**20):
+	""" sha256 of the contents of a file, read a block at a time """
+	
+	digest = hashlib.sha256()
+	
+	with open(filename, 'rb') as fp:
+		for block in iter(lambda: fp.read(block_len), b''):
+			digest.update(block)
+	
+	return digest.hexdigest()
+
+
+def hash_params(**params):
+	""" sha256 of a set of (json-able) parameters, order doesnt matter """
+	return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+class file_cache:
+	""" size bounded, least recently used, directory of files """
+	
+	def __init__(self, name, max_bytes=2**30, ext='.hdf5'):
+		""" inputs:
+		name => sub directory of cache_root() to use
+		max_bytes => how big the cache is allowed to get
+		ext => extension of the cached files
+		
+		return: None
+		side_effects: None (the directory is made on the first put)
+		"""
+		
+		self.directory = os.path.join(cache_root(), name)
+		self.max_bytes = max_bytes
+		self.ext = ext
+		
+		# what this process has done with the cache, see stats
+		self.hits = 0
+		self.misses = 0
+		self.puts = 0
+		self.evictions = 0
+		
+		return
+	
+	def path(self, key):
+		""" where the file for key lives (whether or not it exists yet) """
+		return os.path.join(self.directory, key + self.ext)
+	
+	def get(self, key):
+		""" look up a key
+		inputs:
+		key => hash of whatever made the file
+		
+		return: path to the cached file, or None if it isnt there
+		side_effects: marks the file as recently used
+		"""
+		
+		path = self.path(key)
+		
+		try:
+			os.utime(path)
+		except FileNotFoundError:
+			self.misses += 1
+			return None
+		
+		self.hits += 1
+		
+		return path
+	
+	@contextlib.contextmanager
+	def lock(self, key):
+		""" hold an exclusive lock on key for the length of a with block, so only one
+		job at a time checks for & makes its file (the others wait, then find it) """
+		
+		os.makedirs(self.directory, exist_ok=True)
+		
+		path = os.path.join(self.directory, key + '.lock')
+		
+		while True:
+			fp = open(path, 'a')
+			
+			if fcntl is None:
+				break
+			
+			fcntl.flock(fp, fcntl.LOCK_EX)
+			
+			# sweep_locks may have removed the file while we waited, in which case the
+			# lock we got is on nothing anyone else can see, so lock whatever is there now
+			try:
+				if os.path.samestat(os.fstat(fp.fileno()), os.stat(path)):
+					break
+			except FileNotFoundError:
+				pass
+			
+			fp.close()
+		
+		try:
+			yield
+		finally:
+			if fcntl is not None:
+				fcntl.flock(fp, fcntl.LOCK_UN)
+			fp.close()
+	
+	def tmp_path(self, key):
+		""" somewhere unique to write a file before it is put in the cache """
+		
+		os.makedirs(self.directory, exist_ok=True)
+		
+		fd, path = tempfile.mkstemp(prefix=key + '.', suffix='.tmp' + self.ext, dir=self.directory)
+		os.close(fd)
+		
+		return path
+	
+	def put(self, key, tmp_path):
+		""" move a finished file (from tmp_path) into the cache
+		inputs:
+		key => hash of whatever made the file
+		tmp_path => where the file was written
+		
+		return: path to the cached file
+		side_effects: may evict old files
+		"""
+		
+		path = self.path(key)
+		os.replace(tmp_path, path)
+		
+		self.puts += 1
+		self.evict(keep=path)
+		
+		return path
+	
+	def entries(self):
+		""" (last used, size, path) of every file in the cache """
+		
+		if not os.path.isdir(self.directory):
+			return []
+		
+		entries = []
+		for entry in os.scandir(self.directory):
+			if entry.is_file() and entry.name.endswith(self.ext) and '.tmp' not in entry.name:
+				stat = entry.stat()
+				entries.append((stat.st_mtime, stat.st_size, entry.path))
+		
+		return entries
+	
+	def stats(self):
+		""" hits, misses, puts & evictions so far in this process, and the files &
+		bytes in the cache right now """
+		
+		entries = self.entries()
+		
+		return {
+		    'hits': self.hits,
+		    'misses': self.misses,
+		    'puts': self.puts,
+		    'evictions': self.evictions,
+		    'files': len(entries),
+		    'bytes': sum(size for mtime, size, path in entries)
+		}
+	
+	def evict(self, keep=None):
+		""" delete the least recently used files until we fit in max_bytes
+		inputs:
+		keep => a path never to delete, the file just put in (even if it alone is
+		        bigger than max_bytes, it goes with the next put instead)
+		
+		return: None
+		side_effects: removes files
+		"""
+		
+		entries = self.entries()
+		total = sum(size for mtime, size, path in entries)
+		
+		for mtime, size, path in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			
+			if path == keep:
+				continue
+			
+			try:
+				os.remove(path)
+				self.evictions += 1
+			except FileNotFoundError:
+				# someone else got there first
+				pass
+			
+			# the .lock file stays, whoever holds or waits on its flock would otherwise
+			# end up locking a different file to the next job, sweep_locks tidies it
+			total -= size
+		
+		self.sweep_locks()
+		
+		return
+	
+	def sweep_locks(self):
+		""" remove the .lock files of keys that have no file in the cache, leaving any
+		that someone holds (they are making the file)
+		
+		return: None
+		side_effects: removes files
+		"""
+		
+		if not os.path.isdir(self.directory):
+			return
+		
+		for entry in os.scandir(self.directory):
+			if not entry.name.endswith('.lock'):
+				continue
+			
+			path = self.path(entry.name[:-len('.lock')])
+			if os.path.exists(path):
+				continue
+			
+			try:
+				fp = open(entry.path, 'a')
+			except OSError:
+				continue
+			
+			# closing fp at the end of the with lets go of the flock
+			with fp:
+				if fcntl is not None:
+					try:
+						fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+					except OSError:
+						# in use
+						continue
+				
+				# only if nobody made the file (or a new lock) since we looked, anyone
+				# waiting on this lock notices it went (see lock) and locks afresh
+				try:
+					if not os.path.exists(path) and os.path.samestat(os.fstat(fp.fileno()), os.stat(entry.path)):
+						os.remove(entry.path)
+				except FileNotFoundError:
+					pass
+		
+		return
@@ -0,0 +1,433 @@
+#! /usr/bin/env python3
+"""
+try a grid of gate settings on one piece of audio without running main.py for each.
+The audio is decomposed once (through note_cache, so a rerun doesnt even do that), and
+then every batch of notes goes through every configuration before moving on. Work the
+configurations have in common is only done once per batch:
+	
+	the data envelope => once per (spread, detect_type, window)
+	the background => one noise_profile per (spread, detect_type, window), and the
+	                  sigma gates all share the one noise_gate_sigma profile
+	the adaptive filter => one run per filter setting (taps, nlms_type, eps, leak,
+	                       block_len) with a different mu for each row, see
+	                       noise_gate_adaptave.gain
+
+the batches are spread over a process pool like pipeline. Each configuration gives a
+row of metrics:
+	
+	seconds => time spent gating (work shared by a batch of configurations is split
+	           evenly between them)
+	kept_db => energy of the gated mix over the energy of the ungated one
+	snr_db => scale invariant signal to noise ratio against a clean reference, and
+	          snr_gain_db => how much better that is than the ungated mix (only if
+	          a reference is given)
+	
+	python gate_sweep.py test.wav bg_fan.wav --spread 500 1000 --mu 0.05 0.1 --sigma 3 5
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import numpy as np
+from scipy.io import wavfile
+import note_decompose as nde
+import note_recompose as nre
+import noise_gate as ngate
+import note_cache
+import note_store
+import envelope
+import parallel
+import adaptive_filter
+
+# the settings each gate takes, and what they default to
+gate_params = {
+    'sigma': {
+        'spread': 1000,
+        'sigma': 5
+    },
+    'adaptave': {
+        'spread': 1000,
+        'detect_type': 'peak',
+        'window': None,
+        'taps': 100,
+        'mu': 0.1,
+        'eps': 0.001,
+        'leak': 0,
+        'nlms_type': 'block',
+        'block_len': 32
+    }
+}
+
+
+def grid(gate, **values):
+	""" every combination of some gate settings
+	inputs:
+	gate => 'sigma' or 'adaptave'
+	values => setting name => list of values to try, anything not given is left at
+	          its default (see gate_params)
+	
+	return: list of configurations (dicts with 'gate' and every setting)
+	side_effects: None
+	"""
+	
+	if gate not in gate_params:
+		raise Exception("No idea how to sweep gate " + str(gate))
+	
+	for name in values:
+		if name not in gate_params[gate]:
+			raise Exception(gate + " gates dont have a setting called " + name)
+	
+	# caught here rather than after the background profiles have been built
+	for nlms_type in values.get('nlms_type', []):
+		if nlms_type not in adaptive_filter.filters:
+			raise Exception("No idea what nlms_type " + str(nlms_type) + " is, try one of " +
+			                ", ".join(adaptive_filter.filters))
+	
+	names = list(values)
+	configs = []
+	
+	for combination in itertools.product(*[values[name] for name in names]):
+		config = {'gate': gate}
+		config.update(gate_params[gate])
+		config.update(zip(names, combination))
+		configs.append(config)
+	
+	return configs
+
+
+def plan(configs, nde_class, bg_file):
+	""" group the configurations by the work they share
+	inputs:
+	configs => from grid
+	nde_class, bg_file => the decomposition & background the gates work with
+	
+	return: (groups, sigma_gate), groups being a list of (envelope params, [(index, sigma)],
+	        [(gate, [(index, mu)])]) where the gates are noise_gate_adaptave set up (and
+	        with their profile loaded) for each filter setting, and sigma_gate the
+	        noise_gate_sigma all the sigma gates share (or None)
+	side_effects: may build & cache background profiles
+	"""
+	
+	groups = {}
+	sigma_gate = None
+	
+	for i, config in enumerate(configs):
+		env_params = (config['spread'], config.get('detect_type', 'peak'), config.get('window'))
+		sigmas, filters = groups.setdefault(env_params, ([], {}))
+		
+		if config['gate'] == 'sigma':
+			if sigma_gate is None:
+				sigma_gate = ngate.noise_gate_sigma(bg_file, nde_class.octaves, nde_class.width, nde_class.noteints)
+			
+			sigmas.append((i, config['sigma']))
+		
+		else:
+			filter_params = tuple(config[name] for name in ('taps', 'eps', 'leak', 'nlms_type', 'block_len'))
+			
+			if filter_params not in filters:
+				gate = ngate.noise_gate_adaptave(bg_file, nde_class.octaves, nde_class.width, nde_class.noteints)
+				gate.spread, gate.detect_type, gate.window = env_params
+				gate.taps, gate.eps, gate.leak, gate.nlms_type, gate.block_len = filter_params
+				gate.noise_profile()
+				filters[filter_params] = (gate, [])
+			
+			filters[filter_params][1].append((i, config['mu']))
+	
+	groups = [(env_params, sigmas, list(filters.values())) for env_params, (sigmas, filters) in groups.items()]
+	
+	return groups, sigma_gate
+
+
+class sweep_job:
+	""" gates batches of cached notes with every configuration, also a
+	parallel.reduce_map job adding the sums of a batch into its share's accumulator """
+	
+	def __init__(self, nde_class, filename, keys, groups, sigma_gate, n_configs, n_shares):
+		""" inputs:
+		nde_class => decompose the cache entry was made with
+		filename => the cached hdf5 file (without the extension)
+		keys => the notes in it, in order
+		groups, sigma_gate => from plan
+		n_configs => number of configurations
+		n_shares => accumulators, one per reduce_map worker (0 if serial)
+		
+		return: None
+		side_effects: makes a shared array, close removes it
+		"""
+		
+		self.filename = filename
+		self.keys = keys
+		self.batch_size = nde_class.batch_size
+		self.groups = groups
+		self.sigma_gate = sigma_gate
+		self.n_configs = n_configs
+		self.threads = 1
+		
+		# opened in each worker the first time it is needed, h5py files dont pickle
+		self.reader = None
+		
+		# a row per configuration and one more for the ungated notes
+		self.sum_shape = (n_configs + 1, ) + nde_class.channel_shape() + (nde_class.file_len, )
+		self.slots = parallel.shared_array((n_shares, ) + self.sum_shape, nde_class.dtype())
+		
+		return
+	
+	def n_tasks(self):
+		""" number of batches """
+		return int(np.ceil(len(self.keys) / self.batch_size))
+	
+	def gate_batch(self, keys, block, sums):
+		""" gate a batch of notes with every configuration
+		inputs:
+		keys => key of each row
+		block => (notes x samples) block, or (notes x channels x samples)
+		sums => where to add the gated batches, see self.sum_shape
+		
+		return: seconds spent on each configuration
+		side_effects: adds to sums
+		"""
+		
+		seconds = np.zeros(self.n_configs)
+		sums[-1] += np.sum(block, axis=0)
+		
+		for (spread, detect_type, window), sigmas, filters in self.groups:
+			start = time.perf_counter()
+			v_data = envelope.envelope(block, spread, detect_type, window)
+			shared = time.perf_counter() - start
+			
+			n_group = len(sigmas) + sum(len(mus) for gate, mus in filters)
+			
+			if sigmas:
+				start = time.perf_counter()
+				
+				# every sigma at once, see noise_gate_sigma.noise_gate_sigma
+				bg_mean = np.array([self.sigma_gate.bg_mean[key] for key in keys])
+				bg_sigma = np.array([self.sigma_gate.bg_sigma[key] for key in keys])
+				level = bg_mean + bg_sigma * np.array([sigma for i, sigma in sigmas])[:, np.newaxis]
+				is_open = np.greater(v_data, level.reshape(level.shape + (1, ) * (v_data.ndim - 1)))
+				
+				each = (time.perf_counter() - start) / len(sigmas)
+				
+				for (i, sigma), row_open in zip(sigmas, is_open):
+					start = time.perf_counter()
+					sums[i] += np.sum(np.where(envelope.hold(row_open, spread, block.shape[-1]), block, 0), axis=0)
+					seconds[i] += time.perf_counter() - start + each
+			
+			for gate, mus in filters:
+				start = time.perf_counter()
+				
+				# every mu at once, see noise_gate_adaptave.noise_gate_block
+				v_noise = gate.noise_profile().stack(keys, v_data.shape[-1])
+				v_noise = v_noise.reshape(v_noise.shape[:1] + (1, ) * (block.ndim - 2) + v_noise.shape[1:])
+				
+				mu = np.array([mu for i, mu in mus]).reshape((-1, ) + (1, ) * (v_data.ndim - 1))
+				gains = gate.gain(v_data, v_noise, mu=mu)
+				
+				each = (time.perf_counter() - start) / len(mus)
+				
+				for (i, mu), gain in zip(mus, gains):
+					start = time.perf_counter()
+					sums[i] += np.sum(envelope.apply_gain(block, gain, spread), axis=0)
+					seconds[i] += time.perf_counter() - start + each
+			
+			for i, value in sigmas + [i_mu for gate, mus in filters for i_mu in mus]:
+				seconds[i] += shared / n_group
+		
+		return seconds
+	
+	def batch(self, task):
+		""" keys and notes of one batch """
+		
+		if self.reader is None:
+			self.reader = note_store.note_reader(self.filename)
+		
+		keys = self.keys[task * self.batch_size:(task + 1) * self.batch_size]
+		
+		return keys, np.array([self.reader.view(key) for key in keys])
+	
+	def run(self, task, share):
+		""" gate a batch with every configuration into the accumulator of share
+		
+		return: seconds spent on each configuration
+		side_effects: adds to the accumulator
+		"""
+		return self.gate_batch(*self.batch(task), self.slots.array[share])
+	
+	def close_worker(self):
+		""" close the reader, parallel calls this as each worker exits """
+		
+		if self.reader is not None:
+			self.reader.close()
+			self.reader = None
+		
+		return
+	
+	def close(self):
+		""" cleanup """
+		self.close_worker()
+		self.slots.close()
+		return
+
+
+def si_snr(data, reference):
+	""" scale invariant signal to noise ratio (dB) of data against a clean reference """
+	
+	reference = reference.reshape(-1)
+	data = data.reshape(-1)
+	
+	target = reference * (np.dot(data, reference) / np.dot(reference, reference))
+	noise = data - target
+	
+	return 10 * np.log10(np.dot(target, target) / max(np.dot(noise, noise), 1e-300))
+
+
+def sweep(nde_class, bg_file, configs, reference=None, workers=None, out_files=None):
+	""" run every gate configuration over the audio held by nde_class
+	inputs:
+	nde_class => note_decompose.decompose with its params set
+	bg_file => background noise wav for the gates
+	configs => list of configurations, from grid
+	reference => the clean audio (wav file or array, the same length & channels as the
+	             audio) to score against, None => no snr metrics
+	workers => processes to use, None => nde_class.workers (see parallel.split_cpus)
+	out_files => a wav file per configuration to write the gated audio to, or None
+	
+	return: a row per configuration, the configuration plus its metrics (see the top of
+	        this file)
+	side_effects: may decompose & cache the audio and background, may write wavs
+	"""
+	
+	groups, sigma_gate = plan(configs, nde_class, bg_file)
+	
+	workers, threads = parallel.split_cpus(nde_class.n_cpu, nde_class.workers if workers is None else workers)
+	
+	reader = note_cache.load(nde_class, 0)
+	
+	filename = os.path.splitext(reader.fp.filename)[0]
+	
+	# a full set of sums per worker, as many workers as there is shared memory for
+	sum_bytes = (len(configs) + 1) * int(np.prod(nde_class.channel_shape())) * nde_class.file_len
+	workers = parallel.fit_slots(workers, sum_bytes * np.dtype(nde_class.dtype()).itemsize)
+	
+	n_shares = workers if workers > 1 else 0
+	job = sweep_job(nde_class, filename, reader.keys(), groups, sigma_gate, len(configs), n_shares)
+	
+	sums = np.zeros(job.sum_shape, dtype=nde_class.dtype())
+	seconds = np.zeros(len(configs))
+	
+	try:
+		if workers > 1:
+			seconds += np.sum(parallel.reduce_map(job, job.n_tasks(), workers, threads), axis=0)
+			
+			for share in range(workers):
+				sums += job.slots.array[share]
+		
+		else:
+			for task in range(job.n_tasks()):
+				seconds += job.gate_batch(*job.batch(task), sums)
+	
+	finally:
+		job.close()
+		reader.close()
+	
+	if isinstance(reference, str):
+		reference = nde_class.arrange_channels(wavfile.read(reference)[1])
+	
+	if reference is not None:
+		reference = np.asarray(reference, dtype=np.float64)[..., :nde_class.file_len]
+		ungated_snr = si_snr(sums[-1], reference)
+	
+	ungated_energy = np.sum(np.square(sums[-1], dtype=np.float64))
+	
+	rows = []
+	for i, config in enumerate(configs):
+		row = dict(config)
+		row['seconds'] = seconds[i]
+		row['kept_db'] = 10 * np.log10(np.sum(np.square(sums[i], dtype=np.float64)) / ungated_energy)
+		
+		if reference is not None:
+			row['snr_db'] = si_snr(sums[i], reference)
+			row['snr_gain_db'] = row['snr_db'] - ungated_snr
+		
+		rows.append(row)
+		
+		if out_files is not None:
+			# channels (if there are any) go last in a wav
+			wavfile.write(out_files[i], nde_class.sample_rate, nre.normalise(sums[i]).T)
+	
+	return rows
+
+
+def best(rows, metric='snr_db'):
+	""" the row with the highest metric """
+	return max(rows, key=lambda row: row[metric])
+
+
+def print_table(rows, sort_by=None):
+	""" print the rows of a sweep, best first if sort_by names a metric """
+	
+	if sort_by is not None:
+		rows = sorted(rows, key=lambda row: row[sort_by], reverse=True)
+	
+	columns = []
+	for row in rows:
+		columns.extend(name for name in row if name not in columns)
+	
+	print('  '.join('%12s' % name for name in columns))
+	
+	for row in rows:
+		cells = []
+		for name in columns:
+			value = row.get(name, '')
+			cells.append('%12.4g' % value if isinstance(value, float) else '%12s' % (value, ))
+		
+		print('  '.join(cells))
+	
+	return
+
+
+def main(argv=None):
+	""" command line, see python gate_sweep.py --help """
+	
+	parser = argparse.ArgumentParser(description="sweep noise gate settings over some audio")
+	parser.add_argument('audio', help="wav to gate")
+	parser.add_argument('background', help="wav of the background noise")
+	parser.add_argument('--reference', help="clean wav to score the gated audio against")
+	parser.add_argument('--octaves', type=int, nargs=2, default=(2, 15))
+	parser.add_argument('--gates', nargs='+', choices=list(gate_params), default=list(gate_params))
+	parser.add_argument('--spread', type=int, nargs='+', default=[1000])
+	parser.add_argument('--sigma', type=float, nargs='+', default=[5])
+	parser.add_argument('--mu', type=float, nargs='+', default=[0.1])
+	parser.add_argument('--taps', type=int, nargs='+', default=[100])
+	parser.add_argument('--nlms-type', nargs='+', choices=list(adaptive_filter.filters), default=['block'])
+	parser.add_argument('--workers', type=int, help="processes to use, default one per cpu")
+	parser.add_argument('--out', help="write the rows to this json file")
+	args = parser.parse_args(argv)
+	
+	nde_class = nde.decompose(args.audio)
+	nde_class.octaves = tuple(args.octaves)
+	nde_class.workers = args.workers
+	
+	configs = []
+	if 'sigma' in args.gates:
+		configs += grid('sigma', spread=args.spread, sigma=args.sigma)
+	
+	if 'adaptave' in args.gates:
+		configs += grid('adaptave', spread=args.spread, mu=args.mu, taps=args.taps, nlms_type=args.nlms_type)
+	
+	rows = sweep(nde_class, args.background, configs, reference=args.reference)
+	
+	print_table(rows, sort_by='snr_db' if args.reference else None)
+	
+	if args.out is not None:
+		with open(args.out, 'w') as fp:
+			json.dump(rows, fp, indent=1)
+	
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
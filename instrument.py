@@ -0,0 +1,391 @@
+#! /usr/bin/env python3
+"""
+opt-in instrumentation: where the time, cpu, memory and io of a run goes. Code marks
+out stages with spans and bumps counters as it goes
+	
+	with instrument.span('decompose.masks', 'mask', notes=len(batch)):
+		...
+	instrument.count('bytes_written', block.nbytes)
+
+while it is disabled (the default) a span is one shared do-nothing context manager and
+a counter is an early return, so leaving them in costs next to nothing. Once enabled
+every span records its wall time, cpu time (of the process) and optionally the peak
+allocation (tracemalloc, python & numpy) above where it started, nested spans
+included. Events go to any hooks as they happen and are kept for summary() and
+export_chrome_trace(), which writes chrome trace-event json (chrome://tracing or
+https://ui.perfetto.dev)
+
+the parallel workers record with the same flags as the process that started them,
+and hand their events back with each result (see worker_state & take), so they show
+up here under the pid of the worker that did the work
+"""
+
+import os
+import json
+import time
+import threading
+import tracemalloc
+import contextlib
+
+enabled = False
+memory = False  # track allocation peaks too (slow, tracemalloc is on while enabled)
+keep_events = True  # keep events for summary & export, False => only hooks see them
+started_tracemalloc = False  # tracemalloc was started by enable, so disable stops it
+
+hooks = []
+events = []
+counters = {}
+taken = {}  # counter totals a worker has already handed over, see take
+
+# per thread stack of open spans
+local = threading.local()
+
+# the start of the trace, timestamps are relative to it
+origin = time.perf_counter_ns()
+
+null_span = contextlib.nullcontext()
+
+
+def enable(track_memory=False, keep=True):
+	""" start recording
+	inputs:
+	track_memory => also record the allocation peak of every span (turns tracemalloc on)
+	keep => keep the events for summary & export_chrome_trace, otherwise they only go
+	        to the hooks
+	
+	return: None
+	side_effects: sets the module state
+	"""
+	
+	global enabled, memory, keep_events, started_tracemalloc
+	
+	memory = track_memory
+	keep_events = keep
+	
+	if memory and not tracemalloc.is_tracing():
+		tracemalloc.start()
+		started_tracemalloc = True
+	
+	enabled = True
+	
+	return
+
+
+def stop_tracemalloc():
+	""" stop tracemalloc if enable started it, leave it alone if someone else did """
+	
+	global started_tracemalloc
+	
+	if started_tracemalloc and tracemalloc.is_tracing():
+		tracemalloc.stop()
+	
+	started_tracemalloc = False
+	
+	return
+
+
+def disable():
+	""" stop recording, the events so far are kept """
+	
+	global enabled
+	
+	enabled = False
+	stop_tracemalloc()
+	
+	return
+
+
+def reset():
+	""" forget every event and counter """
+	
+	global origin
+	
+	events.clear()
+	counters.clear()
+	origin = time.perf_counter_ns()
+	
+	return
+
+
+@contextlib.contextmanager
+def recording(track_memory=False, keep=True):
+	""" enable for the length of a with block, see enable. Whatever was set before
+	(enabled or not, memory, keep) is put back afterwards """
+	
+	global memory, keep_events
+	
+	was_enabled, was_memory, was_keep = enabled, memory, keep_events
+	enable(track_memory, keep)
+	
+	try:
+		yield
+	finally:
+		if was_enabled:
+			if not was_memory:
+				stop_tracemalloc()
+			
+			enable(was_memory, was_keep)
+		
+		else:
+			disable()
+			memory, keep_events = was_memory, was_keep
+
+
+def add_hook(hook):
+	""" call hook(event) for every span that finishes and counter that changes, the
+	event is a chrome trace event dict (see export_chrome_trace) """
+	
+	hooks.append(hook)
+	
+	return
+
+
+def remove_hook(hook):
+	""" stop calling a hook """
+	
+	hooks.remove(hook)
+	
+	return
+
+
+def emit(event):
+	""" hand an event to the hooks and keep it """
+	
+	if keep_events:
+		events.append(event)
+	
+	for hook in hooks:
+		hook(event)
+	
+	return
+
+
+def now():
+	""" microseconds since the trace started """
+	return (time.perf_counter_ns() - origin) / 1000
+
+
+class active_span:
+	""" an open span, see span """
+	
+	__slots__ = ('name', 'cat', 'args', 'wall', 'cpu', 'mem_start', 'child_peak')
+	
+	def __init__(self, name, cat, args):
+		""" see span """
+		self.name = name
+		self.cat = cat
+		self.args = args
+	
+	def __enter__(self):
+		""" start the clocks """
+		
+		stack = getattr(local, 'stack', None)
+		if stack is None:
+			stack = local.stack = []
+		
+		if memory and tracemalloc.is_tracing():
+			current, peak = tracemalloc.get_traced_memory()
+			
+			# the peak so far belongs to whatever span we are inside
+			if stack:
+				stack[-1].child_peak = max(stack[-1].child_peak, peak)
+			
+			tracemalloc.reset_peak()
+			self.mem_start = current
+			self.child_peak = 0
+		
+		else:
+			self.mem_start = None
+		
+		stack.append(self)
+		
+		self.cpu = time.process_time_ns()
+		self.wall = time.perf_counter_ns()
+		
+		return self
+	
+	def __exit__(self, *exc):
+		""" stop the clocks and emit the event """
+		
+		wall = time.perf_counter_ns()
+		cpu = time.process_time_ns()
+		
+		local.stack.pop()
+		
+		args = dict(self.args)
+		args['cpu_ms'] = (cpu - self.cpu) / 1e6
+		
+		if self.mem_start is not None and tracemalloc.is_tracing():
+			peak = max(tracemalloc.get_traced_memory()[1], self.child_peak)
+			args['peak_bytes'] = peak - self.mem_start
+			
+			if local.stack:
+				local.stack[-1].child_peak = max(local.stack[-1].child_peak, peak)
+		
+		emit({
+		    'name': self.name,
+		    'cat': self.cat,
+		    'ph': 'X',
+		    'ts': (self.wall - origin) / 1000,
+		    'dur': (wall - self.wall) / 1000,
+		    'pid': os.getpid(),
+		    'tid': threading.get_ident(),
+		    'args': args
+		})
+		
+		return False
+
+
+def span(name, cat='', **args):
+	""" time a stage
+	inputs:
+	name => what the stage is, like 'decompose.masks'
+	cat => category, used to group spans ('fft', 'mask', 'io', 'nlms' ...)
+	args => anything else worth keeping with the event (json-able)
+	
+	return: context manager
+	side_effects: records an event on exit if enabled
+	"""
+	
+	if not enabled:
+		return null_span
+	
+	return active_span(name, cat, args)
+
+
+def count(name, n=1):
+	""" add n to a counter (like 'notes_decomposed' or 'bytes_written')
+	
+	return: None
+	side_effects: records a counter event if enabled
+	"""
+	
+	if not enabled:
+		return
+	
+	counters[name] = counters.get(name, 0) + n
+	
+	emit({
+	    'name': name,
+	    'cat': 'counter',
+	    'ph': 'C',
+	    'ts': now(),
+	    'pid': os.getpid(),
+	    'tid': threading.get_ident(),
+	    'args': {
+	        name: counters[name]
+	    }
+	})
+	
+	return
+
+
+def summary():
+	""" totals of the events recorded so far
+	
+	return: dict of
+	        spans => {name: {count, wall_s, cpu_s, max_peak_bytes}} (wall & cpu include
+	                 any spans nested inside)
+	        counters => {name: total}
+	side_effects: None
+	"""
+	
+	spans = {}
+	for event in events:
+		if event['ph'] != 'X':
+			continue
+		
+		total = spans.setdefault(event['name'], {'count': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'max_peak_bytes': None})
+		total['count'] += 1
+		total['wall_s'] += event['dur'] / 1e6
+		total['cpu_s'] += event['args']['cpu_ms'] / 1e3
+		
+		if 'peak_bytes' in event['args']:
+			total['max_peak_bytes'] = max(total['max_peak_bytes'] or 0, event['args']['peak_bytes'])
+	
+	return {'spans': spans, 'counters': dict(counters)}
+
+
+def worker_state():
+	""" what a worker process needs to record like this one, see start_worker """
+	return enabled, memory, origin
+
+
+def start_worker(state):
+	""" set a worker process up to record like the process worker_state came from. The
+	worker keeps its events (and none of its parents hooks) until take hands them over
+	
+	return: None
+	side_effects: sets the module state
+	"""
+	
+	global origin, taken
+	
+	worker_enabled, track_memory, origin = state
+	
+	hooks.clear()
+	events.clear()
+	counters.clear()
+	taken = {}
+	
+	if worker_enabled:
+		enable(track_memory, keep=True)
+	else:
+		disable()
+	
+	return
+
+
+def take():
+	""" hand over what a worker has recorded since the last take, for merge
+	
+	return: (events, {counter: added since the last take}), None if disabled
+	side_effects: forgets the events
+	"""
+	
+	global taken
+	
+	if not enabled:
+		return None
+	
+	recorded = list(events)
+	events.clear()
+	
+	added = {name: total - taken.get(name, 0) for name, total in counters.items() if total != taken.get(name, 0)}
+	taken = dict(counters)
+	
+	return recorded, added
+
+
+def merge(recorded):
+	""" add what a worker handed over with take to this process (None is ignored)
+	
+	return: None
+	side_effects: emits the events, adds to the counters
+	"""
+	
+	if recorded is None:
+		return
+	
+	worker_events, added = recorded
+	
+	for name, n in added.items():
+		counters[name] = counters.get(name, 0) + n
+	
+	for event in worker_events:
+		emit(event)
+	
+	return
+
+
+def export_chrome_trace(filename):
+	""" write the events as chrome trace-event json
+	
+	return: None
+	side_effects: writes filename
+	"""
+	
+	with open(filename, 'w') as fp:
+		json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'counters': counters}}, fp)
+	
+	return
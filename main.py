@@ -1,57 +1,65 @@
 #! /usr/bin/env python3
 
 import numpy as np
-import h5py
 import note_decompose as nde
-import note_recompose as nre
 import noise_gate as ngate
 import note_utils as note
+import pipeline
+import note_cache
 import sys
 import math_fun
 
 
-def main():
+class block_gate:
+	""" what the pipeline gates each block of notes with, a class rather than a closure
+	so it pickles into the workers however they get started """
 	
-	print("decomposing data")
-	nde_class = nde.decompose('test.wav')
-	nde_class.octaves = (2, 15)
-	nde_class.decompose('ns~test')
+	def __init__(self, nga_class):
+		""" nga_class => the gate, with its noise profile loaded """
+		self.nga_class = nga_class
+		return
+	
+	def __call__(self, block, keys):
+		""" gate a block of notes """
+		
+		# print some stuff
+		for key in keys:
+			freq = note.note2freq(*note.key2note(key))
+			print("filtering:  %s \t %.2f Hz " % (key, freq))
+		
+		#return np.array([ngs_class.noise_gate_sigma(d, k, 5, spread=1000) for d, k in zip(block, keys)])
+		#return np.array([ngate.noise_gate_PWVD(d, spread=1000) for d in block])
+		return self.nga_class.noise_gate_block(block, keys)
+
+
+def main(debug=False):
 	
 	print("decomposing bg")
-	#ngs_class = ngate.noise_gate_sigma('bg_fan.wav', nde_class.octaves)
-	nga_class = ngate.noise_gate_adaptave('bg_fan.wav', nde_class.octaves)
+	#ngs_class = ngate.noise_gate_sigma('bg_fan.wav', (2, 15))
+	nga_class = ngate.noise_gate_adaptave('bg_fan.wav', (2, 15))
 	nga_class.spread = 1000
 	nga_class.mu = 0.1
 	
-	fp_in = h5py.File('ns~test.hdf5', 'r', libver='latest')
-	fp_out = h5py.File('ns~test2.hdf5', 'w', libver='latest')
+	# load the profile now so the workers all start with it
+	nga_class.noise_profile()
 	
-	# copy over the meta key
-	fp_out.create_dataset('meta', data=fp_in['meta'], dtype=int)
-	
-	for i, key in enumerate(fp_in.keys()):
-		if key == 'meta':
-			continue
-		
-		# print some stuff
-		d = np.copy(fp_in[key])
-		freq = note.note2freq(int(key.split('-')[0]), key.split('-')[1])
-		print("filtering:  %s \t %.2f Hz " % (key, freq))
-		
-		#d = ngs_class.noise_gate_sigma(d, key, 5, spread=1000)
-		#d = ngate.noise_gate_PWVD(d, spread=1000)
-		d = nga_class.noise_gate_adaptave(d, key)
-		
-		fp_out.create_dataset(key, data=d, dtype=d.dtype)
+	print("decomposing, filtering & recomposing data")
+	nde_class = nde.decompose('test.wav')
+	nde_class.octaves = (2, 15)
+	nde_class.workers = None  # one process per cpu
 	
-	print("recomposing")
-	nre.recompose('ns~test2', 'out.wav')
+	# debug writes the notes before & after filtering to ns~test.hdf5 & ns~test2.hdf5
+	# the decomposition is cached, so rerunning to tune the gate skips straight to it
+	pipeline.pipeline(nde_class,
+	                  out_file='out.wav',
+	                  debug='ns~test' if debug else None,
+	                  block_gate=block_gate(nga_class),
+	                  use_cache=True)
 	
-	fp_in.close()
-	fp_out.close()
+	print("decomposition cache:", note_cache.cache.stats())
 	
 	return
 
 
 if __name__ == "__main__":
-	main()
+	main(debug='--debug' in sys.argv)
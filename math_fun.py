@@ -25,6 +25,28 @@ def gaussian_max1(x, mu, sig):
 	return np.exp((-1 / 2) * ((x - mu) / sig)**2)
 
 
+def gaussian_band(x, mu, sig, truncate):
+	""" compact support version of gaussian_max1, only keep the part of the
+	gaussian that is within truncate sigmas of mu
+	
+	everything outside the band is taken to be 0, so the largest weight that gets
+	thrown away is exp(-truncate**2 / 2) (4 sigma => 3.4e-4, 5 sigma => 3.7e-6).
+	Applied to a spectrum X this means every bin is off by at most that fraction of
+	|X| and by Parseval the error energy of the selected note is bounded by
+	exp(-truncate**2) * sum(|X|**2) over the bins outside the band.
+	
+	inputs:
+		x => x axis data of distribution (sorted ascending)
+		mu => the mean value of data
+		sig => standard deviation of data
+		truncate => how many sigma either side of mu to keep
+	returns: (start, stop, weights) where weights == gaussian_max1(x[start:stop], mu, sig)
+	"""
+	start = int(np.searchsorted(x, mu - truncate * sig, side='left'))
+	stop = int(np.searchsorted(x, mu + truncate * sig, side='right'))
+	return start, stop, gaussian_max1(x[start:stop], mu, sig)
+
+
 def pink_power(f, alpha=1, scale=1):
 	""" power spectral density for pink noise 
 	inputs:
@@ -1,17 +1,21 @@
 #! /usr/bin/env python3
 
 import numpy as np
-import note_utils as note
 import h5py
-import note_decompose as nde
-import scipy.signal as signal
-import adaptfilt as ada
+import note_store
+import envelope
+import noise_profile
+import adaptive_filter
+import instrument
 
 
 def wave2vol(data=None, spread=None, detect_type='peak'):
 	""" convert AC audio into DC volume, do this by dicing up the audio and picking
 	the peak or the rms value as the audio
 	
+	NOTE: this blows the volume back up to the length of the audio, use
+	envelope.envelope to get it at the decimated rate
+	
 	spread => the size of the window
 	detect_type => how we are finding the volume
 	wave => tuple containing fp & key, or the actual data itself
@@ -24,50 +28,21 @@ def wave2vol(data=None, spread=None, detect_type='peak'):
 	"""
 	
 	if type(data) == tuple:
-		fp_key = True
-		fp = data[0]
-		key = data[1]
-		wave = np.copy(fp[key])
+		fp, key = data
+		wave = fp[key]
+		
+		if spread is None:
+			spread = noise_profile.auto_spread(key, fp.sample_rate)
 	
 	else:
-		fp_key = False
-		wave = np.copy(data)
+		wave = data
 	
 	if spread is None:
-		if fp_key:
-			# (Lin et al. 2008 Varying-Window-Length Time-Frequency Peak Filtering And Its Application
-			# To Seismic Data): The optimal Window Length can be expressed as a function of the dominant
-			# frequency fd and the sampling frequency fs
-			fd = note.note2freq(int(key.split('-')[0]), key.split('-')[1])
-			fs = fp['meta'][1]
-			
-			alpha = 0.384  # Lin et al 2008
-			
-			spread = alpha * fs / fd
-			spread = int(np.ceil(spread))
-		
-		else:
-			spread = 1000  # default value if we dont have spread
-	
-	oldlen = len(wave)
-	newlen = int(np.ceil(len(wave) / spread)) * spread
+		spread = 1000  # default value if we dont have spread
 	
-	wave = np.append(wave, np.zeros(newlen - oldlen))
-	
-	wave = wave.reshape(int(newlen / spread), spread)
-	
-	if detect_type == 'peak':
-		volume = np.max(np.abs(wave), axis=1)
-	elif detect_type == 'rms':
-		volume = np.sqrt(np.sum(wave**2, axis=1) / wave.shape[1])
-	else:
-		raise Exception("only peak and rms detection types are defined so far")
+	volume = envelope.block_envelope(wave, spread, detect_type)
 	
-	volume = np.repeat(volume, spread)
-	
-	volume = volume[0:oldlen]
-	
-	return volume
+	return envelope.hold(volume, spread, wave.shape[-1])
 
 
 # -------------------------------------------------------------------------------------------- #
@@ -75,40 +50,28 @@ def wave2vol(data=None, spread=None, detect_type='peak'):
 
 class noise_gate_sigma:
 	""" class only used to store the mean & sigma global vars """
-	def __init__(self, bg_file, octave):
+	def __init__(self, bg_file, octave, width=0.5, noteints=12):
 		""" calculate & store the mean and stddev values for a short sample of the 
 		background noise
 		
 		input:
 		bg_file => path to background file
 		octave -> octaves that we are looking at (needs to be the same as the main audio)
+		width, noteints -> the rest of the decomposition params (same as the main audio)
 		
 		return:
 		None
 		
 		Side effects:
-		create file for background noise &  
+		adds the background noise profile to the cache (see noise_profile) &  
 		update self.bg_sigma and self.bg_mean
 		"""
 		
-		nde_class = nde.decompose(bg_file)
-		nde_class.octaves = octave
-		nde_class.decompose('ns~background')
-		
-		fp = h5py.File('ns~background.hdf5', 'r', libver='latest')
+		profile = noise_profile.load(bg_file, octave, width, noteints)
 		
-		self.bg_sigma = {}
-		self.bg_mean = {}
+		self.bg_sigma = profile.sigma
+		self.bg_mean = profile.mean
 		
-		for key in list(fp.keys()):
-			
-			if key == 'meta':
-				continue
-			
-			self.bg_sigma[key] = np.std(wave2vol((fp, key)))
-			self.bg_mean[key] = np.mean(wave2vol((fp, key)))
-		
-		fp.close()
 		return
 	
 	def noise_gate_sigma(self, data, key, sigma, spread=None):
@@ -123,35 +86,48 @@ class noise_gate_sigma:
 		"""
 		
 		if type(data) == h5py._hl.files.File:
-			volume = wave2vol((data, key), spread=spread)
+			data = note_store.note_reader(data)
+		
+		if type(data) == note_store.note_reader:
+			if spread is None:
+				spread = noise_profile.auto_spread(key, data.sample_rate)
 			data = data[key]
-		else:
-			volume = wave2vol(data, spread=spread)
 		
-		level = self.bg_mean[key] + (self.bg_sigma[key] * sigma)
+		if spread is None:
+			spread = 1000  # default value if we dont have spread
+		
+		instrument.count('notes_gated')
 		
-		vol_mask = np.logical_not(np.greater(volume, level))
+		with instrument.span('gate.envelope', 'gate'):
+			volume = envelope.envelope(data, spread)
+		
+		level = self.bg_mean[key] + (self.bg_sigma[key] * sigma)
 		
-		new_data = np.copy(data)
-		new_data[vol_mask] = 0
+		# gate a whole block at a time
+		vol_mask = envelope.hold(np.greater(volume, level), spread, data.shape[-1])
 		
-		return new_data
+		return np.where(vol_mask, data, 0)
 
 
 class noise_gate_adaptave:
 	
 	# not actually a noise gate but whatever
 	
-	def __init__(self, bg_file, octave):
-		# decompose the background noise
-		nde_class = nde.decompose(bg_file)
-		nde_class.octaves = octave
-		nde_class.decompose('ns~background')
+	def __init__(self, bg_file, octave, width=0.5, noteints=12):
+		# the background noise gets decomposed (or pulled out of the cache) the first
+		# time it is needed, once we know what spread etc to use
 		
 		# ---- and now for global vars in disguise ----- #
-		# file stuff
-		self.fp = h5py.File('ns~background.hdf5', 'r', libver='latest')
+		# background stuff
+		self.bg_file = bg_file
+		self.octave = octave
+		self.width = width
+		self.noteints = noteints
+		self.profile = None
+		
 		self.spread = 1000
+		self.window = None  # envelope window, None => spread
+		self.detect_type = 'peak'
 		self.data_len = 0
 		
 		# vars for nlms
@@ -162,6 +138,8 @@ class noise_gate_adaptave:
 		self.initCoeffs = None
 		self.n = None
 		self.returnCoeffs = False
+		self.nlms_type = 'block'  # see adaptive_filter.filters
+		self.block_len = 32  # block_nlms only
 		
 		# other interesting values that get generated
 		self.err = 0
@@ -170,38 +148,26 @@ class noise_gate_adaptave:
 		
 		return
 	
-	def dedup_vol(self, vol):
-		""" wave2vol returns a repeated thing 
-		1 1 1 2 2 2 3 3 3 etc 
-		de-duplicate that
-		
-		input: volume 
-		
-		global input: spread => amount of times each value is duplicated
+	def noise_profile(self):
+		""" the background noise profile for the current spread, detect_type & window
 		
-		output: shortened volume
-		side_effects: None
+		output: noise_profile.noise_profile
+		side_effects: self.profile gets updated if the envelope params changed
 		"""
 		
-		return vol[0::self.spread]
-	
-	def redup_vol(self, vol):
-		""" wave2vol returns a repeated thing 
-		1 1 1 2 2 2 3 3 3 etc 
-		dedup_vol deduplicates that
-		
-		set us re-duplicate that to its init length
+		params = (self.spread, self.detect_type, self.window)
 		
-		input: volume 
+		if self.profile is None or self.profile_params != params:
+			self.profile = noise_profile.load(self.bg_file,
+			                                  self.octave,
+			                                  self.width,
+			                                  self.noteints,
+			                                  spread=self.spread,
+			                                  detect_type=self.detect_type,
+			                                  window=self.window)
+			self.profile_params = params
 		
-		global input: spread => amount of times each value is duplicated
-		              data_len => how long the data was origenally
-		
-		output: re-lengthened volume
-		side_effects: None
-		"""
-		
-		return np.repeat(vol, self.spread)[:self.data_len]
+		return self.profile
 	
 	def noise_gate_adaptave(self, data, key):
 		""" the filtering 
@@ -218,25 +184,67 @@ class noise_gate_adaptave:
 		self.data_len gets updated (nothing will probs change)
 		"""
 		
-		self.data_len = len(data)
+		gated = self.noise_gate_block(data[np.newaxis], [key])
+		
+		self.err = self.err[0]
+		self.weights = self.weights[0]
+		
+		return gated[0]
+	
+	def noise_gate_block(self, data, keys):
+		""" the filtering, for a whole block of notes at once. The envelopes, noise
+		tiling, adaptive filter & gain all run across the note axis together
+		
+		input: data => (notes x samples) block we want to filter, or (notes x channels x
+		               samples), every channel of a note is gated against the same
+		               (mono) background noise
+		       keys => key of the freq of each row
+		
+		globals: self.taps => number of weights
+		
+		output: the filtered block
+		
+		side_effects:
+		self.err & self.weights get updated (a row per note)
+		self.data_len gets updated (nothing will probs change)
+		"""
+		
+		self.data_len = data.shape[-1]
 		
-		v_data = wave2vol(data)
-		v_noise = wave2vol(self.fp[key])
+		instrument.count('notes_gated', len(keys))
 		
-		v_data = self.dedup_vol(v_data)
-		v_noise = self.dedup_vol(v_noise)
+		# volumes at the decimated rate
+		with instrument.span('gate.envelope', 'gate', notes=len(keys)):
+			v_data = envelope.envelope(data, self.spread, self.detect_type, self.window)
 		
-		# extend noise so that it is the same length as data
-		while len(v_noise) < len(v_data):
-			v_noise = np.append(v_noise, v_noise)
-		v_noise = v_noise[:len(v_data)]
+		# noise repeated so that it is the same length as data
+		v_noise = self.noise_profile().stack(keys, v_data.shape[-1])
+		v_noise = v_noise.reshape(v_noise.shape[:1] + (1, ) * (data.ndim - 2) + v_noise.shape[1:])
+		
+		gain = self.gain(v_data, v_noise)
+		
+		with instrument.span('gate.gain', 'gate', notes=len(keys)):
+			return envelope.apply_gain(data, gain, self.spread)
+	
+	def gain(self, v_data, v_noise, mu=None):
+		""" the gain to apply to the data, at the envelope rate
+		
+		input: v_data => envelope of the data
+		       v_noise => envelope of the background noise, broadcast against v_data
+		       mu => step size to use instead of self.mu, an array of shape (n, 1, ...)
+		             (a 1 for each axis of v_data but the samples) gives n gains at
+		             once, one per mu
+		
+		output: the gain, (n, ) + v_data.shape if mu is an array
+		side_effects: self.err & self.weights get updated
+		"""
 		
 		# calculate nlms
-		est_v_noise, self.err, self.weights = self.nlms(v_data, v_noise)
+		est_v_noise, self.err, self.weights = self.nlms(v_data, v_noise, mu=mu)
 		
 		# nlms makes the data offset & slightly shorter
-		est_v_noise = np.roll(est_v_noise, self.taps - 1)
-		est_v_noise = np.append(est_v_noise, est_v_noise[0:self.taps - 1])
+		est_v_noise = np.roll(est_v_noise, self.taps - 1, axis=-1)
+		est_v_noise = np.concatenate((est_v_noise, est_v_noise[..., 0:self.taps - 1]), axis=-1)
 		
 		# calculate the estimated data volume
 		est_v_data = v_data - est_v_noise
@@ -244,23 +252,45 @@ class noise_gate_adaptave:
 		# set negative volume to 0
 		est_v_data[est_v_data < 0] = 0
 		
-		v_data = self.redup_vol(v_data)
-		est_v_data = self.redup_vol(est_v_data)
-		
-		# re-volumise the data
-		return data * est_v_data / v_data
+		# re-volumise the data (apply_gain interpolates the gain between blocks)
+		return np.divide(est_v_data,
+		                 v_data,
+		                 out=np.zeros_like(est_v_data),
+		                 where=np.broadcast_to(v_data > 0, est_v_data.shape))
 	
-	def nlms(self, v_data, v_noise):
-		""" currently just an alias to adaptfilt """
-		return ada.nlms(v_data,
-		                v_noise,
-		                self.taps,
-		                self.mu,
-		                eps=self.eps,
-		                leak=self.leak,
-		                initCoeffs=self.initCoeffs,
-		                N=self.n,
-		                returnCoeffs=self.returnCoeffs)
+	def nlms(self, v_data, v_noise, init_coeffs=None, mu=None):
+		""" run the adaptive filter picked by self.nlms_type over the volumes
+		
+		input: v_data => filter input
+		       v_noise => desired signal
+		       init_coeffs => weights to start from, None => self.initCoeffs
+		       mu => step size, None => self.mu (see adaptive_filter for arrays of them)
+		
+		output: estimated noise, error, weights (see adaptive_filter.nlms)
+		side_effects: None
+		"""
+		
+		if init_coeffs is None:
+			init_coeffs = self.initCoeffs
+		
+		if mu is None:
+			mu = self.mu
+		
+		kargs = {}
+		if self.nlms_type == 'block':
+			kargs['block_len'] = self.block_len
+		
+		with instrument.span('gate.nlms', 'nlms', type=self.nlms_type, shape=np.shape(v_data)):
+			return adaptive_filter.filters[self.nlms_type](v_data,
+			                                               v_noise,
+			                                               self.taps,
+			                                               mu,
+			                                               eps=self.eps,
+			                                               leak=self.leak,
+			                                               initCoeffs=init_coeffs,
+			                                               N=self.n,
+			                                               returnCoeffs=self.returnCoeffs,
+			                                               **kargs)
 
 
 # -------------------------------------------------------------------------------------------- #
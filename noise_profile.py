@@ -0,0 +1,181 @@
+#! /usr/bin/env python3
+"""
+background noise profiles for the noise gates: the volume envelope of every note of
+the background file, plus its mean & stddev. Building one means decomposing the
+background, so they are cached on disk keyed on a hash of the audio and of every
+parameter that goes into them
+"""
+
+import os
+import tempfile
+import numpy as np
+import h5py
+import note_utils as note
+import note_decompose as nde
+import envelope
+import file_cache
+
+# bump this if what goes into a profile changes
+profile_version = 1
+
+cache = file_cache.file_cache('noise_profiles', max_bytes=2**28)
+
+
+def auto_spread(key, fs):
+	""" envelope window for a note
+	
+	(Lin et al. 2008 Varying-Window-Length Time-Frequency Peak Filtering And Its Application
+	To Seismic Data): The optimal Window Length can be expressed as a function of the dominant
+	frequency fd and the sampling frequency fs
+	
+	key => note we are looking at
+	fs => sample rate
+	
+	return: window length in samples
+	"""
+	
+	fd = note.note2freq(*note.key2note(key))
+	
+	alpha = 0.384  # Lin et al 2008
+	
+	return int(np.ceil(alpha * fs / fd))
+
+
+class noise_profile:
+	""" per note envelope & statistics of some background noise """
+	
+	def __init__(self, filename):
+		""" read a profile written by build
+		inputs:
+		filename => path of the profile
+		
+		return: None
+		side_effects: None
+		"""
+		
+		self.envelope = {}
+		self.spread = {}
+		self.mean = {}
+		self.sigma = {}
+		
+		with h5py.File(filename, 'r') as fp:
+			self.sample_rate = int(fp.attrs['sample_rate'])
+			self.data_len = int(fp.attrs['data_len'])
+			
+			for key in fp.attrs['keys']:
+				self.envelope[key] = fp[key][:]
+				self.spread[key] = int(fp[key].attrs['spread'])
+				self.mean[key] = float(fp[key].attrs['mean'])
+				self.sigma[key] = float(fp[key].attrs['sigma'])
+		
+		return
+	
+	def keys(self):
+		""" notes in the profile """
+		return list(self.envelope.keys())
+	
+	def stack(self, keys, length, offset=0):
+		""" envelopes of a set of notes as a (len(keys), length) array, each one repeated
+		end to end (or cut short) to fill length, starting offset envelope samples in.
+		Needs a fixed spread so they all match
+		"""
+		
+		volume = np.array([self.envelope[key] for key in keys])
+		
+		return volume[:, (offset + np.arange(length)) % volume.shape[-1]]
+
+
+def build(filename, bg_file, octaves, width, noteints, spread, detect_type, window):
+	""" decompose the background (in memory) and save its profile
+	inputs:
+	filename => where to write the profile
+	the rest => see load
+	
+	return: None
+	side_effects: writes filename
+	"""
+	
+	nde_class = nde.decompose(bg_file)
+	nde_class.octaves = tuple(octaves)
+	nde_class.width = width
+	nde_class.noteints = noteints
+	
+	with h5py.File(filename, 'w') as fp:
+		fp.attrs['version'] = np.int32(profile_version)
+		fp.attrs['sample_rate'] = np.int64(nde_class.sample_rate)
+		fp.attrs['data_len'] = np.int64(nde_class.file_len)
+		
+		keys = []
+		for key, data in nde_class.iter_notes(savetype=0):
+			key_spread = auto_spread(key, nde_class.sample_rate) if spread is None else spread
+			volume = envelope.envelope(data, key_spread, detect_type, window)
+			
+			dset = fp.create_dataset(key, data=volume)
+			dset.attrs['spread'] = np.int64(key_spread)
+			dset.attrs['mean'] = np.mean(volume)
+			dset.attrs['sigma'] = np.std(volume)
+			keys.append(key)
+		
+		fp.attrs['keys'] = keys
+	
+	return
+
+
+def load(bg_file, octaves, width=0.5, noteints=12, spread=None, detect_type='peak', window=None, use_cache=True):
+	""" get the noise profile of a background file, from the cache if we can
+	inputs:
+	bg_file => path to background wav
+	octaves, width, noteints => decomposition params (same as the main audio)
+	spread => envelope spacing, None => auto_spread for each note
+	detect_type, window => see envelope.envelope
+	use_cache => False to always rebuild (and not touch the cache)
+	
+	return: noise_profile
+	side_effects: may build a profile and add it to the cache
+	"""
+	
+	params = (bg_file, octaves, width, noteints, spread, detect_type, window)
+	
+	if not use_cache:
+		# somewhere of our own, the cache directory isnt ours to write to here
+		fd, tmp_path = tempfile.mkstemp(prefix='noise_profile.', suffix=cache.ext)
+		os.close(fd)
+		
+		try:
+			build(tmp_path, *params)
+			return noise_profile(tmp_path)
+		finally:
+			os.remove(tmp_path)
+	
+	key = file_cache.hash_params(version=profile_version,
+	                             audio=file_cache.hash_file(bg_file),
+	                             octaves=list(octaves),
+	                             width=width,
+	                             noteints=noteints,
+	                             spread=spread,
+	                             detect_type=detect_type,
+	                             window=window)
+	
+	with cache.lock(key):
+		path = cache.get(key)
+		
+		if path is not None:
+			try:
+				return noise_profile(path)
+			except OSError:
+				# another job evicted it from under us
+				pass
+		
+		tmp_path = cache.tmp_path(key)
+		
+		try:
+			build(tmp_path, *params)
+			profile = noise_profile(tmp_path)
+		except:
+			# dont leave a half written file behind in the cache directory
+			os.remove(tmp_path)
+			raise
+		
+		cache.put(key, tmp_path)
+	
+	return profile
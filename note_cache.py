@@ -0,0 +1,139 @@
+#! /usr/bin/env python3
+"""
+decompositions kept between runs, so tuning the gate (spread, mu ...) doesnt mean
+doing the fft & every note all over again. An entry is keyed on a hash of the audio
+as it gets decomposed plus every param that changes the notes, and lives in a
+file_cache (so it is shared between jobs, locked while it is made and the least
+recently used entries go once the cache is full). Entries are written uncompressed
+with a chunk per note, so a note can come back as a memory mapped view of the file
+(note_store.note_reader.view) rather than being read in
+"""
+
+import os
+import copy
+import json
+import hashlib
+import numpy as np
+import fft_wrapper as fft
+import file_cache
+import note_store
+
+cache_version = 1
+
+cache = file_cache.file_cache('decompositions', max_bytes=2**32)
+
+
+def hash_audio(nde_class, block_len=2**20):
+	""" sha256 of the audio held by nde_class as it gets decomposed (after any mix
+	down), so the same sound hits whatever file it came from """
+	
+	data = np.asarray(nde_class.filedata)
+	
+	digest = hashlib.sha256()
+	digest.update(json.dumps([data.dtype.str, data.shape]).encode())
+	
+	flat = data.reshape(-1)
+	for i in range(0, len(flat), block_len):
+		digest.update(np.ascontiguousarray(flat[i:i + block_len]))
+	
+	return digest.hexdigest()
+
+
+def cache_key(nde_class, savetype):
+	""" hash of the audio & every param that changes the notes """
+	return file_cache.hash_params(version=cache_version,
+	                              format_version=note_store.format_version,
+	                              audio=hash_audio(nde_class),
+	                              sample_rate=int(nde_class.sample_rate),
+	                              octaves=[int(octave) for octave in nde_class.octaves],
+	                              width=float(nde_class.width),
+	                              noteints=int(nde_class.noteints),
+	                              truncate=None if nde_class.truncate is None else float(nde_class.truncate),
+	                              savetype=int(savetype),
+	                              precision=nde_class.precision,
+	                              channels=list(nde_class.channel_shape()))
+
+
+def build(nde_class, savetype, filename):
+	""" decompose into a file the way the cache keeps it
+	inputs:
+	nde_class => note_decompose.decompose with its params set
+	savetype => see note_decompose.decompose
+	filename => hdf5 file to write (without the extension)
+	
+	return: None
+	side_effects: writes filename
+	"""
+	
+	builder = copy.copy(nde_class)
+	builder.store_layout = 'table'
+	builder.compression = None
+	builder.store_chunks = 'row'
+	
+	# hdf5 chunks top out at 4GB, notes longer than that just get read instead of mapped
+	if savetype == 1:
+		row_len, dtype = nde_class.file_len // 2 + 1, fft.complex_dtype(nde_class.dtype())
+	else:
+		row_len, dtype = nde_class.file_len, np.dtype(nde_class.dtype())
+	
+	if row_len * int(np.prod(nde_class.channel_shape())) * dtype.itemsize >= 2**32:
+		builder.store_chunks = None
+	
+	builder.decompose(filename, savetype)
+	
+	return
+
+
+def load(nde_class, savetype=0):
+	""" get the decomposition of the audio held by nde_class, from the cache if we can
+	inputs:
+	nde_class => note_decompose.decompose with its params set (read in, not stream)
+	savetype => see note_decompose.decompose
+	
+	return: note_store.note_reader of the cached file (close it when done)
+	side_effects: may decompose and add the result to the cache
+	"""
+	
+	key = cache_key(nde_class, savetype)
+	
+	with cache.lock(key):
+		path = cache.get(key)
+		
+		if path is not None:
+			try:
+				return note_store.note_reader(os.path.splitext(path)[0])
+			except OSError:
+				# another job evicted it from under us
+				pass
+		
+		tmp_path = cache.tmp_path(key)
+		
+		try:
+			build(nde_class, savetype, os.path.splitext(tmp_path)[0])
+		except:
+			# dont leave a half written file behind in the cache directory
+			os.remove(tmp_path)
+			raise
+		
+		path = cache.put(key, tmp_path)
+	
+	return note_store.note_reader(os.path.splitext(path)[0])
+
+
+def iter_blocks(reader, batch_size):
+	""" the notes of a savetype 0 or 1 decomposition batch_size at a time, the same
+	as note_decompose.decompose.iter_blocks hands them back
+	inputs:
+	reader => note_store.note_reader, from load say
+	batch_size => notes per block
+	
+	yield: (keys, (len(keys) x samples) block of notes)
+	side_effects: None
+	"""
+	
+	keys = reader.keys()
+	
+	for i in range(0, len(keys), batch_size):
+		batch = keys[i:i + batch_size]
+		
+		yield batch, np.array([reader.view(key) for key in batch])
@@ -4,18 +4,29 @@ from scipy.io import wavfile
 import fft_wrapper as fft
 import numpy as np
 import os
-import h5py
+import copy
+import time
+import note_store
 import note_utils as note
 import matplotlib.pyplot as plt
 import math_fun
+import parallel
+import instrument
 
 
 class decompose:
-	def __init__(self, filename):
+	def __init__(self, filename, stream=False, multichannel=False):
 		""" This procedure declares global variables. Reads in .wav file information, 
 		converts stereo audio to mono then standardises to multiples of 2
 		inputs:
-			filename=> .wav file that will be decomposed
+			filename=> .wav file that will be decomposed, None => no audio, just the
+			           params (set sample_rate yourself), eg for stream_gate
+			stream => memory map the file instead of reading it in, for use with 
+			          decompose_stream on files that dont fit in memory
+			multichannel => keep every channel instead of mixing down to mono. The
+			                audio is then (channels, samples) and every note gets a
+			                channel axis just before the samples, the note masks are
+			                still only worked out once and shared by all the channels
 		"""
 		
 		# tunable paramsdata is now gated
@@ -23,20 +34,75 @@ class decompose:
 		self.width = 0.5
 		self.octaves = (2, 6)
 		self.noteints = 12
+		self.batch_size = 16  # notes held in memory per inverse fft
+		self.workers = 1  # processes for the note batches, None => one per cpu (see parallel)
+		self.truncate = None  # sigmas to keep each side of a note, None => full gaussian (see band_block)
+		self.block_len = 2**16  # samples per frame in decompose_stream
+		self.store_layout = 'table'  # see note_store
+		self.compression = None  # None, 'gzip' or 'lzf'
+		self.store_chunks = None  # chunk shape of the stored notes, see note_store.note_writer
+		self.precision = 'double'  # 'single' => float32 / complex64 all the way through
 		
-		self.filedata = wavfile.read(filename)
+		self.table = None  # (params, note table) from the last note_table
+		
+		self.multichannel = multichannel
+		
+		if filename is None:
+			self.sample_rate = None
+			self.filedata = None
+			self.file_len = 0
+			self.n_channels = 1
+			return
+		
+		if stream:
+			# leave the audio on disk, decompose_stream reads it a block at a time
+			self.sample_rate, self.filedata = wavfile.read(filename, mmap=True)
+			self.file_len = len(self.filedata) - len(self.filedata) % 2
+			self.n_channels = self.filedata.shape[1] if self.filedata.ndim > 1 else 1
+			return
+		
+		with instrument.span('decompose.read', 'io'):
+			self.filedata = wavfile.read(filename)
+		
+		instrument.count('bytes_read', self.filedata[1].nbytes)
 		
 		# get file information
 		self.sample_rate = self.filedata[0]
-		self.filedata = self.stereo2mono(self.filedata[1])
+		self.n_channels = self.filedata[1].shape[1] if self.filedata[1].ndim > 1 else 1
+		self.filedata = self.arrange_channels(self.filedata[1])
 		
 		# convert length to a multiple of 2 because fft does this and it makes things
 		# get confused otherwise
-		if len(self.filedata) % 2 == 1:
-			self.filedata = self.filedata[0:-1]
+		if self.filedata.shape[-1] % 2 == 1:
+			self.filedata = self.filedata[..., 0:-1]
+		
+		self.file_len = self.filedata.shape[-1]
 		
 		return
 	
+	def dtype(self):
+		""" the real dtype we work (and store) in, see self.precision """
+		return fft.precision_dtype(self.precision)
+	
+	def channel_shape(self):
+		""" the shape of the channel axes of the audio & notes, () unless multichannel """
+		return (self.n_channels, ) if self.multichannel else ()
+	
+	def arrange_channels(self, d):
+		""" get audio as read from a wav the way we work on it
+		inputs:
+		d => (samples, ) or (samples, channels) audio
+		
+		return: (channels, samples) audio if multichannel, otherwise mono audio
+		side effects: None
+		"""
+		
+		if not self.multichannel:
+			return self.stereo2mono(d)
+		
+		# channels first so each channel is contiguous for the ffts
+		return np.ascontiguousarray(np.atleast_2d(np.transpose(d)))
+	
 	def stereo2mono(self, d, channel='a'):
 		""" convert stereo audio to mono audio 
 		inputs:
@@ -79,23 +145,31 @@ class decompose:
 		fourier_freqs => fourier freq conversion
 		f => freq we want to find the index of 
 		
-		return: closest index of desired freq
+		return: closest index of desired freq (the lower one on a tie, like argmin)
 		side_effects: none
+		
+		f can also be an array of freqs, giving an array of indices. fourier_freqs has to
+		be sorted, so this is a binary search rather than a scan over the whole fourier
 		"""
-		return np.argmin(np.abs(fourier_freqs - f))
+		
+		f = np.asarray(f)
+		
+		above = np.clip(np.searchsorted(fourier_freqs, f), 1, len(fourier_freqs) - 1)
+		below = above - 1
+		
+		return np.where(f - fourier_freqs[below] <= fourier_freqs[above] - f, below, above)[()]
 	
-	def gauss_select(self, fourier_data, fourier_freqs, octave, noteint):
-		""" select a gaussian set of freqs
+	def gauss_params(self, fourier_freqs, octave, noteint):
+		""" find the centre and width of the gaussian for a note
 		input:
-		fourier_data => array of fourier transformed data 
 		fourier_freqs => what index in fourier_data corresponds to what freq
 		octave, noteint => the specific note we want to select
 		
-		return: selected Fourier data
+		return: (mu, sigma) in fourier indices, or None if we ran off the fourier
 		side_effects: None
 		"""
 		
-		# get the freq of the notedata is now gated
+		# get the freq of the note
 		f = note.note2freq(octave, noteint)
 		
 		# get the freq of the next note in the series
@@ -104,12 +178,30 @@ class decompose:
 		mu = self.freq2index(fourier_freqs, f)
 		muminus1 = self.freq2index(fourier_freqs, fminus1)
 		
-		sigma = self.width * (mu - muminus1)
-		
 		if (mu - muminus1) == 0:
 			# we reached the end of the fourier
+			return None
+		
+		return mu, self.width * (mu - muminus1)
+	
+	def gauss_select(self, fourier_data, fourier_freqs, octave, noteint):
+		""" select a gaussian set of freqs
+		input:
+		fourier_data => array of fourier transformed data 
+		fourier_freqs => what index in fourier_data corresponds to what freq
+		octave, noteint => the specific note we want to select
+		
+		return: selected Fourier data
+		side_effects: None
+		"""
+		
+		params = self.gauss_params(fourier_freqs, octave, noteint)
+		
+		if params is None:
 			return np.nan
 		
+		mu, sigma = params
+		
 		# create a Gaussian with mu = note,  sigma = 0.5*(note+1 - note)
 		g = math_fun.gaussian_max1(self.g_init, mu, sigma)
 		
@@ -119,58 +211,620 @@ class decompose:
 		
 		return ret
 	
-	def decompose(self, filename_out, savetype=0):
+	def note_table(self, fourier_freqs):
+		""" every note in self.octaves that fits on the fourier, worked out all at once
+		and kept until the params or the fourier change
+		input:
+		fourier_freqs => what index in fourier_data corresponds to what freq
+		
+		return: structured array with a row per note of
+		        octave, noteint, freq => the note
+		        mu, sigma => centre and width of its gaussian in fourier indices
+		        start, stop => fourier bins within truncate sigmas (6 if not set) of mu
+		side_effects: caches the table in self.table
+		"""
+		
+		params = (len(fourier_freqs), fourier_freqs[-1], self.octaves, self.noteints, self.width, self.truncate)
+		
+		if self.table is not None and self.table[0] == params:
+			return self.table[1]
+		
+		with instrument.span('decompose.note_table', 'mask'):
+			table = self.build_note_table(fourier_freqs)
+		
+		self.table = (params, table)
+		
+		return table
+	
+	def build_note_table(self, fourier_freqs):
+		""" work out the note table, see note_table """
+		
+		octave, noteint = np.meshgrid(np.arange(*self.octaves), np.arange(self.noteints), indexing='ij')
+		octave = octave.ravel()
+		noteint = noteint.ravel()
+		
+		freq = note.note2freq_array(octave, noteint)
+		
+		mu = self.freq2index(fourier_freqs, freq)
+		muminus1 = self.freq2index(fourier_freqs, note.note2freq_array(octave, noteint - 1))
+		
+		# stop at the first note that is no wider than a bin, we reached the end of the fourier
+		overrun = np.flatnonzero(mu == muminus1)
+		n_notes = overrun[0] if len(overrun) > 0 else len(mu)
+		
+		if n_notes < len(mu):
+			print("overrun bounds, safely stopping at ", octave[n_notes], note.notenames[noteint[n_notes] % 12])
+		
+		table = np.zeros(n_notes,
+		                 dtype=[('octave', np.int32), ('noteint', np.int32), ('freq', np.float64), ('mu', np.int64),
+		                        ('sigma', np.float64), ('start', np.int64), ('stop', np.int64)])
+		
+		table['octave'] = octave[:n_notes]
+		table['noteint'] = noteint[:n_notes]
+		table['freq'] = freq[:n_notes]
+		table['mu'] = mu[:n_notes]
+		table['sigma'] = self.width * (mu[:n_notes] - muminus1[:n_notes])
+		
+		# the same bins math_fun.gaussian_band picks
+		g_init = np.linspace(0, len(fourier_freqs), len(fourier_freqs))
+		truncate = 6 if self.truncate is None else self.truncate
+		table['start'] = np.searchsorted(g_init, table['mu'] - truncate * table['sigma'], side='left')
+		table['stop'] = np.searchsorted(g_init, table['mu'] + truncate * table['sigma'], side='right')
+		
+		return table
+	
+	def note_list(self, fourier_freqs):
+		""" list every note in self.octaves that fits on the fourier
+		input:
+		fourier_freqs => what index in fourier_data corresponds to what freq
+		
+		return: list of (octave, noteint, mu, sigma)
+		side_effects: see note_table
+		"""
+		
+		table = self.note_table(fourier_freqs)
+		
+		return list(zip(table['octave'].tolist(), table['noteint'].tolist(), table['mu'].tolist(),
+		                table['sigma'].tolist()))
+	
+	def gauss_block(self, fourier_data, notes):
+		""" select a block of notes at once, one row per note
+		input:
+		fourier_data => array of fourier transformed data, any leading axes are channels
+		notes => list of (octave, noteint, mu, sigma) from note_list
+		
+		return: array of selected Fourier data (note, channels..., freq)
+		side_effects: None
+		"""
+		
+		g = np.empty((len(notes), len(self.g_init)), dtype=self.dtype())
+		
+		# one gaussian per row, worked out in double (the positions need it) but only
+		# ever held in our precision
+		with instrument.span('decompose.masks', 'mask', notes=len(notes)):
+			for row, (_, _, mu, sigma) in zip(g, notes):
+				row[:] = math_fun.gaussian_max1(self.g_init, mu, sigma)
+		
+		# the same gaussian for every channel
+		g = g.reshape(g.shape[:1] + (1, ) * (fourier_data.ndim - 1) + g.shape[1:])
+		
+		return fourier_data[np.newaxis] * g
+	
+	def gauss_band(self, mu, sigma, truncate):
+		""" math_fun.gaussian_band with the weights in our precision """
+		
+		start, stop, weights = math_fun.gaussian_band(self.g_init, mu, sigma, truncate)
+		
+		return start, stop, weights.astype(self.dtype())
+	
+	def gauss_bands(self, notes):
+		""" compact support masks for a list of notes, see math_fun.gaussian_band for the
+		error bound that self.truncate gives
+		input:
+		notes => list of (octave, noteint, mu, sigma) from note_list
+		
+		return: list of (start, stop, weights), one per note
+		side_effects: None
+		"""
+		
+		with instrument.span('decompose.masks', 'mask', notes=len(notes)):
+			return [self.gauss_band(mu, sigma, self.truncate) for (_, _, mu, sigma) in notes]
+	
+	def band_block(self, fourier_data, bands):
+		""" select a block of notes using only the band of each gaussian
+		
+		only the mask multiply scales with the bandwidth here. The block is still full
+		length (0 outside each band) because savetype 0 & 1 notes are, so the memory and
+		the inverse fft of note_block still grow with the file. For notes that stay
+		band sized all the way to storage & summing use savetype 2 (see iter_bands)
+		
+		input:
+		fourier_data => array of fourier transformed data, any leading axes are channels
+		bands => list of (start, stop, weights) from gauss_bands
+		
+		return: array of selected Fourier data (note, channels..., freq), 0 outside each band
+		side_effects: None
+		"""
+		
+		block = np.zeros((len(bands), ) + fourier_data.shape, dtype=fourier_data.dtype)
+		
+		for row, (start, stop, weights) in zip(block, bands):
+			row[..., start:stop] = fourier_data[..., start:stop] * weights
+		
+		return block
+	
+	def spectrum(self):
+		""" fourier transform the audio
+		
+		return: (fourier_data, fourier_freqs)
+		side_effects: sets up self.g_init for the gaussians
+		"""
 		
 		# ------ fft transform -------#
-		fourier_data = fft.rfft(self.filedata, threads=self.n_cpu, overwrite_input=True)
+		fourier_data = fft.rfft(np.asarray(self.filedata, dtype=self.dtype()),
+		                        threads=self.n_cpu,
+		                        overwrite_input=True)
 		
 		# convert samples per second to a list of freqs
-		fourier_freqs = np.fft.rfftfreq(len(self.filedata), 1 / self.sample_rate)
+		fourier_freqs = np.fft.rfftfreq(self.file_len, 1 / self.sample_rate)
 		# ------ fft transform -------#
 		
-		fp = h5py.File(filename_out + '.hdf5', 'w', libver='latest')
+		# prevent re-generating gaussian space every time
+		self.g_init = np.linspace(0, len(fourier_freqs), len(fourier_freqs))
 		
-		# save some metadata
-		fp.create_dataset('meta',
-		                  data=[savetype, self.sample_rate,
-		                        len(self.filedata),
-		                        len(fourier_data)],
-		                  dtype=int)
+		return fourier_data, fourier_freqs
+	
+	def iter_blocks(self, savetype=0):
+		""" decompose the audio, handing back batch_size notes at a time
+		inputs:
+		savetype => 0 real data, 1 fourier data
 		
-		# prevent re-generating gaussian space every time
-		self.g_init = np.linspace(0, len(fourier_data), len(fourier_data))
+		yield: (keys, (len(keys) x samples) block of notes) where keys look like '4-C#'
+		       (len(keys) x channels x samples) if multichannel
+		side_effects: None
+		"""
 		
-		# for each note do:
-		for octave in range(*self.octaves):
-			for noteint in range(self.noteints):
-				
-				# select the note we want to look at
-				selected_note = self.gauss_select(fourier_data, fourier_freqs, octave, noteint)
-				
-				if selected_note is np.nan:
-					break
-				
-				if savetype == 0:
-					# inverse fft to convert back to real
-					newdata = fft.irfft(selected_note, threads=self.n_cpu, overwrite_input=True)
-				
-				elif savetype == 1:
-					# just save the fft data
-					newdata = selected_note
+		if savetype not in (0, 1):
+			raise Exception("No idea how to handle savetype" + str(savetype))
+		
+		fourier_data, fourier_freqs = self.spectrum()
+		
+		notes = self.note_list(fourier_freqs)
+		
+		workers, threads = parallel.split_cpus(self.n_cpu, self.workers)
+		
+		if workers > 1:
+			# same batches, but worked out over a process pool
+			job = note_job(self, fourier_data, notes, savetype, 2 * workers)
+			
+			# a worker per slot at most, if memory is that tight
+			workers = min(workers, job.n_slots)
+			
+			try:
+				for task, slot, batch in parallel.ordered_map(job, job.n_tasks(), workers, threads, job.n_slots):
+					yield self.note_keys(batch), np.array(job.slots.array[slot, :len(batch)])
+			
+			finally:
+				job.close()
+			
+			return
+		
+		# work through the notes batch_size at a time so memory stays bounded
+		for i in range(0, len(notes), self.batch_size):
+			batch = notes[i:i + self.batch_size]
+			
+			yield self.note_keys(batch), self.note_block(fourier_data, batch, savetype)
+	
+	def note_keys(self, notes):
+		""" keys like '4-C#' for a list of (octave, noteint, mu, sigma) """
+		return [note.note2key(octave, noteint) for octave, noteint, mu, sigma in notes]
+	
+	def note_block(self, fourier_data, batch, savetype=0):
+		""" decompose a batch of notes out of the spectrum
+		inputs:
+		fourier_data => array of fourier transformed data
+		batch => list of (octave, noteint, mu, sigma) from note_list
+		savetype => 0 real data, 1 fourier data
+		
+		return: (len(batch) x samples) block of notes, (len(batch) x channels x samples)
+		        if multichannel
+		side_effects: None
+		"""
+		
+		instrument.count('notes_decomposed', len(batch))
+		
+		# select the notes we want to look at
+		if self.truncate is None:
+			selected_notes = self.gauss_block(fourier_data, batch)
+		else:
+			selected_notes = self.band_block(fourier_data, self.gauss_bands(batch))
+		
+		if savetype == 0:
+			# one batched inverse fft over every row to convert back to real
+			return fft.irfft(selected_notes, axis=-1, threads=self.n_cpu, overwrite_input=True)
+		
+		# just save the fft data
+		return selected_notes
+	
+	def iter_notes(self, savetype=0):
+		""" decompose the audio, handing back one note at a time
+		inputs:
+		savetype => 0 real data, 1 fourier data
+		
+		yield: (key, note data) where key looks like '4-C#'
+		side_effects: None
+		"""
+		
+		for keys, newdata in self.iter_blocks(savetype):
+			for key, row in zip(keys, newdata):
+				yield key, row
+	
+	def iter_bands(self):
+		""" decompose the audio into band limited notes (savetype 2)
+		
+		each note only keeps the fourier bins under its truncated gaussian (self.truncate,
+		or 6 sigma if that isnt set) and inverse transforms just those. That gives the
+		note shifted down by its start bin and decimated to stop - start samples, scaled
+		by 2 * (stop - start) / file_len so it is the complex envelope of the note.
+		note_recompose.save_prep brings back the bins that were kept, so how close that
+		gets to the savetype 0 note depends on the truncation: with self.truncate set
+		savetype 0 keeps the same bins and they agree to rounding (~1e-15 of the peak),
+		with it unset savetype 0 keeps the whole gaussian and the 6 sigma tail that is
+		dropped here is the difference (~1e-8 of the peak)
+		
+		yield: (key, baseband note, start, stop) where start:stop are the bins kept
+		side_effects: None
+		"""
+		
+		truncate = 6 if self.truncate is None else self.truncate
+		
+		fourier_data, fourier_freqs = self.spectrum()
+		
+		for octave, noteint, mu, sigma in self.note_list(fourier_freqs):
+			start, stop, weights = self.gauss_band(mu, sigma, truncate)
+			
+			newdata = fft.ifft(fourier_data[..., start:stop] * weights, axis=-1, threads=self.n_cpu)
+			newdata *= 2 * (stop - start) / self.file_len
+			
+			instrument.count('notes_decomposed')
+			
+			yield note.note2key(octave, noteint), newdata, start, stop
+	
+	def decimation(self, stop):
+		""" the most the audio can be decimated by (a power of 2) and still hold fourier
+		bins up to stop, with the nyquist bin left empty
+		inputs:
+		stop => one past the highest fourier bin we need
+		
+		return: decimation factor
+		side_effects: None
+		"""
+		
+		factor = 1
+		
+		# the decimated audio needs to stay an even length for the rfft
+		while self.file_len % (4 * factor) == 0 and stop <= self.file_len // (4 * factor):
+			factor *= 2
+		
+		return factor
+	
+	def iter_pyramid(self):
+		""" decompose the audio into real notes at their own sample rates (savetype 3)
+		
+		each octave is worked out at the lowest sample rate (halving each time) whose
+		fourier still holds every band in the octave, truncated the same way as in
+		iter_bands. We already have the whole spectrum, so decimating by a factor is just
+		keeping the first file_len // factor // 2 + 1 bins: an ideal anti-alias filter
+		for free. The inverse ffts shrink by half each octave down, so the low octaves
+		cost next to nothing. note_recompose.upsample puts a note back to the full rate
+		
+		yield: (key, note at its own rate, start, stop, decimation) where start:stop are
+		       the bins kept and the note is file_len // decimation samples long (along
+		       the last axis)
+		side_effects: None
+		"""
+		
+		truncate = 6 if self.truncate is None else self.truncate
+		
+		fourier_data, fourier_freqs = self.spectrum()
+		
+		notes = self.note_list(fourier_freqs)
+		
+		for octave in sorted(set(n[0] for n in notes)):
+			octave_notes = [n for n in notes if n[0] == octave]
+			bands = [self.gauss_band(mu, sigma, truncate) for (_, _, mu, sigma) in octave_notes]
+			
+			factor = min(self.decimation(stop) for start, stop, weights in bands)
+			native_len = self.file_len // factor
+			
+			block = np.zeros((len(bands), ) + self.channel_shape() + (native_len // 2 + 1, ),
+			                 dtype=fourier_data.dtype)
+			for row, (start, stop, weights) in zip(block, bands):
+				row[..., start:stop] = fourier_data[..., start:stop] * weights
+			
+			# keeping the bins scales the audio up by factor, so undo that
+			newdata = fft.irfft(block, n=native_len, axis=-1, threads=self.n_cpu, overwrite_input=True)
+			newdata /= factor
+			
+			instrument.count('notes_decomposed', len(bands))
+			
+			for key, row, (start, stop, weights) in zip(self.note_keys(octave_notes), newdata, bands):
+				yield key, row, start, stop, factor
+	
+	def note_writer(self, filename_out, savetype):
+		""" open a note_store.note_writer using our storage settings """
+		return note_store.note_writer(filename_out,
+		                              savetype,
+		                              self.sample_rate,
+		                              self.file_len,
+		                              layout=self.store_layout,
+		                              compression=self.compression,
+		                              chunks=self.store_chunks,
+		                              channels=self.n_channels if self.multichannel else None)
+	
+	def decompose(self, filename_out, savetype=0):
+		""" decompose the audio into notes and save them to an hdf5 file
+		inputs:
+		filename_out => hdf5 file we want to write to (without the extension)
+		savetype => 0 real data, 1 fourier data, 2 band limited complex envelope,
+		            3 real data at the lowest sample rate that still holds the note
+		
+		return: None
+		side_effects: generate hdf5 file in filesystem
+		"""
+		
+		store = self.note_writer(filename_out, savetype)
+		
+		# save our decomposition
+		with instrument.span('decompose.decompose', 'decompose', savetype=savetype):
+			if savetype == 2:
+				for key, newdata, start, stop in self.iter_bands():
+					store.append(key, newdata, band=(start, stop))
+			
+			elif savetype == 3:
+				for key, newdata, start, stop, factor in self.iter_pyramid():
+					store.append(key, newdata, band=(start, stop))
+			
+			else:
+				for key, newdata in self.iter_notes(savetype):
+					store.append(key, newdata)
+		
+		# cleanup
+		store.close()
+		
+		return
+	
+	def precision_report(self):
+		""" decompose (savetype 0) in both single and double precision and measure how
+		far the single precision notes are from the double ones
+		
+		return: dict of
+		        max_abs => biggest difference in any sample of any note
+		        max_rel => max_abs over the biggest sample of any note
+		        snr_db => signal to error ratio over every note, in dB
+		        worst_note, worst_snr_db => the note with the lowest snr, and its snr
+		        time_single, time_double => seconds spent decomposing in each precision
+		        bytes_single, bytes_double => size of the decomposition in each precision
+		side_effects: None
+		"""
+		
+		single = copy.copy(self)
+		single.precision = 'single'
+		double = copy.copy(self)
+		double.precision = 'double'
+		
+		report = {'max_abs': 0.0, 'max_rel': 0.0, 'worst_note': None, 'worst_snr_db': np.inf,
+		          'time_single': 0.0, 'time_double': 0.0, 'bytes_single': 0, 'bytes_double': 0}
+		peak = 0.0
+		signal_power = 0.0
+		error_power = 0.0
+		
+		blocks_single = single.iter_blocks(0)
+		blocks_double = double.iter_blocks(0)
+		
+		while True:
+			start = time.time()
+			keys, block_double = next(blocks_double, (None, None))
+			report['time_double'] += time.time() - start
+			
+			start = time.time()
+			keys, block_single = next(blocks_single, (None, None))
+			report['time_single'] += time.time() - start
+			
+			if keys is None:
+				break
+			
+			report['bytes_single'] += block_single.nbytes
+			report['bytes_double'] += block_double.nbytes
+			
+			error = block_single - block_double
+			report['max_abs'] = max(report['max_abs'], float(np.max(np.abs(error))))
+			peak = max(peak, float(np.max(np.abs(block_double))))
+			
+			note_power = np.sum(block_double**2, axis=-1)
+			note_error = np.sum(error**2, axis=-1)
+			signal_power += float(np.sum(note_power))
+			error_power += float(np.sum(note_error))
+			
+			note_snr = 10 * np.log10(note_power / np.maximum(note_error, np.finfo(float).tiny))
+			
+			# a note is only as good as its worst channel
+			note_snr = np.min(note_snr.reshape(len(keys), -1), axis=-1)
+			worst = int(np.argmin(note_snr))
+			if note_snr[worst] < report['worst_snr_db']:
+				report['worst_note'] = keys[worst]
+				report['worst_snr_db'] = float(note_snr[worst])
+		
+		report['max_rel'] = report['max_abs'] / peak if peak > 0 else 0.0
+		report['snr_db'] = float(10 * np.log10(signal_power / max(error_power, np.finfo(float).tiny)))
+		
+		return report
+	
+	def read_block(self, start, stop):
+		""" read a block of audio, zero padding anything outside the file
+		inputs:
+		start, stop => sample range we want (can run off either end of the file)
+		
+		return: mono audio of length stop - start, (channels, stop - start) if multichannel
+		side_effects: None
+		"""
+		
+		block = np.zeros(self.channel_shape() + (stop - start, ))
+		
+		lo = max(start, 0)
+		hi = min(stop, self.file_len)
+		
+		if hi > lo:
+			block[..., lo - start:hi - start] = self.arrange_channels(self.filedata[lo:hi])
+		
+		return block
+	
+	def decompose_stream(self, filename_out):
+		""" same as decompose (savetype 0) but never holds more than a few frames of
+		audio in memory. The audio is cut into hann windowed frames of self.block_len
+		overlapping by half, each frame goes through the same gaussian note selection
+		and the notes are overlap-added back together and written out a hop at a time
+		
+		self.block_len needs to be long enough to resolve the lowest octave, notes that
+		dont fit on the frame fourier are dropped the same way as in decompose
+		
+		inputs:
+		filename_out => hdf5 file we want to write to (without the extension)
+		
+		return: None
+		side_effects: generate hdf5 file in filesystem
+		"""
+		
+		hop = self.block_len // 2
+		
+		# periodic hann windows at half overlap sum to exactly 1
+		window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(self.block_len) / self.block_len)
+		window = window.astype(self.dtype())
+		
+		# all the frames share one fourier so the masks only get built once
+		fourier_freqs = np.fft.rfftfreq(self.block_len, 1 / self.sample_rate)
+		self.g_init = np.linspace(0, len(fourier_freqs), len(fourier_freqs))
+		
+		notes = self.note_list(fourier_freqs)
+		
+		store = self.note_writer(filename_out, 0)
+		store.allocate([note.note2key(octave, noteint) for octave, noteint, mu, sigma in notes], self.dtype())
+		
+		# overlap-add buffer, the first hop of it is finished after every frame
+		acc = np.zeros((len(notes), ) + self.channel_shape() + (self.block_len, ), dtype=self.dtype())
+		
+		# start a hop before the file so the first samples see two windows too
+		for start in range(-hop, self.file_len, hop):
+			
+			with instrument.span('decompose.read', 'io'):
+				frame = self.read_block(start, start + self.block_len)
+			
+			instrument.count('bytes_read', frame.nbytes)
+			
+			fourier_data = fft.rfft(frame.astype(self.dtype()) * window, threads=self.n_cpu, overwrite_input=True)
+			
+			for i in range(0, len(notes), self.batch_size):
+				batch = notes[i:i + self.batch_size]
 				
+				if self.truncate is None:
+					selected_notes = self.gauss_block(fourier_data, batch)
 				else:
-					raise Exception("No idea how to handle savetype" + savetype)
+					selected_notes = self.band_block(fourier_data, self.gauss_bands(batch))
 				
-				# save our decomposition
-				fp.create_dataset(str(octave) + '-' + note.notenames[noteint],
-				                  data=newdata,
-				                  dtype=newdata.dtype)
+				acc[i:i + len(batch)] += fft.irfft(selected_notes, axis=-1, threads=self.n_cpu, overwrite_input=True)
 			
-			if selected_note is np.nan:
-				print("overrun bounds, safely stopping at ", octave, note.notenames[noteint])
-				break
+			# write out the finished hop
+			lo = max(start, 0)
+			hi = min(start + hop, self.file_len)
+			if hi > lo:
+				store.write_block(lo, hi, acc[..., lo - start:hi - start])
+			
+			# shift the buffer along a hop
+			acc[..., :hop] = acc[..., hop:2 * hop]
+			acc[..., hop:] = 0
 		
 		# cleanup
-		fp.close()
+		store.close()
+		
+		return
+
+
+class note_job:
+	""" parallel.ordered_map job working out batches of notes: the spectrum sits in a
+	shared array and each task writes its block of notes into an output slot """
+	
+	def __init__(self, nde_class, fourier_data, notes, savetype, n_slots):
+		""" inputs:
+		nde_class => decompose with its params set (and spectrum already run)
+		fourier_data => the spectrum
+		notes => list of (octave, noteint, mu, sigma) from note_list
+		savetype => 0 real data, 1 fourier data
+		n_slots => output slots wanted, self.n_slots is how many there are once cut down
+		           to what fits in shared memory, and is what ordered_map needs to use
+		
+		return: None
+		side_effects: makes shared arrays, close removes them
+		"""
+		
+		# the workers only need the spectrum, not the audio
+		self.nde_class = copy.copy(nde_class)
+		self.nde_class.filedata = None
+		
+		self.notes = notes
+		self.savetype = savetype
+		self.threads = 1
+		
+		self.spectrum = parallel.shared_array.copy_of(fourier_data)
+		
+		slot_bytes = int(np.prod(self.slot_shape(1))) * np.dtype(self.slot_dtype()).itemsize
+		self.n_slots = parallel.fit_slots(n_slots, slot_bytes)
+		self.slots = parallel.shared_array(self.slot_shape(self.n_slots), self.slot_dtype())
+		
+		return
+	
+	def slot_shape(self, n_slots):
+		""" shape of the output slots """
+		
+		if self.savetype == 0:
+			row_len = self.nde_class.file_len
+		else:
+			row_len = self.spectrum.shape[-1]
+		
+		return (n_slots, self.nde_class.batch_size) + self.nde_class.channel_shape() + (row_len, )
+	
+	def slot_dtype(self):
+		""" dtype of the output slots """
+		return fft.real_dtype(self.spectrum.dtype) if self.savetype == 0 else self.spectrum.dtype
+	
+	def n_tasks(self):
+		""" number of batches """
+		return int(np.ceil(len(self.notes) / self.nde_class.batch_size))
+	
+	def batch(self, task):
+		""" the notes of one task """
+		return self.notes[task * self.nde_class.batch_size:(task + 1) * self.nde_class.batch_size]
+	
+	def block(self, task):
+		""" work out the notes of one task """
+		
+		self.nde_class.n_cpu = self.threads
+		
+		return self.nde_class.note_block(self.spectrum.array, self.batch(task), self.savetype)
+	
+	def run(self, task, slot):
+		""" work out a batch of notes into slot
 		
+		return: the batch
+		side_effects: fills in the slot
+		"""
+		
+		batch = self.batch(task)
+		self.slots.array[slot, :len(batch)] = self.block(task)
+		
+		return batch
+	
+	def close(self):
+		""" cleanup """
+		self.spectrum.close()
+		self.slots.close()
 		return
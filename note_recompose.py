@@ -3,18 +3,28 @@
 import numpy as np
 from scipy.io import wavfile
 import fft_wrapper as fft
-import h5py
+import note_store
+import wav_stream
+import instrument
 import os
+import tempfile
+import h5py
+from concurrent.futures import ThreadPoolExecutor
 
 
-def save_prep(key_data, n_cpu, save_type):
+def save_prep(key_data, n_cpu, save_type, file_len=None, band=None):
 	""" this fuction preps the data for saving to a wav file 
-	This is only needed in case the data is save_type = 1
+	This is only needed in case the data is save_type = 1, 2 or 3
 	
 	inputs:
 	key_data => data from the hdf5 file
 	n_cpu => cpu cores to use when using pyfftw
-	save_type => was the data saved in real or fourier form
+	save_type => was the data saved in real, fourier, band limited or decimated form
+	file_len => length of the real data (from the meta key)
+	band => (start, stop) fourier bins of a save_type 2 note
+	
+	everything works along the last axis, so multichannel notes come back with their
+	channels in front of the samples
 	
 	outputs:
 	return => data in real form
@@ -27,57 +37,454 @@ def save_prep(key_data, n_cpu, save_type):
 	
 	elif save_type == 1:
 		# saved in fourier form, convert to real & return
-		return fft.ifft(key_data, threads=n_cpu, overwrite_input=True)
+		# every note is the same length so they all share one fft plan
+		return fft.irfft(key_data, n=file_len, threads=n_cpu)
+	
+	elif save_type == 2:
+		# saved as a decimated complex envelope, put the bins back where they came from
+		start, stop = band
+		fourier_data = np.zeros(key_data.shape[:-1] + (file_len // 2 + 1, ),
+		                        dtype=fft.complex_dtype(key_data.dtype))
+		fourier_data[..., start:stop] = band2fourier(key_data, n_cpu, file_len)
+		return fft.irfft(fourier_data, n=file_len, threads=n_cpu)
+	
+	elif save_type == 3:
+		# saved at a lower sample rate, bring it back up
+		return upsample(key_data, n_cpu, file_len)
 	
 	else:
 		# something horrid happened
 		raise Exception("No idea how to handle save_type" + save_type)
 
 
-def recompose(in_file, out_file='out.wav', compose_to='combine'):
+def band2fourier(key_data, n_cpu, file_len):
+	""" turn a save_type 2 note back into the fourier bins it came from
+	
+	inputs:
+	key_data => data from the hdf5 file
+	n_cpu => cpu cores to use when using pyfftw
+	file_len => length of the real data (from the meta key)
+	
+	outputs:
+	return => fourier data for bins start:stop of the band
+	side_effects => None
+	"""
+	
+	# undo the scaling from decompose.iter_bands
+	return fft.fft(key_data, axis=-1, threads=n_cpu) * (file_len / (2 * key_data.shape[-1]))
+
+
+def decimated2fourier(key_data, n_cpu, file_len):
+	""" turn a save_type 3 note back into the fourier bins it came from
+	
+	inputs:
+	key_data => data from the hdf5 file
+	n_cpu => cpu cores to use when using pyfftw
+	file_len => length of the real data (from the meta key)
+	
+	outputs:
+	return => fourier data for the first key_data.shape[-1] // 2 + 1 bins
+	side_effects => None
+	"""
+	
+	# undo the scaling from decompose.iter_pyramid
+	return fft.rfft(key_data, axis=-1, threads=n_cpu) * (file_len // key_data.shape[-1])
+
+
+def upsample(key_data, n_cpu, file_len):
+	""" bring a save_type 3 note back up to the full sample rate, by zero padding its
+	fourier (exact, as the note has nothing above its own nyquist)
+	
+	inputs:
+	key_data => data from the hdf5 file
+	n_cpu => cpu cores to use when using pyfftw
+	file_len => length of the real data (from the meta key)
+	
+	outputs:
+	return => the note at the full sample rate
+	side_effects => None
+	"""
+	
+	fourier_data = decimated2fourier(key_data, n_cpu, file_len)
+	
+	return fft.irfft(fourier_data, n=file_len, threads=n_cpu)
+
+
+def fourier_sum(fp, n_cpu, chunk=16):
+	""" sum the notes of a save_type 1, 2 or 3 file while they are still in fourier form,
+	the transform is linear so this only needs one inverse fft at the end instead of one
+	per note. Every note is read exactly once, chunk notes at a time
+	
+	inputs:
+	fp => note_store.note_reader of the file
+	n_cpu => cpu cores to use when using pyfftw
+	chunk => how many save_type 1 notes to read in one go
+	
+	outputs:
+	return => the summed notes in real form, (channels, samples) if multichannel
+	side_effects => None
+	"""
+	
+	# sum in the precision the notes were stored in
+	fourier_data = np.zeros(fp.channel_shape() + (fp.fourier_len, ), dtype=fft.complex_dtype(fp.dtype))
+	
+	if fp.savetype == 1:
+		for i in range(0, len(fp), chunk):
+			fourier_data += np.sum(fp.read_rows(i, i + chunk), axis=0)
+	
+	elif fp.savetype == 2:
+		for key in fp.keys():
+			start, stop = fp.band(key)
+			fourier_data[..., start:stop] += band2fourier(fp[key], n_cpu, fp.file_len)
+	
+	elif fp.savetype == 3:
+		for key in fp.keys():
+			note_fourier = decimated2fourier(fp[key], n_cpu, fp.file_len)
+			fourier_data[..., :note_fourier.shape[-1]] += note_fourier
+	
+	else:
+		raise Exception("fourier_sum only works on save_type 1, 2 or 3, not " + str(fp.savetype))
+	
+	return fft.irfft(fourier_data, n=fp.file_len, axis=-1, threads=n_cpu)
+
+
+def normalise(data):
+	""" scale the summed notes ready for writing to a wav
+	
+	inputs:
+	data => summed notes
+	
+	outputs:
+	return => data scaled to a peak of 1
+	side_effects => None
+	"""
+	
+	# TODO fix scaling
+	return (np.real(data) + np.imag(data)) / np.max((np.real(data) + np.imag(data)))
+
+
+def write_notes(fp, n_cpu, workers=4):
+	""" save each note as a seperate wav file, the reads & ffts happen here and the
+	wav writing happens on a pool of threads. At most workers notes are held in memory
+	
+	inputs: fp, note_store.note_reader of the file
+	        n_cpu, cpu cores to use when using pyfftw
+	        workers, how many wav files to write at once
+	
+	return: None
+	side_effects: generate a wav file per note in filesystem
+	"""
+	
+	with ThreadPoolExecutor(workers) as pool:
+		pending = []
+		
+		for key in fp.keys():
+			save_data = save_prep(fp[key], n_cpu, fp.savetype, fp.file_len, fp.band(key))
+			save_data = (np.real(save_data) + np.imag(save_data))
+			instrument.count('notes_recomposed')
+			instrument.count('bytes_written', save_data.nbytes)
+			
+			# wavs want the channels last
+			pending.append(pool.submit(wavfile.write, key + '.wav', fp.sample_rate, save_data.T))
+			
+			# dont let the notes waiting to be written pile up
+			if len(pending) >= workers:
+				pending.pop(0).result()
+		
+		for job in pending:
+			job.result()
+	
+	return
+
+
+def recompose(in_file, out_file='out.wav', compose_to='combine', chunk=16, block_len=None, workers=4):
 	""" recompose a file from a bunch of diffrent decomposed notes 
 	NOTE: not in the decompose class, but resides in the same file
 	
+	save_type 0 files are summed and written a block of samples at a time, then
+	normalised in place, so memory use doesnt grow with the length of the file.
+	Multichannel files give a wav with the same number of channels
+	
 	inputs: in_file, hdf5 file we want to recompose
 	        out_file, wav file we want to write to
+	        chunk, notes to sum at once when combining save_type 1 files
+	        block_len, samples to sum at once (defaults to the hdf5 chunk length)
+	        workers, wav files to write at once when compose_to='all'
 	
 	return: None
 	side_effects: generate wav file in filesystem
 	"""
 	
-	fp = h5py.File(in_file + '.hdf5', 'r', libver='latest')
+	fp = note_store.note_reader(in_file)
 	
-	# metadata key
-	save_type, sample_rate, file_len, fourier_len = fp['meta']
+	# metadata
+	save_type, sample_rate, file_len = fp.savetype, fp.sample_rate, fp.file_len
 	
 	# init some variables
 	n_cpu = os.cpu_count()
-	data = np.zeros(file_len)
 	
-	for key in list(fp.keys()):
-		# skip over the meta key
-		if key == 'meta':
-			continue
+	if compose_to != 'combine':
+		write_notes(fp, n_cpu, workers)
+		fp.close()
+		return
+	
+	if block_len is None:
+		if fp.layout == 'table' and save_type == 0:
+			block_len = fp.notes.chunks[-1]
+		else:
+			block_len = 2**16
+	
+	if save_type in (1, 2, 3):
+		# sum in fourier space, one ifft in total
+		with instrument.span('recompose.fourier_sum', 'recompose', savetype=save_type):
+			data = fourier_sum(fp, n_cpu, chunk)
+	
+	instrument.count('notes_recomposed', len(fp))
+	
+	out = wav_stream.wav_writer(out_file,
+	                            sample_rate,
+	                            channels=max(fp.channels, 1),
+	                            dtype=fft.real_dtype(fp.dtype))
+	
+	# .T puts the channels (if there are any) last, the way wavs interleave them
+	for lo in range(0, file_len, block_len):
+		if save_type == 0:
+			# sum this block of every note
+			block = fp.time_slice(lo, lo + block_len)
+			
+			with instrument.span('recompose.sum', 'recompose', samples=block.shape[-1]):
+				block = np.sum(block, axis=0).T
+		else:
+			block = data[..., lo:lo + block_len].T
 		
-		if compose_to == 'combine':
-			# convert to real & sum
-			data += save_prep(np.real(fp[key]) + np.imag(fp[key]), n_cpu, save_type)
+		with instrument.span('recompose.write', 'io'):
+			out.write(block)
 		
-		else:
-			# save each key as a seperate wav file depending on the note
-			save_data = save_prep(fp[key], n_cpu, save_type)
-			save_data = (np.real(save_data) + np.imag(save_data))
-			wavfile.write(key + '.wav', sample_rate, save_data)
+		instrument.count('bytes_written', block.nbytes)
+	
+	out.close()
 	
-	if compose_to == 'combine':
-		# save the summation of the data
-		# TODO fix scaling
-		save_data = (np.real(data) + np.imag(data)) / np.max((np.real(data) + np.imag(data)))
-		wavfile.write(out_file, sample_rate, save_data)
+	# save the summation of the data, scaled the same way as normalise
+	with instrument.span('recompose.normalise', 'io'):
+		out.divide(out.max)
+	
+	fp.close()
 	
 	return
 
 
+class incremental_mix:
+	""" the sum of a set of notes that can be changed a note at a time. Each note's
+	contribution (in real form) is kept alongside the running mix, so changing a note
+	takes the old contribution off and puts the new one on, and costs the same however
+	many notes there are
+	
+	nothing looks at the data to tell whether a note changed (that would cost as much
+	as adding it). Instead each note can carry a fingerprint of whatever made it, the
+	gate settings used on it say. A note handed back with the fingerprint it already
+	has is skipped without touching its data, and changed(key, fingerprint) lets a
+	tuning loop skip gating it in the first place, so a refresh costs time in the
+	number of notes that changed rather than the number of notes
+	
+		for key in mix.keys():
+			if mix.changed(key, settings[key]):
+				mix.update(key, gate(notes[key], settings[key]), settings[key])
+	
+	every change leaves a little rounding in the mix, resum adds the notes up again
+	from scratch to clear it
+	
+	keeping every contribution costs notes x channels x file_len x itemsize, which for
+	a long file over many octaves is far more than the mix itself. on_disk keeps them
+	in a temporary hdf5 file instead (removed by close), so memory is just the mix and
+	an update reads the old contribution back from disk to take it off
+	"""
+	
+	def __init__(self, sample_rate, file_len, channels=0, dtype=np.float64, on_disk=False):
+		""" an empty mix
+		inputs:
+		sample_rate, file_len => of the audio
+		channels => channels of multichannel notes, 0 => notes have no channel axis
+		dtype => real dtype to sum in
+		on_disk => keep the contributions in a temporary file rather than in memory
+		
+		return: None
+		side_effects: on_disk makes a temporary file, close removes it
+		"""
+		
+		self.sample_rate = sample_rate
+		self.file_len = file_len
+		self.channels = channels
+		
+		shape = ((channels, ) if channels else ()) + (file_len, )
+		self.data = np.zeros(shape, dtype=dtype)
+		
+		# key => contribution, a dict or an hdf5 file with a dataset per note
+		self.filename = None
+		if on_disk:
+			fd, self.filename = tempfile.mkstemp(prefix='incremental_mix.', suffix='.hdf5')
+			os.close(fd)
+			self.notes = h5py.File(self.filename, 'w')
+		else:
+			self.notes = {}
+		
+		# key => fingerprint of what made the contribution (or None), in the order added
+		self.fingerprints = {}
+		
+		self.changes = 0  # notes changed since the mix was last summed from scratch
+		
+		return
+	
+	@classmethod
+	def from_file(cls, in_file, n_cpu=None, fingerprint=None, on_disk=False):
+		""" a mix of every note of a decomposition
+		inputs:
+		in_file => hdf5 file (without the extension) or an open note_store.note_reader
+		n_cpu => cpu cores to use when using pyfftw, None => all of them
+		fingerprint => fingerprint to give every note, see update
+		on_disk => see incremental_mix
+		
+		return: incremental_mix
+		side_effects: None
+		"""
+		
+		fp = in_file if isinstance(in_file, note_store.note_reader) else note_store.note_reader(in_file)
+		n_cpu = os.cpu_count() if n_cpu is None else n_cpu
+		
+		mix = cls(fp.sample_rate, fp.file_len, fp.channels, fft.real_dtype(fp.dtype), on_disk)
+		
+		for key in fp.keys():
+			mix.update(key, save_prep(fp[key], n_cpu, fp.savetype, fp.file_len, fp.band(key)), fingerprint)
+		
+		if fp is not in_file:
+			fp.close()
+		
+		return mix
+	
+	def changed(self, key, fingerprint):
+		""" whether a note made with fingerprint would change the mix, always True for a
+		note that isnt in the mix or a fingerprint of None """
+		return fingerprint is None or key not in self.fingerprints or self.fingerprints[key] != fingerprint
+	
+	def contribution(self, key):
+		""" what a note adds to the mix """
+		return self.notes[key][...] if self.filename is not None else self.notes[key]
+	
+	def update(self, key, data, fingerprint=None):
+		""" set a note, adding it if it is new
+		inputs:
+		key => note name like '4-C#'
+		data => the note in real form (see save_prep), (channels, samples) if
+		        multichannel
+		fingerprint => anything comparable standing for what made data (gate settings,
+		               a version number ...), None => always treat the note as changed
+		
+		return: True if the mix changed, False if the note already had fingerprint
+		side_effects: updates the mix
+		"""
+		
+		if not self.changed(key, fingerprint):
+			return False
+		
+		instrument.count('notes_recomposed')
+		
+		with instrument.span('recompose.update', 'recompose', key=key):
+			contribution = np.real(data).astype(self.data.dtype)
+			
+			if contribution.shape != self.data.shape:
+				raise Exception("note " + key + " is " + str(contribution.shape) + ", the mix is " +
+				                str(self.data.shape))
+			
+			if key in self.fingerprints:
+				self.data -= self.contribution(key)
+			
+			self.data += contribution
+			
+			if self.filename is not None and key in self.fingerprints:
+				self.notes[key][...] = contribution
+			else:
+				self.notes[key] = contribution
+		
+		self.fingerprints[key] = fingerprint
+		self.changes += 1
+		
+		return True
+	
+	def update_many(self, notes, fingerprints=None):
+		""" update from an iterable of (key, data), or a dict
+		inputs:
+		notes => the notes, only the changed ones need to be given
+		fingerprints => dict of key => fingerprint (see update), None => every note
+		                given is treated as changed
+		
+		return: the number of notes that changed
+		side_effects: updates the mix
+		"""
+		
+		if isinstance(notes, dict):
+			notes = notes.items()
+		
+		if fingerprints is None:
+			fingerprints = {}
+		
+		return sum(self.update(key, data, fingerprints.get(key)) for key, data in notes)
+	
+	def remove(self, key):
+		""" take a note out of the mix """
+		
+		self.data -= self.contribution(key)
+		del self.notes[key]
+		del self.fingerprints[key]
+		self.changes += 1
+		
+		return
+	
+	def keys(self):
+		""" the notes in the mix """
+		return list(self.fingerprints)
+	
+	def resum(self):
+		""" add the notes up again from scratch, clearing any rounding the changes left """
+		
+		with instrument.span('recompose.sum', 'recompose', notes=len(self.fingerprints)):
+			self.data[...] = 0
+			
+			for key in self.fingerprints:
+				self.data += self.contribution(key)
+		
+		self.changes = 0
+		
+		return
+	
+	def write(self, out_file='out.wav'):
+		""" write the mix to a wav, normalised the same way as recompose
+		
+		return: None
+		side_effects: generate wav file in filesystem
+		"""
+		
+		with instrument.span('recompose.write', 'io'):
+			# wavs want the channels last
+			wavfile.write(out_file, self.sample_rate, normalise(self.data).T)
+		
+		instrument.count('bytes_written', self.data.nbytes)
+		
+		return
+	
+	def close(self):
+		""" let go of the contributions (removing the on_disk file), only the mix itself
+		(data & write) is any use after this """
+		
+		if self.filename is not None:
+			self.notes.close()
+			os.remove(self.filename)
+			self.filename = None
+		
+		self.notes = {}
+		self.fingerprints = {}
+		
+		return
+
+
 # ------------------------------------------------------------------------------------------------- #
 
 
@@ -0,0 +1,490 @@
+#! /usr/bin/env python3
+"""
+reading and writing decomposed notes to hdf5
+
+'table' layout (the default):
+	notes => one chunked (n_notes, n_samples) dataset, a row per note
+	index => table of (octave, noteint, note, freq) for each row
+	attrs => format, format_version, savetype, sample_rate, file_len, fourier_len
+	
+	savetype 2 notes are all different lengths, so for those notes is instead a flat
+	dataset of every note end to end, and bands holds (start, stop, offset) for each
+	row: the fourier bins start:stop the note came from and where it starts in notes
+	
+	savetype 3 notes are stored the same way, with a 4th column in bands for how much
+	each note is decimated by (the note is file_len // decimation samples long)
+	
+	multichannel files have a channels attr and a channel axis just before the samples,
+	so notes is (n_notes, channels, n_samples), or (channels, total) for savetype 2 & 3
+
+'keys' layout (the original one, still read & writable):
+	meta => int array of [savetype, sample_rate, file_len, fourier_len], with channels
+	        on the end for multichannel files
+	a dataset per note, named like '4-C#' (savetype 2 & 3 have start & stop attrs, 3
+	also has decimation), (channels, n_samples) for multichannel files
+"""
+
+import os
+import numpy as np
+import h5py
+import note_utils as note
+import instrument
+
+format_version = 3
+
+index_dtype = np.dtype([('octave', np.int32), ('noteint', np.int32), ('note', 'S2'), ('freq', np.float64)])
+
+
+def index_row(key):
+	""" the index table entry for a note key like '4-C#' """
+	octave, notename = note.key2note(key)
+	noteint = note.noteints[notename]
+	return np.array((octave, noteint, notename, note.note2freq(octave, noteint)), dtype=index_dtype)
+
+
+class note_writer:
+	""" write a decomposition to disk, one note at a time (append) or a block of
+	samples across every note at a time (allocate + write_block) """
+	
+	def __init__(self,
+	             filename,
+	             savetype,
+	             sample_rate,
+	             file_len,
+	             layout='table',
+	             compression=None,
+	             chunks=None,
+	             channels=None):
+		""" open the file and write the metadata
+		inputs:
+		filename => hdf5 file to write (without the extension)
+		savetype => 0 real data, 1 fourier data, 2 band limited complex envelope,
+		            3 real data at the lowest sample rate that still holds the note
+		sample_rate, file_len => of the original audio
+		layout => 'table' or 'keys', see the top of this file
+		compression => None, 'gzip' or 'lzf' (table layout only)
+		chunks => chunk shape of the notes dataset, defaults to a row and ~2**16 samples,
+		          'row' => a chunk per whole note (so an uncompressed note is in one piece
+		          on disk and note_reader.view can map it)
+		channels => number of channels of multichannel notes, None => notes have no
+		            channel axis
+		
+		return: None
+		side_effects: generate hdf5 file in filesystem
+		"""
+		
+		self.layout = layout
+		self.savetype = savetype
+		self.compression = compression
+		self.chunks = chunks
+		self.channels = channels
+		self.keys = []
+		
+		# how long each note is on disk
+		if savetype == 1:
+			self.row_len = file_len // 2 + 1
+		else:
+			self.row_len = file_len
+		
+		# shape of a note on disk
+		self.channel_shape = () if channels is None else (int(channels), )
+		self.row_shape = self.channel_shape + (self.row_len, )
+		
+		self.fp = h5py.File(filename + '.hdf5', 'w', libver='latest')
+		
+		if layout == 'table':
+			self.fp.attrs['format'] = 'notes2d'
+			self.fp.attrs['format_version'] = np.int32(format_version)
+			self.fp.attrs['savetype'] = np.int32(savetype)
+			self.fp.attrs['sample_rate'] = np.int64(sample_rate)
+			self.fp.attrs['file_len'] = np.int64(file_len)
+			self.fp.attrs['fourier_len'] = np.int64(file_len // 2 + 1)
+			
+			if channels is not None:
+				self.fp.attrs['channels'] = np.int64(channels)
+			
+			self.index = self.fp.create_dataset('index', shape=(0, ), maxshape=(None, ), dtype=index_dtype)
+			self.notes = None
+			
+			if savetype in (2, 3):
+				self.band_cols = 3 if savetype == 2 else 4
+				self.bands = self.fp.create_dataset('bands',
+				                                    shape=(0, self.band_cols),
+				                                    maxshape=(None, self.band_cols),
+				                                    dtype=np.int64)
+		
+		elif layout == 'keys':
+			meta = [savetype, sample_rate, file_len, file_len // 2 + 1] + list(self.channel_shape)
+			self.fp.create_dataset('meta', data=meta, dtype=int)
+		
+		else:
+			raise Exception("No idea how to handle layout " + str(layout))
+		
+		return
+	
+	def chunk_len(self):
+		""" about 2**16 samples, evened out so the last chunk isnt mostly padding """
+		n_chunks = int(np.ceil(self.row_len / 2**16))
+		return max(int(np.ceil(self.row_len / n_chunks)), 1)
+	
+	def create_notes(self, n_notes, dtype):
+		""" make the (n_notes, n_samples) dataset, growable along the note axis """
+		
+		if self.chunks is None:
+			chunks = (1, ) + self.channel_shape + (self.chunk_len(), )
+		elif self.chunks == 'row':
+			chunks = (1, ) + self.row_shape
+		else:
+			chunks = self.chunks
+		
+		self.notes = self.fp.create_dataset('notes',
+		                                    shape=(n_notes, ) + self.row_shape,
+		                                    maxshape=(None, ) + self.row_shape,
+		                                    chunks=chunks,
+		                                    dtype=dtype,
+		                                    compression=self.compression,
+		                                    shuffle=self.compression is not None)
+		return
+	
+	def add_index(self, keys):
+		""" add keys to the end of the index table """
+		
+		start = len(self.index)
+		self.index.resize((start + len(keys), ))
+		self.index[start:] = np.array([index_row(key) for key in keys], dtype=index_dtype)
+		
+		return
+	
+	def append_band(self, key, data, band):
+		""" write a savetype 2 or 3 note, see append """
+		
+		start, stop = band
+		
+		# savetype 3 notes are a whole number of times shorter than the audio
+		decimation = self.row_len // data.shape[-1]
+		
+		if self.layout == 'keys':
+			dset = self.fp.create_dataset(key, data=data, dtype=data.dtype)
+			dset.attrs['start'] = np.int64(start)
+			dset.attrs['stop'] = np.int64(stop)
+			
+			if self.savetype == 3:
+				dset.attrs['decimation'] = np.int64(decimation)
+		
+		else:
+			if self.notes is None:
+				self.notes = self.fp.create_dataset('notes',
+				                                    shape=self.channel_shape + (0, ),
+				                                    maxshape=self.channel_shape + (None, ),
+				                                    chunks=self.channel_shape + (2**16, ),
+				                                    dtype=data.dtype,
+				                                    compression=self.compression,
+				                                    shuffle=self.compression is not None)
+			
+			# every channel of the note goes at the same offset
+			offset = self.notes.shape[-1]
+			self.notes.resize(self.channel_shape + (offset + data.shape[-1], ))
+			self.notes[..., offset:] = data
+			
+			row = self.bands.shape[0]
+			self.bands.resize((row + 1, self.band_cols))
+			self.bands[row] = (start, stop, offset, decimation)[:self.band_cols]
+			self.add_index([key])
+		
+		self.keys.append(key)
+		
+		return
+	
+	def append(self, key, data, band=None):
+		""" write a whole note
+		inputs:
+		key => note name like '4-C#'
+		data => the note
+		band => (start, stop) fourier bins of a savetype 2 or 3 note
+		
+		return: None
+		side_effects: adds the note to the file
+		"""
+		
+		instrument.count('bytes_written', data.nbytes)
+		instrument.count('notes_written')
+		
+		with instrument.span('store.write', 'io', key=key):
+			if self.savetype in (2, 3):
+				return self.append_band(key, data, band)
+			
+			if self.layout == 'keys':
+				self.fp.create_dataset(key, data=data, dtype=data.dtype)
+			
+			else:
+				if self.notes is None:
+					self.create_notes(0, data.dtype)
+				
+				row = self.notes.shape[0]
+				self.notes.resize((row + 1, ) + self.row_shape)
+				self.notes[row] = data
+				self.add_index([key])
+		
+		self.keys.append(key)
+		
+		return
+	
+	def allocate(self, keys, dtype=float):
+		""" make room for a set of notes that get filled in with write_block
+		inputs:
+		keys => note names like '4-C#'
+		dtype => dtype of the notes
+		
+		return: None
+		side_effects: adds empty notes to the file
+		"""
+		
+		if self.layout == 'keys':
+			if self.chunks is None:
+				chunks = self.channel_shape + (self.chunk_len(), )
+			elif self.chunks == 'row':
+				chunks = None
+			else:
+				chunks = self.chunks[1:]
+			
+			for key in keys:
+				self.fp.create_dataset(key, shape=self.row_shape, chunks=chunks, dtype=dtype)
+		
+		else:
+			self.create_notes(len(keys), dtype)
+			self.add_index(keys)
+		
+		self.keys.extend(keys)
+		
+		return
+	
+	def write_block(self, lo, hi, block):
+		""" write samples lo:hi of every allocated note
+		inputs:
+		lo, hi => sample range
+		block => (n_notes, hi - lo) array, (n_notes, channels, hi - lo) if multichannel
+		
+		return: None
+		side_effects: fills in part of the file
+		"""
+		
+		instrument.count('bytes_written', block.nbytes)
+		
+		with instrument.span('store.write', 'io', samples=hi - lo):
+			if self.layout == 'keys':
+				for key, row in zip(self.keys, block):
+					self.fp[key][..., lo:hi] = row
+			
+			else:
+				self.notes[..., lo:hi] = block
+		
+		return
+	
+	def close(self):
+		""" cleanup """
+		self.fp.close()
+		return
+
+
+class note_reader:
+	""" read a decomposition from disk, whichever layout it was written in """
+	
+	def __init__(self, filename):
+		""" open the file and read the metadata
+		inputs:
+		filename => hdf5 file (without the extension) or an already open h5py file
+		
+		return: None
+		side_effects: None
+		"""
+		
+		if isinstance(filename, h5py.File):
+			self.fp = filename
+		else:
+			self.fp = h5py.File(filename + '.hdf5', 'r', libver='latest')
+		
+		if 'notes' in self.fp and self.fp.attrs.get('format') == 'notes2d':
+			self.layout = 'table'
+			self.savetype = int(self.fp.attrs['savetype'])
+			self.sample_rate = int(self.fp.attrs['sample_rate'])
+			self.file_len = int(self.fp.attrs['file_len'])
+			self.fourier_len = int(self.fp.attrs['fourier_len'])
+			self.channels = int(self.fp.attrs.get('channels', 0))
+			
+			self.notes = self.fp['notes']
+			self.index = self.fp['index'][:]
+			self.key_list = [note.note2key(i['octave'], i['note'].decode()) for i in self.index]
+			
+			if self.savetype in (2, 3):
+				self.bands = self.fp['bands'][:]
+		
+		else:
+			self.layout = 'keys'
+			meta = [int(i) for i in self.fp['meta']]
+			self.savetype, self.sample_rate, self.file_len, self.fourier_len = meta[:4]
+			self.channels = meta[4] if len(meta) > 4 else 0
+			
+			self.notes = None
+			self.key_list = [key for key in self.fp.keys() if key != 'meta']
+			self.index = np.array([index_row(key) for key in self.key_list], dtype=index_dtype)
+		
+		self.rows = {key: i for i, key in enumerate(self.key_list)}
+		
+		# our own handle on the file for view, opened on first use
+		self.raw = None
+		
+		# what the notes were stored as (the precision they were worked out in)
+		if self.notes is not None:
+			self.dtype = self.notes.dtype
+		elif len(self.key_list) > 0:
+			self.dtype = self.fp[self.key_list[0]].dtype
+		else:
+			self.dtype = np.dtype(np.float64)
+		
+		return
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *args):
+		self.close()
+		return
+	
+	def __len__(self):
+		return len(self.key_list)
+	
+	def __contains__(self, key):
+		return key in self.rows
+	
+	def keys(self):
+		""" note names, in the order they are stored """
+		return list(self.key_list)
+	
+	def channel_shape(self):
+		""" the shape of the channel axes of a note, () unless the file is multichannel """
+		return (self.channels, ) if self.channels else ()
+	
+	def __getitem__(self, key):
+		""" read a whole note """
+		
+		with instrument.span('store.read', 'io', key=key):
+			data = self.read_note(key)
+		
+		instrument.count('bytes_read', data.nbytes)
+		
+		return data
+	
+	def read_note(self, key):
+		""" read a whole note, see __getitem__ """
+		
+		if self.layout == 'keys':
+			return self.fp[key][:]
+		
+		if self.savetype == 2:
+			start, stop, offset = self.bands[self.rows[key]]
+			return self.notes[..., offset:offset + stop - start]
+		
+		if self.savetype == 3:
+			start, stop, offset, decimation = self.bands[self.rows[key]]
+			return self.notes[..., offset:offset + self.file_len // decimation]
+		
+		return self.notes[self.rows[key]]
+	
+	def view(self, key):
+		""" a whole note as a read only memory mapped view of the file, nothing is read
+		until it gets used. Only notes stored uncompressed in one piece can be mapped
+		(keys layout, or table layout savetype 0 & 1 written with chunks='row'), any other
+		note is read as __getitem__ would
+		"""
+		
+		if self.layout == 'keys':
+			dset = self.fp[key]
+			shape = dset.shape
+			offset = dset.id.get_offset()
+		
+		elif self.savetype in (0, 1) and self.notes.chunks == (1, ) + self.notes.shape[1:]:
+			dset = self.notes
+			shape = dset.shape[1:]
+			info = dset.id.get_chunk_info_by_coord((self.rows[key], ) + (0, ) * (dset.ndim - 1))
+			
+			# a compressed chunk on disk isnt the note
+			filtered = dset.compression is not None or dset.shuffle or dset.fletcher32
+			offset = None if filtered else info.byte_offset
+		
+		else:
+			offset = None
+		
+		if offset is None:
+			return self[key]
+		
+		if self.raw is None:
+			# a copy of h5py's own descriptor, so the mapping works even if the file gets
+			# deleted (evicted from a cache say) while we have it open
+			self.raw = os.fdopen(os.dup(self.fp.id.get_vfd_handle()), 'rb')
+		
+		return np.memmap(self.raw, dtype=dset.dtype, mode='r', offset=offset, shape=shape)
+	
+	def band(self, key):
+		""" (start, stop) fourier bins of a savetype 2 or 3 note, None for other savetypes """
+		
+		if self.savetype not in (2, 3):
+			return None
+		
+		if self.layout == 'keys':
+			return int(self.fp[key].attrs['start']), int(self.fp[key].attrs['stop'])
+		
+		start, stop = self.bands[self.rows[key]][:2]
+		return int(start), int(stop)
+	
+	def decimation(self, key):
+		""" how many times shorter than the audio a note is stored, 1 unless savetype 3 """
+		
+		if self.savetype != 3:
+			return 1
+		
+		if self.layout == 'keys':
+			return int(self.fp[key].attrs['decimation'])
+		
+		return int(self.bands[self.rows[key]][3])
+	
+	def read_rows(self, start, stop):
+		""" read notes start:stop (in storage order) as a 2d array """
+		
+		if self.savetype in (2, 3):
+			raise Exception("savetype 2 & 3 notes are all different lengths, read them one at a time")
+		
+		with instrument.span('store.read', 'io', rows=stop - start):
+			if self.layout == 'keys':
+				data = np.array([self.fp[key][:] for key in self.key_list[start:stop]])
+			else:
+				data = self.notes[start:stop]
+		
+		instrument.count('bytes_read', data.nbytes)
+		
+		return data
+	
+	def time_slice(self, lo, hi):
+		""" read samples lo:hi of every note as a (n_notes, hi - lo) array, or
+		(n_notes, channels, hi - lo) if multichannel """
+		
+		if self.savetype in (2, 3):
+			raise Exception("savetype 2 & 3 notes are all different lengths, read them one at a time")
+		
+		with instrument.span('store.read', 'io', samples=hi - lo):
+			if self.layout == 'keys':
+				data = np.array([self.fp[key][..., lo:hi] for key in self.key_list])
+			else:
+				data = self.notes[..., lo:hi]
+		
+		instrument.count('bytes_read', data.nbytes)
+		
+		return data
+	
+	def close(self):
+		""" cleanup """
+		
+		if self.raw is not None:
+			self.raw.close()
+		
+		self.fp.close()
+		return
@@ -20,6 +20,9 @@ notenames = {
     11: 'G#'
 }
 
+# and back again, so nobody has to search notenames
+noteints = {name: i for i, name in notenames.items()}
+
 
 def freq2note(f):
 	""" converts freq to the nearest note 
@@ -49,11 +52,68 @@ def note2freq(octave, note):
 	side effects: None
 	"""
 	
-	if type(note) != int:
+	if isinstance(note, str):
 		# convert str to int
 		#if np.floor((list(notenames.values()).index(note)+3) /12) == 1:
 		#octave += 1
-		note = np.mod(list(notenames.values()).index(note), 12)
+		note = noteints[note]
 	
 	n = note + 12 * int(octave - 4)
 	return 440 * (2**(n / 12))
+
+
+def note2freq_array(octave, noteint):
+	""" note2freq for arrays of notes
+	
+	input: octave => array of octaves (int)
+	       noteint => array of notes (int), same shape or broadcastable
+	
+	return: array of frequencies
+	side effects: None
+	"""
+	
+	n = np.asarray(noteint) + 12 * (np.asarray(octave).astype(int) - 4)
+	return 440 * (2**(n / 12))
+
+
+def freq2note_array(f):
+	""" freq2note for arrays of frequencies, notes come back as ints (see notenames)
+	
+	input: f => array of freqs
+	
+	return: (array of octaves, array of notes)
+	side effects: None
+	"""
+	
+	n = np.round(12 * np.log2(np.asarray(f) / 440)).astype(int)
+	
+	return n // 12 + 4, np.mod(n, 12)
+
+
+def note2key(octave, note):
+	""" name used for a note in the decomposition files
+	
+	input: octave (int)
+	       note (int) or (str)
+	
+	return: key like '4-C#'
+	side effects: None
+	"""
+	
+	if type(note) != str:
+		note = notenames[int(note)]
+	
+	return str(int(octave)) + '-' + note
+
+
+def key2note(key):
+	""" inverse of note2key
+	
+	input: key like '4-C#'
+	
+	return: (octave (int), note (str))
+	side effects: None
+	"""
+	
+	octave, note = key.split('-')
+	return int(octave), note
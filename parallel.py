@@ -0,0 +1,274 @@
+#! /usr/bin/env python3
+"""
+spread note work over a pool of processes. Big arrays (the spectrum going in, the
+notes coming out) live in memory mapped files that every process maps, preferably
+in /dev/shm, so only tiny (task, slot) messages ever get pickled. Results come back
+through a ring of output slots that the parent empties in task order, so the output
+is the same whatever order the workers happen to finish in. Jobs that only add their
+results up (reduce_map) get one accumulator per worker instead
+
+workers and fft threads come out of the same n_cpu (see split_cpus) so running
+workers * threads never asks for more cores than there are
+"""
+
+import os
+import tempfile
+import numpy as np
+import concurrent.futures
+import multiprocessing.util
+from collections import deque
+import instrument
+
+try:
+	# only used to stop the workers blas threads fighting over cores
+	import threadpoolctl
+except:
+	threadpoolctl = None
+
+
+def split_cpus(n_cpu, workers=None):
+	""" share out cores between worker processes and the fft threads in each
+	inputs:
+	n_cpu => cores we are allowed to use
+	workers => worker processes wanted, None => one per core
+	
+	return: (workers, threads per worker)
+	side_effects: None
+	"""
+	
+	n_cpu = max(int(n_cpu or 1), 1)
+	
+	if workers is None:
+		workers = n_cpu
+	
+	workers = min(max(int(workers), 1), n_cpu)
+	
+	return workers, n_cpu // workers
+
+
+def shm_dir():
+	""" somewhere backed by memory for the shared files if we have it """
+	
+	if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+		return '/dev/shm'
+	
+	return None
+
+
+class shared_array:
+	""" a numpy array in a memory mapped file. Pickles as just the file name, shape &
+	dtype so sending it to a worker maps the same memory rather than copying it """
+	
+	def __init__(self, shape, dtype=np.float64, filename=None):
+		""" make a new (zeroed) shared array, or map an existing one
+		inputs:
+		shape, dtype => of the array
+		filename => file of an existing shared array, None => make a new one
+		
+		return: None
+		side_effects: a new array creates a file, removed again by close
+		"""
+		
+		self.shape = tuple(shape)
+		self.dtype = np.dtype(dtype)
+		self.owner = filename is None
+		
+		if self.owner:
+			fd, filename = tempfile.mkstemp(prefix='threezerozeroeight-', suffix='.shm', dir=shm_dir())
+			os.ftruncate(fd, max(int(np.prod(self.shape)) * self.dtype.itemsize, 1))
+			os.close(fd)
+		
+		self.filename = filename
+		
+		if np.prod(self.shape) == 0:
+			self.array = np.zeros(self.shape, dtype=self.dtype)
+		else:
+			self.array = np.memmap(filename, dtype=self.dtype, mode='r+', shape=self.shape)
+		
+		return
+	
+	@classmethod
+	def copy_of(cls, data):
+		""" a shared array holding a copy of data """
+		
+		shared = cls(np.shape(data), np.asarray(data).dtype)
+		shared.array[...] = data
+		
+		return shared
+	
+	def __getstate__(self):
+		return {'shape': self.shape, 'dtype': self.dtype, 'filename': self.filename}
+	
+	def __setstate__(self, state):
+		self.__init__(state['shape'], state['dtype'], state['filename'])
+		return
+	
+	def close(self):
+		""" unmap the array, and remove the file if we made it """
+		
+		self.array = None
+		
+		if self.owner and os.path.exists(self.filename):
+			os.remove(self.filename)
+		
+		return
+
+
+# the job a worker process is running, set once by init_worker
+worker_job = None
+
+
+def shm_budget():
+	""" bytes of shared arrays one job may make: half of what is free where they go """
+	
+	try:
+		stat = os.statvfs(shm_dir() or tempfile.gettempdir())
+	except (OSError, AttributeError):
+		return 2**30
+	
+	return stat.f_bavail * stat.f_frsize // 2
+
+
+def fit_slots(n_slots, slot_bytes, budget=None):
+	""" cut a number of shared slots (or accumulators) down to what fits in memory
+	inputs:
+	n_slots => slots wanted
+	slot_bytes => size of one slot
+	budget => bytes the slots may take, None => shm_budget()
+	
+	return: slots to use, at least 1
+	side_effects: None
+	"""
+	
+	if budget is None:
+		budget = shm_budget()
+	
+	return int(max(min(n_slots, budget // max(slot_bytes, 1)), 1))
+
+
+def init_worker(job, threads, recording=None):
+	""" set up a worker process
+	inputs:
+	job => the job object (see ordered_map) whose run method the worker calls, if it
+	       has a close_worker method that gets called as the worker exits
+	threads => threads the worker may use for ffts & blas
+	recording => instrument.worker_state() of the parent, None => dont record
+	
+	return: None
+	side_effects: sets worker_job, sets up instrument
+	"""
+	
+	global worker_job
+	
+	worker_job = job
+	worker_job.threads = threads
+	
+	if threadpoolctl is not None:
+		threadpoolctl.threadpool_limits(threads)
+	
+	if recording is not None:
+		instrument.start_worker(recording)
+	
+	# not job.close, a forked worker holds the parents job & would remove its arrays
+	if hasattr(job, 'close_worker'):
+		multiprocessing.util.Finalize(None, job.close_worker, exitpriority=0)
+	
+	return
+
+
+def run_task(task, slot):
+	""" what the pool actually calls, hands the task on to the workers job and
+	returns what it gave back along with anything instrument recorded """
+	
+	result = worker_job.run(task, slot)
+	
+	return result, instrument.take()
+
+
+def ordered_map(job, n_tasks, workers, threads, n_slots=None):
+	""" run job.run(task, slot) for every task over a pool of processes, handing the
+	results back in task order. A task writes its output into output slot number slot
+	(job decides what that means), and a slot only gets reused once the parent has
+	asked for the next result, so the parent can read it until then
+	
+	inputs:
+	job => picklable object with a run(task, slot) method (and a threads attribute the
+	       worker sets), the job must not be modified after this is called
+	n_tasks => number of tasks, run as range(n_tasks)
+	workers, threads => see split_cpus
+	n_slots => output slots, defaults to twice workers so nobody waits on the parent
+	
+	yield: (task, slot, whatever run returned)
+	side_effects: runs a process pool
+	"""
+	
+	if n_slots is None:
+		n_slots = 2 * workers
+	
+	pending = deque()
+	
+	with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_worker,
+	                                            initargs=(job, threads, instrument.worker_state())) as pool:
+		
+		for task in range(n_tasks):
+			if len(pending) == n_slots:
+				# free a slot by handing the oldest result back
+				done, slot, future = pending.popleft()
+				yield done, slot, result_of(future)
+			
+			slot = task % n_slots
+			pending.append((task, slot, pool.submit(run_task, task, slot)))
+		
+		while pending:
+			done, slot, future = pending.popleft()
+			yield done, slot, result_of(future)
+	
+	return
+
+
+def result_of(future):
+	""" the result of a run_task or run_share, passing on what the worker recorded """
+	
+	result, recorded = future.result()
+	instrument.merge(recorded)
+	
+	return result
+
+
+def run_share(share, n_shares, n_tasks):
+	""" what the pool calls for reduce_map, runs every n_shares'th task into share """
+	
+	results = [worker_job.run(task, share) for task in range(share, n_tasks, n_shares)]
+	
+	return results, instrument.take()
+
+
+def reduce_map(job, n_tasks, workers, threads):
+	""" run job.run(task, share) for every task over a pool of processes, for jobs whose
+	results just get added up. The tasks are dealt out round robin into workers shares,
+	and each task adds its result into the accumulator of its share (job decides what
+	that means), so there is one accumulator per worker however many tasks there are.
+	A share runs its tasks in order, so the total (the accumulators added up in share
+	order) depends on the number of workers but not on how the pool schedules them
+	
+	inputs:
+	job => picklable object with a run(task, share) method (and a threads attribute the
+	       worker sets), the job must not be modified after this is called
+	n_tasks => number of tasks, run as range(n_tasks)
+	workers, threads => see split_cpus, workers is also the number of shares
+	
+	return: list of whatever run returned for each task, in task order
+	side_effects: runs a process pool
+	"""
+	
+	results = [None] * n_tasks
+	
+	with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_worker,
+	                                            initargs=(job, threads, instrument.worker_state())) as pool:
+		
+		futures = [pool.submit(run_share, share, workers, n_tasks) for share in range(workers)]
+		
+		for share, future in enumerate(futures):
+			results[share::workers] = result_of(future)
+	
+	return results
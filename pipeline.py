@@ -0,0 +1,249 @@
+#! /usr/bin/env python3
+"""
+decompose -> gate -> recompose in one pass, each block of notes goes straight from
+the decomposer through the gate and into the running sum, nothing touches the disk
+unless asked to (or the decomposition comes out of note_cache)
+"""
+
+import os
+import numpy as np
+from scipy.io import wavfile
+import note_recompose as nre
+import note_decompose as nde
+import note_cache
+import note_store
+import parallel
+
+
+def pipeline(nde_class, gate=None, out_file='out.wav', debug=None, block_gate=None, use_cache=False):
+	""" decompose, gate and recompose the audio held by nde_class
+	
+	inputs:
+	nde_class => note_decompose.decompose with its params set
+	gate => function(data, key) returning the gated note, None => no gating
+	out_file => wav file we want to write to, None => dont write one
+	debug => if set, also write the notes before and after gating to
+	         debug + '.hdf5' and debug + '2.hdf5' (same layout as decompose)
+	block_gate => function(block, keys) returning a gated (notes x samples) block,
+	              used instead of gate to work on nde_class.batch_size notes at once
+	use_cache => take the notes from note_cache (decomposing & caching them first if
+	             they arent there yet) rather than decomposing them as we go
+	
+	if nde_class.workers asks for more than one process, the batches are decomposed &
+	gated on a process pool (see parallel), unless debug is set. The gates then run in
+	the workers, so they need to be picklable where processes are spawned rather than
+	forked, and anything they update about themselves stays in the workers
+	
+	return: the recomposed data (before normalisation), (channels, samples) if nde_class
+	        is multichannel
+	side_effects: generate wav file (and debug hdf5 files) in filesystem
+	"""
+	
+	workers, threads = parallel.split_cpus(nde_class.n_cpu, nde_class.workers)
+	
+	reader = note_cache.load(nde_class, 0) if use_cache else None
+	
+	try:
+		if workers > 1 and debug is None:
+			data = pipeline_parallel(nde_class, gate, block_gate, workers, threads, reader)
+		
+		else:
+			data = pipeline_serial(nde_class, gate, block_gate, debug, reader)
+	
+	finally:
+		if reader is not None:
+			reader.close()
+	
+	if out_file is not None:
+		# channels (if there are any) go last in a wav
+		wavfile.write(out_file, nde_class.sample_rate, nre.normalise(data).T)
+	
+	return data
+
+
+def gate_block(block, keys, gate, block_gate):
+	""" run whichever gate we were given over a block of notes """
+	
+	if block_gate is not None:
+		return block_gate(block, keys)
+	
+	if gate is not None:
+		return np.array([gate(note_data, key) for key, note_data in zip(keys, block)])
+	
+	return block
+
+
+def pipeline_serial(nde_class, gate, block_gate, debug, reader=None):
+	""" the pipeline a batch at a time in this process, see pipeline. reader => cached
+	notes to use rather than decomposing """
+	
+	fp_in = fp_out = None
+	
+	if debug is not None:
+		fp_in = nde_class.note_writer(debug, 0)
+		fp_out = nde_class.note_writer(debug + '2', 0)
+	
+	data = np.zeros(nde_class.channel_shape() + (nde_class.file_len, ), dtype=nde_class.dtype())
+	
+	if reader is None:
+		blocks = nde_class.iter_blocks(savetype=0)
+	else:
+		blocks = note_cache.iter_blocks(reader, nde_class.batch_size)
+	
+	try:
+		for keys, block in blocks:
+			
+			if fp_in is not None:
+				for key, note_data in zip(keys, block):
+					fp_in.append(key, note_data)
+			
+			block = gate_block(block, keys, gate, block_gate)
+			
+			if fp_out is not None:
+				for key, note_data in zip(keys, block):
+					fp_out.append(key, note_data)
+			
+			data += np.sum(block, axis=0)
+	
+	finally:
+		for fp in (fp_in, fp_out):
+			if fp is not None:
+				fp.close()
+	
+	return data
+
+
+class gate_job(nde.note_job):
+	""" parallel.reduce_map job that decomposes & gates a batch of notes and adds the
+	sum of the batch into its share's accumulator (the slots of note_job) """
+	
+	def __init__(self, nde_class, fourier_data, notes, gate, block_gate, n_slots):
+		""" see note_decompose.note_job, gate & block_gate as pipeline, n_slots being
+		the accumulators (so the reduce_map workers) wanted """
+		
+		self.gate = gate
+		self.block_gate = block_gate
+		
+		nde.note_job.__init__(self, nde_class, fourier_data, notes, 0, n_slots)
+		
+		return
+	
+	def slot_shape(self, n_slots):
+		""" a running sum per accumulator """
+		return (n_slots, ) + self.nde_class.channel_shape() + (self.nde_class.file_len, )
+	
+	def run(self, task, share):
+		""" decompose, gate and sum a batch of notes into the accumulator of share
+		
+		return: the batch
+		side_effects: adds to the accumulator
+		"""
+		
+		batch = self.batch(task)
+		block = gate_block(self.block(task), self.nde_class.note_keys(batch), self.gate, self.block_gate)
+		
+		self.slots.array[share] += np.sum(block, axis=0)
+		
+		return batch
+
+
+class cached_gate_job:
+	""" parallel.reduce_map job that gates a batch of notes out of a cached
+	decomposition (see note_cache) and adds the sum of the batch into its share's
+	accumulator """
+	
+	def __init__(self, nde_class, filename, keys, gate, block_gate, n_slots):
+		""" inputs:
+		nde_class => decompose the cache entry was made with
+		filename => the cached hdf5 file (without the extension)
+		keys => the notes in it, in order
+		gate, block_gate => as pipeline
+		n_slots => accumulators (so reduce_map workers) wanted, self.n_slots is how many
+		           there are once cut down to what fits in shared memory
+		
+		return: None
+		side_effects: makes a shared array, close removes it
+		"""
+		
+		self.filename = filename
+		self.keys = keys
+		self.batch_size = nde_class.batch_size
+		self.gate = gate
+		self.block_gate = block_gate
+		self.threads = 1
+		
+		# opened in each worker the first time it is needed, h5py files dont pickle
+		self.reader = None
+		
+		sum_shape = nde_class.channel_shape() + (nde_class.file_len, )
+		self.n_slots = parallel.fit_slots(n_slots, int(np.prod(sum_shape)) * np.dtype(nde_class.dtype()).itemsize)
+		self.slots = parallel.shared_array((self.n_slots, ) + sum_shape, nde_class.dtype())
+		
+		return
+	
+	def n_tasks(self):
+		""" number of batches """
+		return int(np.ceil(len(self.keys) / self.batch_size))
+	
+	def run(self, task, share):
+		""" gate and sum a batch of cached notes into the accumulator of share
+		
+		return: the keys of the batch
+		side_effects: adds to the accumulator
+		"""
+		
+		if self.reader is None:
+			self.reader = note_store.note_reader(self.filename)
+		
+		keys = self.keys[task * self.batch_size:(task + 1) * self.batch_size]
+		block = np.array([self.reader.view(key) for key in keys])
+		
+		self.slots.array[share] += np.sum(gate_block(block, keys, self.gate, self.block_gate), axis=0)
+		
+		return keys
+	
+	def close_worker(self):
+		""" close the reader, parallel calls this as each worker exits """
+		
+		if self.reader is not None:
+			self.reader.close()
+			self.reader = None
+		
+		return
+	
+	def close(self):
+		""" cleanup """
+		self.close_worker()
+		self.slots.close()
+		return
+
+
+def pipeline_parallel(nde_class, gate, block_gate, workers, threads, reader=None):
+	""" the pipeline with the batches spread over a process pool, see pipeline. Each
+	worker adds its batches up into its own accumulator (see parallel.reduce_map) and
+	those get added up in order, so the result doesnt depend on how the batches get
+	scheduled, and only depends on the number of workers to rounding.
+	reader => cached notes to use rather than decomposing """
+	
+	if reader is None:
+		fourier_data, fourier_freqs = nde_class.spectrum()
+		notes = nde_class.note_list(fourier_freqs)
+		
+		job = gate_job(nde_class, fourier_data, notes, gate, block_gate, workers)
+	
+	else:
+		filename = os.path.splitext(reader.fp.filename)[0]
+		job = cached_gate_job(nde_class, filename, reader.keys(), gate, block_gate, workers)
+	
+	data = np.zeros(nde_class.channel_shape() + (nde_class.file_len, ), dtype=nde_class.dtype())
+	
+	try:
+		parallel.reduce_map(job, job.n_tasks(), job.n_slots, threads)
+		
+		for share in range(job.n_slots):
+			data += job.slots.array[share]
+	
+	finally:
+		job.close()
+	
+	return data
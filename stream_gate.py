@@ -0,0 +1,430 @@
+#! /usr/bin/env python3
+"""
+the adaptive noise gate on live audio, a fixed size block at a time. Everything the
+offline chain (decompose_stream -> noise_gate_adaptave.noise_gate_block -> sum) keeps
+in whole arrays is carried between blocks instead:
+
+filterbank => hann windowed frames of 2 * block_len overlapping by half, with the note
+              masks worked out once. These are the frames decompose_stream uses when
+              its block_len is 2 * block_len, which stream_gate sets on nde_class
+envelope => note samples that dont fill a whole spread block yet
+nlms => the weights and the last taps - 1 envelope samples of every note
+gain => the gains the next samples interpolate between
+
+latency: the output is the gated input delayed by a fixed self.latency samples,
+	block_len + 2 * spread - 1 - spread // 2
+block_len of that is the filterbank, a hop is only finished once the frame after it is
+in. The rest is the gain, which is interpolated between envelope samples at the block
+centres like envelope.apply_gain, so a sample has to wait for the end of the envelope
+block after it. The first self.latency samples out are silence. On top of that each
+block costs however long it takes to process, which is what the metrics measure
+
+apart from the first taps - 1 envelope samples (where the offline nlms has nothing to
+go on either) and the end of the audio, the notes and gain are the same as the offline
+chain, so the output is too (to rounding)
+"""
+
+import time
+import numpy as np
+from scipy.io import wavfile
+import fft_wrapper as fft
+import envelope
+import wav_stream
+
+
+class stream_gate:
+	""" stateful block processor: audio blocks in, gated audio blocks out """
+	
+	def __init__(self, nde_class, gate, block_len=4096):
+		""" set up the filterbank and gate state
+		inputs:
+		nde_class => note_decompose.decompose with its params and sample_rate set, the
+		             audio isnt needed (decompose(None)), multichannel & n_channels say
+		             what the blocks look like. Its block_len gets set to 2 * block_len
+		             so decompose_stream on it makes the same frames (with any other
+		             block_len the offline frames, and so the notes, come out different)
+		gate => noise_gate.noise_gate_adaptave with its params set, its window has to
+		        be None (or spread) and n None
+		block_len => samples per block, frames are twice this so it needs to be long
+		             enough to resolve the lowest octave (notes that dont fit are dropped
+		             the same way as in decompose)
+		
+		return: None
+		side_effects: loads the gates noise profile
+		"""
+		
+		if gate.window not in (None, gate.spread):
+			raise Exception("stream_gate only works with non-overlapping envelopes (window=None)")
+		
+		if gate.n is not None or gate.returnCoeffs:
+			raise Exception("stream_gate needs the gate to run the nlms over everything (n=None)")
+		
+		self.nde_class = nde_class
+		self.gate = gate
+		self.block_len = int(block_len)
+		
+		# frames of the same length as ours, see the top of this file
+		nde_class.block_len = 2 * self.block_len
+		self.sample_rate = nde_class.sample_rate
+		self.dtype = nde_class.dtype()
+		self.channel_shape = nde_class.channel_shape()
+		
+		self.spread = gate.spread
+		self.taps = gate.taps
+		self.profile = gate.noise_profile()
+		
+		# see the top of this file
+		self.gate_latency = 2 * self.spread - 1 - self.spread // 2
+		self.latency = self.block_len + self.gate_latency
+		
+		# ---- filterbank ---- #
+		frame_len = 2 * self.block_len
+		
+		# periodic hann windows at half overlap sum to exactly 1
+		window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(frame_len) / frame_len)
+		self.window = window.astype(self.dtype)
+		
+		fourier_freqs = np.fft.rfftfreq(frame_len, 1 / self.sample_rate)
+		nde_class.g_init = np.linspace(0, len(fourier_freqs), len(fourier_freqs))
+		
+		notes = nde_class.note_list(fourier_freqs)
+		self.keys = nde_class.note_keys(notes)
+		
+		# the masks themselves (the notes of a flat spectrum), so each frame is just a multiply
+		flat = np.ones(len(fourier_freqs), dtype=self.dtype)
+		if nde_class.truncate is None:
+			self.masks = nde_class.gauss_block(flat, notes)
+		else:
+			self.masks = nde_class.band_block(flat, nde_class.gauss_bands(notes))
+		
+		self.masks = self.masks.reshape(self.masks.shape[:1] + (1, ) * len(self.channel_shape) +
+		                                self.masks.shape[1:])
+		
+		self.reset()
+		
+		return
+	
+	def reset(self):
+		""" forget all the audio so far, the next block starts a new stream """
+		
+		note_shape = (len(self.keys), ) + self.channel_shape
+		
+		# filterbank: the current frame and the overlap-add buffer
+		self.frame = np.zeros(self.channel_shape + (2 * self.block_len, ), dtype=self.dtype)
+		self.acc = np.zeros(note_shape + (2 * self.block_len, ), dtype=self.dtype)
+		
+		# gate: note samples from self.pending_start on that havent been gated yet,
+		# gains from self.gain_start on and the nlms state
+		self.pending = np.zeros(note_shape + (0, ), dtype=self.dtype)
+		self.pending_start = 0
+		self.gains = np.zeros(note_shape + (0, ), dtype=self.dtype)
+		self.gain_start = 0
+		self.n_env = 0
+		self.history = np.zeros(note_shape + (0, ))
+		self.weights = None
+		
+		# gated audio from self.out_start on that hasnt been handed back yet
+		self.out = np.zeros(self.channel_shape + (0, ), dtype=self.dtype)
+		self.out_start = 0
+		
+		self.n_blocks = 0
+		self.metrics = []
+		
+		return
+	
+	def process(self, block):
+		""" gate a block of audio
+		inputs:
+		block => block_len samples, (block_len, ) or (block_len, channels) like a wav
+		
+		return: block_len samples of gated audio, self.latency samples behind the input,
+		        the same shape as a block in
+		side_effects: updates the state and adds this blocks metrics to self.metrics
+		"""
+		
+		start = time.perf_counter()
+		
+		out = self.step(block)
+		
+		seconds = time.perf_counter() - start
+		duration = self.block_len / self.sample_rate
+		
+		self.metrics.append({
+		    'block': self.n_blocks - 1,
+		    'seconds': seconds,
+		    'rtf': seconds / duration,
+		    'latency': self.latency / self.sample_rate + seconds
+		})
+		
+		return out
+	
+	def step(self, block):
+		""" process without the metrics, see process """
+		
+		block = np.asarray(block)
+		
+		if block.shape[0] != self.block_len:
+			raise Exception("blocks need to be %d samples, not %d" % (self.block_len, block.shape[0]))
+		
+		# the frame slides along a block, see note_decompose.decompose_stream
+		self.frame[..., :self.block_len] = self.frame[..., self.block_len:]
+		self.frame[..., self.block_len:] = self.nde_class.arrange_channels(block)
+		
+		fourier_data = fft.rfft(self.frame * self.window, axis=-1, threads=self.nde_class.n_cpu)
+		
+		self.acc += fft.irfft(fourier_data[np.newaxis] * self.masks,
+		                      axis=-1,
+		                      threads=self.nde_class.n_cpu,
+		                      overwrite_input=True)
+		
+		# the first block is finished now, except on the first frame where it is from before
+		# the start of the stream
+		if self.n_blocks > 0:
+			self.gate_notes(self.acc[..., :self.block_len])
+		
+		self.acc[..., :self.block_len] = self.acc[..., self.block_len:]
+		self.acc[..., self.block_len:] = 0
+		
+		self.n_blocks += 1
+		
+		# hand back the next block of output, anything before the stream started is silence
+		lo = self.n_blocks * self.block_len - self.latency - self.block_len
+		hi = lo + self.block_len
+		
+		if hi - self.out_start > self.out.shape[-1]:
+			raise Exception("stream_gate fell behind its latency")
+		
+		out = np.zeros(self.channel_shape + (self.block_len, ), dtype=self.dtype)
+		if hi > 0:
+			out[..., max(-lo, 0):] = self.out[..., max(lo, 0) - self.out_start:hi - self.out_start]
+			self.out = self.out[..., hi - self.out_start:]
+			self.out_start = hi
+		
+		return out.T
+	
+	def gate_notes(self, notes):
+		""" gate the next block of notes as far as the gains we know allow
+		inputs:
+		notes => (notes, channels..., samples) straight out of the filterbank
+		
+		return: None
+		side_effects: adds the sum of the gated notes to self.out
+		"""
+		
+		self.pending = np.concatenate((self.pending, notes), axis=-1)
+		n_in = self.pending_start + self.pending.shape[-1]
+		
+		# envelope every spread block that is complete now
+		n_new = n_in // self.spread - self.n_env
+		if n_new > 0:
+			lo = self.n_env * self.spread - self.pending_start
+			volume = envelope.block_envelope(self.pending[..., lo:lo + n_new * self.spread], self.spread,
+			                                 self.gate.detect_type)
+			self.gains = np.concatenate((self.gains, self.gain(volume).astype(self.dtype)), axis=-1)
+			self.n_env += n_new
+		
+		# every sample up to the centre of the last envelope block can be interpolated
+		if self.n_env == 0:
+			return
+		elif self.n_env == 1:
+			stop = (self.spread + 1) // 2
+		else:
+			stop = (self.n_env - 1) * self.spread + self.spread // 2
+		
+		if stop <= self.pending_start:
+			return
+		
+		# the same interpolation as envelope.apply_gain
+		pos = np.clip((np.arange(self.pending_start, stop) - (self.spread - 1) / 2) / self.spread, 0,
+		              self.n_env - 1)
+		k = np.minimum(pos.astype(int), max(self.n_env - 2, 0))
+		frac = (pos - k).astype(self.dtype, copy=False)
+		
+		k -= self.gain_start
+		g = self.gains[..., k] * (1 - frac) + self.gains[..., np.minimum(k + 1, self.gains.shape[-1] - 1)] * frac
+		
+		gated = self.pending[..., :stop - self.pending_start] * g
+		self.out = np.concatenate((self.out, np.sum(gated, axis=0)), axis=-1)
+		
+		# drop what nothing needs any more
+		self.pending = self.pending[..., stop - self.pending_start:]
+		self.pending_start = stop
+		
+		drop = max(int(k[-1]), 0)
+		self.gains = self.gains[..., drop:]
+		self.gain_start += drop
+		
+		return
+	
+	def gain(self, volume):
+		""" gain for new envelope samples, see noise_gate_adaptave.noise_gate_block
+		inputs:
+		volume => (notes, channels..., n) envelope samples following on from the last ones
+		
+		return: (notes, channels..., n) gain
+		side_effects: moves the nlms on
+		"""
+		
+		u = np.concatenate((self.history, volume), axis=-1)
+		
+		# the nlms needs taps envelope samples before it says anything
+		est_v_noise = np.zeros(volume.shape)
+		n_out = u.shape[-1] - self.taps + 1
+		
+		if n_out > 0:
+			offset = self.n_env - self.history.shape[-1]
+			v_noise = self.profile.stack(self.keys, u.shape[-1], offset)
+			v_noise = v_noise.reshape(v_noise.shape[:1] + (1, ) * len(self.channel_shape) + v_noise.shape[1:])
+			
+			y, err, self.weights = self.gate.nlms(u, v_noise, init_coeffs=self.weights)
+			est_v_noise[..., volume.shape[-1] - n_out:] = y
+		
+		self.history = u[..., max(u.shape[-1] - (self.taps - 1), 0):]
+		
+		est_v_data = volume - est_v_noise
+		est_v_data[est_v_data < 0] = 0
+		
+		return np.divide(est_v_data, volume, out=np.zeros_like(volume), where=volume > 0)
+	
+	def flush(self):
+		""" push silence through until the last of the input has come out
+		
+		return: the last self.latency samples of output
+		side_effects: updates the state (the stream cant carry on sensibly after this)
+		"""
+		
+		silence = np.zeros((self.block_len, ) + self.channel_shape[::-1])
+		
+		out = [self.step(silence) for i in range(int(np.ceil(self.latency / self.block_len)))]
+		
+		return np.concatenate(out, axis=0)[:self.latency]
+	
+	def report(self):
+		""" summary of self.metrics
+		
+		return: dict of
+		        blocks => blocks processed
+		        latency_samples, latency => algorithmic latency in samples & seconds
+		        mean_rtf, max_rtf => real time factor (seconds processing / seconds of audio)
+		        max_latency => worst latency including the processing time, in seconds
+		        overruns => blocks that took longer to process than they last
+		side_effects: None
+		"""
+		
+		rtf = np.array([m['rtf'] for m in self.metrics])
+		
+		return {
+		    'blocks': len(self.metrics),
+		    'latency_samples': self.latency,
+		    'latency': self.latency / self.sample_rate,
+		    'mean_rtf': float(np.mean(rtf)) if len(rtf) else 0.0,
+		    'max_rtf': float(np.max(rtf)) if len(rtf) else 0.0,
+		    'max_latency': max((m['latency'] for m in self.metrics), default=self.latency / self.sample_rate),
+		    'overruns': int(np.sum(rtf > 1))
+		}
+
+
+# -------------------------------------------------------------------------------------------- #
+# stand-ins for live input
+
+
+def pace(start, n_samples, sample_rate):
+	""" sleep until n_samples worth of audio would have arrived since start """
+	
+	wait = start + n_samples / sample_rate - time.perf_counter()
+	if wait > 0:
+		time.sleep(wait)
+	
+	return
+
+
+def wav_source(filename, block_len, realtime=False):
+	""" blocks of a wav file, as if it were coming in live
+	inputs:
+	filename => wav file
+	block_len => samples per block, the last block is zero padded
+	realtime => hand the blocks out no faster than the audio would arrive
+	
+	yield: (block_len, ) or (block_len, channels) blocks
+	side_effects: None
+	"""
+	
+	sample_rate, data = wavfile.read(filename, mmap=True)
+	start = time.perf_counter()
+	
+	for lo in range(0, len(data), block_len):
+		block = np.zeros((block_len, ) + data.shape[1:])
+		block[:min(block_len, len(data) - lo)] = data[lo:lo + block_len]
+		
+		if realtime:
+			pace(start, lo + block_len, sample_rate)
+		
+		yield block
+
+
+def tone_source(sample_rate, block_len, n_blocks, freqs=(440.0, ), noise=0.0, seed=0, realtime=False):
+	""" a generator standing in for live input: sine waves plus white noise
+	inputs:
+	sample_rate => samples per second
+	block_len => samples per block
+	n_blocks => how many blocks to make, None => carry on forever
+	freqs => frequencies of the sines (amplitude 1 each)
+	noise => stddev of the noise
+	seed => for the noise
+	realtime => hand the blocks out no faster than the audio would arrive
+	
+	yield: (block_len, ) blocks
+	side_effects: None
+	"""
+	
+	rng = np.random.default_rng(seed)
+	start = time.perf_counter()
+	
+	i = 0
+	while n_blocks is None or i < n_blocks:
+		t = (i * block_len + np.arange(block_len)) / sample_rate
+		block = np.sum([np.sin(2 * np.pi * f * t) for f in freqs], axis=0)
+		block = block + noise * rng.standard_normal(block_len)
+		
+		if realtime:
+			pace(start, (i + 1) * block_len, sample_rate)
+		
+		yield block
+		i += 1
+
+
+def run(processor, source, out_file=None, align=True):
+	""" push every block of a source through a stream_gate
+	inputs:
+	processor => stream_gate
+	source => iterable of blocks, eg wav_source or tone_source
+	out_file => wav file to write the gated audio to, None => dont write one
+	align => drop the latency from the start of the output (and flush out the end) so
+	         it lines up with the input, otherwise write exactly what came out live
+	
+	return: processor.report()
+	side_effects: writes out_file
+	"""
+	
+	out = None
+	if out_file is not None:
+		out = wav_stream.wav_writer(out_file,
+		                            processor.sample_rate,
+		                            channels=int(np.prod(processor.channel_shape)),
+		                            dtype=processor.dtype)
+	
+	skip = processor.latency if align else 0
+	
+	for block in source:
+		gated = processor.process(block)
+		
+		if out is not None:
+			out.write(gated[skip:])
+		skip = max(skip - len(gated), 0)
+	
+	if out is not None:
+		if align:
+			out.write(processor.flush())
+		out.close()
+	
+	return processor.report()
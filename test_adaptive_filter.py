@@ -0,0 +1,115 @@
+#! /usr/bin/env python3
+"""
+adaptive_filter against adaptfilt.nlms (the sample at a time reference it replaced) on
+synthetic signals, and fdaf identifying a known system
+
+	python -m pytest test_adaptive_filter.py
+"""
+
+import numpy as np
+import pytest
+import adaptive_filter as af
+
+adaptfilt = pytest.importorskip('adaptfilt')
+
+taps = 20
+mu = 0.5
+
+# every option that changes the numbers
+options = [{}, {'leak': 0.05}, {'initCoeffs': 'random'}, {'N': 3000}, {'returnCoeffs': True},
+           {'leak': 0.05, 'initCoeffs': 'random', 'N': 2500, 'returnCoeffs': True}]
+
+
+def signals(n=5000, seed=1):
+	""" a coloured input, a known fir system and its noisy output
+	
+	return: u, d, the system
+	"""
+	
+	rng = np.random.default_rng(seed)
+	
+	u = np.cumsum(rng.standard_normal(n)) * 0.01 + rng.standard_normal(n)
+	system = rng.standard_normal(taps)
+	d = np.convolve(u, system)[:n] + 0.01 * rng.standard_normal(n)
+	
+	return u, d, system
+
+
+def kargs_for(option):
+	""" the keyword arguments for an entry of options """
+	
+	kargs = dict(option)
+	
+	if kargs.get('initCoeffs') == 'random':
+		kargs['initCoeffs'] = np.random.default_rng(2).standard_normal(taps)
+	
+	return kargs
+
+
+@pytest.mark.parametrize('option', options)
+@pytest.mark.parametrize('filter_name', ['sample', 'block'])
+def test_matches_adaptfilt(filter_name, option):
+	""" nlms & block_nlms give the same y, e & w as adaptfilt.nlms """
+	
+	u, d, system = signals()
+	kargs = kargs_for(option)
+	
+	expected = adaptfilt.nlms(u, d, taps, mu, **kargs)
+	result = af.filters[filter_name](u, d, taps, mu, **kargs)
+	
+	for want, got in zip(expected, result):
+		assert got.shape == want.shape
+		np.testing.assert_allclose(got, want, rtol=0, atol=1e-10)
+
+
+@pytest.mark.parametrize('block_len', [1, 7, 32, 128])
+def test_block_len(block_len):
+	""" the block length (including a short last block) doesnt change the numbers """
+	
+	u, d, system = signals(n=1000)
+	
+	expected = adaptfilt.nlms(u, d, taps, mu)
+	result = af.block_nlms(u, d, taps, mu, block_len=block_len)
+	
+	for want, got in zip(expected, result):
+		np.testing.assert_allclose(got, want, rtol=0, atol=1e-10)
+
+
+@pytest.mark.parametrize('filter_name', ['sample', 'block', 'fdaf'])
+def test_batch(filter_name):
+	""" leading axes are independent filters, each with its own mu """
+	
+	u, d, system = signals(n=2000)
+	
+	y, e, w = af.filters[filter_name](np.stack([u, u[::-1]]), np.stack([d, d[::-1]]), taps, np.array([0.5, 0.2]))
+	
+	for row, (u_row, d_row, mu_row) in enumerate([(u, d, 0.5), (u[::-1], d[::-1], 0.2)]):
+		want = af.filters[filter_name](u_row, d_row, taps, mu_row)
+		
+		for got, expected in zip((y[row], e[row], w[row]), want):
+			np.testing.assert_allclose(got, expected, rtol=0, atol=1e-10)
+
+
+def test_fdaf_converges():
+	""" fdaf finds the weights of a known system and the error drops to the noise """
+	
+	u, d, system = signals(n=20000)
+	
+	y, e, w = af.fdaf(u, d, taps, mu)
+	
+	np.testing.assert_allclose(w, system, rtol=0, atol=0.05)
+	assert np.sqrt(np.mean(e[-1000:]**2)) < 0.05
+	assert np.sqrt(np.mean(e[-1000:]**2)) < 0.01 * np.sqrt(np.mean(e[:1000]**2))
+
+
+def test_fdaf_return_coeffs():
+	""" returnCoeffs gives the weights in use after every sample, ending on w """
+	
+	u, d, system = signals(n=2000)
+	
+	y, e, w = af.fdaf(u, d, taps, mu)
+	y2, e2, coeffs = af.fdaf(u, d, taps, mu, returnCoeffs=True)
+	
+	assert coeffs.shape == (len(e), taps)
+	np.testing.assert_allclose(coeffs[-1], w, rtol=0, atol=1e-12)
+	np.testing.assert_allclose(e2, e, rtol=0, atol=1e-12)
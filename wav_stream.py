@@ -0,0 +1,120 @@
+#! /usr/bin/env python3
+"""
+write a float wav file a block at a time, so long recompositions never need the
+whole output in memory. The header is the same one scipy.io.wavfile writes for
+float data, so the files read back with wavfile.read
+"""
+
+import numpy as np
+import struct
+
+
+class wav_writer:
+	""" incremental float wav writer, keeps track of the running peak so the file can
+	be normalised in place (a second pass over the file) once it has been written """
+	
+	def __init__(self, filename, sample_rate, channels=1, dtype=np.float64):
+		""" open the file and write a placeholder header
+		inputs:
+		filename => wav file to write
+		sample_rate => samples per second
+		channels => number of channels
+		dtype => np.float64 or np.float32
+		
+		return: None
+		side_effects: creates the file
+		"""
+		
+		self.filename = filename
+		self.sample_rate = int(sample_rate)
+		self.channels = int(channels)
+		self.dtype = np.dtype(dtype).newbyteorder('<')
+		
+		self.n_frames = 0
+		self.max = -np.inf  # largest sample so far
+		self.peak = 0  # largest absolute sample so far
+		
+		self.fp = open(filename, 'wb')
+		self.fp.write(self.header())
+		self.header_len = self.fp.tell()
+		
+		return
+	
+	def header(self):
+		""" RIFF header for the frames written so far """
+		
+		bit_depth = self.dtype.itemsize * 8
+		block_align = self.channels * self.dtype.itemsize
+		data_len = self.n_frames * block_align
+		
+		if data_len > 0xFFFFFFFF - 50:
+			raise Exception("wav file too big for RIFF, try writing float32 instead")
+		
+		# format 3 => IEEE float, the 0 on the end is cbSize
+		fmt_chunk = struct.pack('<HHIIHHH', 3, self.channels, self.sample_rate,
+		                        self.sample_rate * block_align, block_align, bit_depth, 0)
+		
+		header = b'WAVE'
+		header += b'fmt ' + struct.pack('<I', len(fmt_chunk)) + fmt_chunk
+		header += b'fact' + struct.pack('<II', 4, self.n_frames)
+		header += b'data' + struct.pack('<I', data_len)
+		
+		return b'RIFF' + struct.pack('<I', len(header) + data_len) + header
+	
+	def write(self, block):
+		""" add a block of audio to the end of the file
+		inputs:
+		block => (n, ) or (n, channels) array
+		
+		return: None
+		side_effects: appends to the file, updates self.max & self.peak
+		"""
+		
+		block = np.asarray(block, dtype=self.dtype)
+		
+		if len(block) == 0:
+			return
+		
+		self.max = max(self.max, np.max(block))
+		self.peak = max(self.peak, np.max(np.abs(block)))
+		self.n_frames += block.shape[0]
+		
+		self.fp.write(block.tobytes())
+		
+		return
+	
+	def close(self):
+		""" fill in the real sizes in the header and close the file """
+		
+		self.fp.seek(0)
+		self.fp.write(self.header())
+		self.fp.close()
+		
+		return
+	
+	def divide(self, scale, block_len=2**16):
+		""" divide every sample in the (closed) file by scale, a block at a time
+		inputs:
+		scale => what to divide by
+		block_len => frames to rescale at once
+		
+		return: None
+		side_effects: rewrites the audio in the file
+		"""
+		
+		if self.n_frames == 0:
+			return
+		
+		data = np.memmap(self.filename,
+		                 dtype=self.dtype,
+		                 mode='r+',
+		                 offset=self.header_len,
+		                 shape=(self.n_frames, self.channels))
+		
+		for lo in range(0, self.n_frames, block_len):
+			data[lo:lo + block_len] /= scale
+		
+		data.flush()
+		del data
+		
+		return